@@ -0,0 +1,406 @@
+# coding: utf-8
+
+# # Batch Geographic Segmentation
+# Run the geographic segmentation (see geographic_segmentation.py) for many study areas without a notebook or display.
+#
+# **Usage:**
+#
+#     python batch_segmentation.py manifest.json --output batch_output --workers 4 --plots defer --tiles 8 15
+#
+# For a weekly refresh after the roads, rivers or population layers were updated, add --incremental: the EAs of the
+# previous run of each study area are updated in place, only re-splitting and recounting the EAs touched by a change.
+#
+# **The manifest** is a JSON file with optional defaults and a list of study areas, for example:
+#
+#     {"defaults": {"meters": 500, "crs": "epsg:32735", "crs_out": "epsg:4326", "limit_check": 100},
+#      "areas": [{"name": "mukobela",
+#                 "study_area": "shapefiles/study_area_32735.shp",
+#                 "line_layers": {"roads": {"file": "shapefiles/roads_4326.shp", "field": "highway", "keep": ["secondary", "primary"]},
+#                                 "rivers": {"file": "shapefiles/rivers_4326.shp", "field": "waterway", "keep": ["river", "ocean", "lake", "sea"]}},
+#                 "count_layers": {"_fb": {"file": "shapefiles/fb_roofs_4326.shp", "check_shape": true, "label": "FB"},
+#                                  "_roof": {"file": "shapefiles/roofs_4326.shp", "check_shape": false, "label": "Roofs"}}}]}
+#
+# Count layers can also take a field and keep list, as the line layers. Records of other categories, and points outside
+# the bounding box of the study area, are skipped while reading.
+# Every setting of an area (meters, crs, crs_out, limit_check, tolerance, tile_cells, projected) falls back to the defaults.
+# With "projected": true the EAs are trimmed, split and counted in crs and only reprojected to crs_out at the end,
+# so the tolerance (the width of the buffer around the lines) is in meters, e.g. 0.1.
+# Relative paths are relative to the folder of the manifest.
+#
+# **Outputs** (one folder per study area in the output folder):<br>
+# 1) EA_information.csv: the EAs with their counts, category and ea_id,<br>
+# 2) grids_final_<crs_out>.shp: the EAs with their ea_id and category,<br>
+# 3) summary.json: the number of EAs in each category and the run time,<br>
+# 4) plots/inclusion_exclusion.png: only with --plots defer, drawn once all study areas are segmented,<br>
+# 5) tiles: only with --tiles, a PNG tile pyramid (tiles/zoom/x/y.png) of the EAs by category, built once all study areas are segmented,<br>
+# 6) snapshot: only with --incremental, the EAs and input layers of the run, which the next --incremental run updates.<br>
+# A batch_summary.csv in the output folder lists the status of every study area, a failed study area does not stop the others.
+
+# import packages
+import argparse
+import json
+import os
+import time
+import traceback
+import numpy as np
+import pandas as pd
+import shapely
+import shapefile
+
+# plots are only saved, never shown
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+# import custom functions
+import functions.clean_data as clean_data
+import functions.load_data as load_data
+import functions.mapping as mapping
+import functions.pipeline as pipeline
+import functions.points as points
+import functions.cache as cache
+import functions.incremental as incremental
+import functions.reproject as reproject
+import functions.tiles as tiles
+
+## settings of a study area that can be set in the manifest defaults
+DEFAULTS = {'meters': 500, 'crs': 'epsg:32735', 'crs_out': 'epsg:4326', 'limit_check': 100,
+            'tolerance': 1e-6, 'tile_cells': None, 'projected': False}
+
+
+def read_manifest(file_name):
+    '''
+    purpose
+    # read a manifest of study areas and fill in the defaults and full file paths
+    
+    inputs
+    # file_name: the path of the manifest (JSON)
+    
+    outputs
+    # areas: a list of dictionaries, one per study area
+    '''
+    
+    with open(file_name) as f:
+        manifest = json.load(f)
+    
+    folder = os.path.dirname(os.path.abspath(file_name))
+    defaults = dict(DEFAULTS, **manifest.get('defaults', {}))
+    
+    def full_path(path):
+        return(path if os.path.isabs(path) else os.path.join(folder, path))
+    
+    areas = []
+    
+    for area in manifest['areas']:
+        area = dict(defaults, **area)
+        area['study_area'] = full_path(area['study_area'])
+    
+        area['line_layers'] = {x: dict(y, file = full_path(y['file'])) for x, y in area.get('line_layers', {}).items()}
+        area['count_layers'] = {x: dict(y, file = full_path(y['file'])) for x, y in area.get('count_layers', {}).items()}
+    
+        areas.append(area)
+    
+    ## the name of each area is used as its output folder
+    names = [x['name'] for x in areas]
+    
+    if len(set(names)) != len(names):
+        raise ValueError('the names of the study areas in the manifest must be unique')
+    
+    return(areas)
+
+def load_layers(area):
+    '''
+    purpose
+    # read the study area, boundary and population shapefiles of a study area, keeping only the records 
+    # of the kept categories and within the study area (see load_data.load_layer)
+    
+    inputs
+    # area: a study area from read_manifest
+    
+    outputs
+    # study_area: the shape of the study area (all records merged) in the area's crs
+    # line_layers: a dictionary with the layer name as key and a series of lines as value
+    # count_layers: a dictionary with the column suffix as key and (series of shapes or PointStore, check_shape) as value
+    '''
+    
+    df_study_area = load_data.load_layer(area['study_area'])
+    study_area = shapely.union_all(df_study_area['shape'].values)
+    
+    ## the study area in the CRS of the other layers, to clip them while reading
+    clip = study_area if area['crs_out'] is None else reproject.transform_shapes(study_area, area['crs'], area['crs_out'])
+    
+    ## boundaries, keeping only the major categories if a field and keep list are given
+    line_layers = {}
+    
+    for name, layer in area['line_layers'].items():
+        where = {layer['field']: layer['keep']} if 'field' in layer else None
+    
+        line_layers[name] = load_data.load_layer(layer['file'], where = where, clip = clip)['shape']
+    
+    ## population shapes, points are held as coordinates only
+    count_layers = {}
+    
+    for append_names, layer in area['count_layers'].items():
+        reader = shapefile.Reader(layer['file'])
+        where = {layer['field']: layer['keep']} if 'field' in layer else None
+    
+        ### only the points within the bounding box of the study area are read
+        if reader.shapeType in load_data.POINT_TYPES:
+            check_shapes = points.PointStore.from_shapefile(reader, crs = area['crs_out'], where = where, bbox = clip.bounds)
+        else:
+            check_shapes = load_data.load_layer(reader, where = where, clip = clip)['shape']
+    
+        count_layers[append_names] = (check_shapes, layer.get('check_shape', False))
+    
+    return(study_area, line_layers, count_layers)
+
+def ea_category(eas, labels):
+    '''
+    purpose
+    # the category of each EA from the population layers that intersect it, e.g. 'FB and Roofs', 'Only FB', 'Neither FB or Roofs'
+    
+    inputs
+    # eas: the EAs with an intersect column per population layer
+    # labels: a dictionary with the column suffix as key and the label of the layer as value, e.g. {'_fb': 'FB'}
+    
+    outputs
+    # category: an array with the category of each EA
+    '''
+    
+    names = list(labels.keys())
+    
+    if len(names) == 0:
+        return(np.full(eas.shape[0], 'No population data', dtype = object))
+    
+    present = np.column_stack([eas['intersect' + x].values == True for x in names])
+    
+    ## name each combination of layers once
+    combinations, inverse = np.unique(present, axis = 0, return_inverse = True)
+    category_names = []
+    
+    for combination in combinations:
+        found = [labels[names[x]] for x in np.flatnonzero(combination)]
+    
+        if len(found) == 0:
+            category_names.append('Neither ' + ' or '.join(labels.values()))
+        elif len(found) == len(names):
+            category_names.append(' and '.join(found))
+        else:
+            category_names.append('Only ' + ' and '.join(found))
+    
+    category = np.array(category_names + [''], dtype = object)[inverse.reshape(-1)]
+    
+    return(category)
+
+def update_area(area, study_area, line_layers, count_layers, folder):
+    '''
+    purpose
+    # update the EAs of the previous run of a study area, only re-splitting and recounting the EAs touched by 
+    # changed lines or population shapes (see incremental.run_incremental) - the first run is a full run
+    
+    inputs
+    # area: a study area from read_manifest
+    # study_area, line_layers, count_layers: the layers of the study area (see load_layers)
+    # folder: the output folder of the study area, which holds the snapshot of the previous run
+    
+    outputs
+    # eas: the EAs in the area's crs_out
+    # summary: a dictionary describing what was updated
+    '''
+    
+    crs_out = area['crs_out']
+    
+    ## in projected mode the snapshot holds the layers in crs, and only the EAs are reprojected to crs_out
+    if (area['projected'] == True) and (crs_out is not None):
+        line_layers, count_layers = pipeline.project_layers(line_layers = line_layers, count_layers = count_layers,
+                                                            src_crs = crs_out, dst_crs = area['crs'])
+        crs_out = None
+    
+    eas, summary = incremental.run_incremental(
+            directory = os.path.join(folder, 'snapshot'), study_area = study_area, meters = area['meters'],
+            line_layers = line_layers, count_layers = count_layers, crs = area['crs'], crs_out = crs_out,
+            limit_check = area['limit_check'], tolerance = area['tolerance'])
+    
+    if crs_out != area['crs_out']:
+        eas = eas.copy()
+        eas['shape'] = reproject.transform_shapes(eas['shape'], src_crs = area['crs'], dst_crs = area['crs_out'])
+    
+    return(eas, summary)
+
+def run_area(area):
+    '''
+    purpose
+    # segment one study area and write its outputs (run in a worker process)
+    
+    inputs
+    # area: a study area from read_manifest, with the output folder and cache settings added by run_batch
+    
+    outputs
+    # result: a dictionary with the status of the study area, and its EAs if plots are deferred or tiles are built
+    '''
+    
+    start = time.time()
+    folder = os.path.join(area['output'], area['name'])
+    os.makedirs(folder, exist_ok = True)
+    
+    try:
+        study_area, line_layers, count_layers = load_layers(area)
+    
+        settings = {x: area[x] for x in DEFAULTS}
+        segment = lambda: pipeline.segment_area(study_area = study_area, line_layers = line_layers,
+                                                count_layers = count_layers, **settings)
+    
+        update = None
+    
+        ## update the EAs of the previous run of this study area, or reuse the EAs of an earlier run with the same 
+        ## input files and settings
+        if area['incremental'] == True:
+            eas, update = update_area(area = area, study_area = study_area, line_layers = line_layers,
+                                      count_layers = count_layers, folder = folder)
+        elif area['cache'] is None:
+            eas = segment()
+        else:
+            files = [area['study_area']] + [x['file'] for x in area['line_layers'].values()] \
+                    + [x['file'] for x in area['count_layers'].values()]
+            params = dict(settings, line_layers = area['line_layers'], count_layers = area['count_layers'])
+    
+            eas, key = cache.StageCache(directory = area['cache']).run(
+                    stage = 'segment_area', function = segment, files = files, params = params)
+    
+        labels = {x: area['count_layers'][x].get('label', x.strip('_')) for x in area['count_layers']}
+        eas['category'] = ea_category(eas, labels)
+    
+        ## save EA information
+        columns = ['shape', 'index'] + [y + x for x in labels for y in ['intersect', 'intersect_count', 'intersect_no_count']] \
+                  + ['ea_id', 'category']
+        eas[columns].to_csv(os.path.join(folder, 'EA_information.csv'), index = False)
+    
+        crs_name = str(area['crs_out'] or area['crs']).split(':')[-1]
+        clean_data.export_shapefile_bulk(df = eas, shape_name = 'shape', field_names = [['ea_id', 'N'], ['category', 'C']],
+                                         file_name = os.path.join(folder, 'grids_final_' + crs_name))
+    
+        result = {'name': area['name'], 'status': 'done', 'n_eas': int(eas.shape[0]),
+                  'seconds': round(time.time() - start, 1), 'error': ''}
+    
+        with open(os.path.join(folder, 'summary.json'), 'w') as f:
+            json.dump(dict(result, categories = eas['category'].value_counts().to_dict(), update = update), f, indent = 2)
+    
+        if (area['plots'] == 'defer') or (area['tiles'] is not None):
+            result['eas'] = eas[['shape', 'category']]
+            result['study_area'] = study_area
+    
+    except Exception as error:
+        result = {'name': area['name'], 'status': 'failed', 'n_eas': 0,
+                  'seconds': round(time.time() - start, 1), 'error': repr(error)}
+    
+        with open(os.path.join(folder, 'error.txt'), 'w') as f:
+            f.write(traceback.format_exc())
+    
+    return(result)
+
+def plot_area(result, area):
+    '''
+    purpose
+    # save the map of EAs by category for a segmented study area
+    
+    inputs
+    # result: the result of run_area (with its EAs)
+    # area: the study area from read_manifest
+    
+    outputs - none, plots/inclusion_exclusion.png is saved in the folder of the study area
+    '''
+    
+    folder = os.path.join(area['output'], area['name'], 'plots')
+    os.makedirs(folder, exist_ok = True)
+    
+    eas = result['eas']
+    
+    fig, ax = mapping.plot_set_up(plot_title = 'Map of EAs for ' + area['name'],
+                                  plot_height = 10, plot_width = 8,
+                                  x_label = 'Longitude', y_label = 'Latitude',
+                                  plot_aspect = 'equal')
+    
+    mapping.group_collection(axis = ax, grouped_df = eas.groupby('category', sort = False),
+                             colors = max(eas['category'].nunique(), 1), shape_column = 'shape', alpha = 0.6)
+    
+    mapping.plot_final(ax_object = ax, fig_object = fig, file_name = os.path.join(folder, 'inclusion_exclusion.png'),
+                       save_file = True)
+    
+    plt.close(fig)
+
+def run_batch(areas, output, workers = 1, plots = 'skip', cache_directory = None, tile_zooms = None, incremental = False):
+    '''
+    purpose
+    # segment many study areas, several at a time
+    
+    inputs
+    # areas: a list of study areas from read_manifest
+    # output: the output folder (one sub-folder per study area)
+    # workers: the number of study areas segmented at the same time
+    # plots: 'skip' for no plots, 'defer' to draw the plots once all study areas are segmented
+    # cache_directory: the folder of the stage cache (None for no cache)
+    # tile_zooms: the zoom levels of the tile pyramid of each study area (None for no tiles)
+    # incremental: whether to update the EAs of the previous run of each study area (see update_area)
+    
+    outputs
+    # summary: a dataframe with the status of every study area (also saved as batch_summary.csv)
+    '''
+    
+    os.makedirs(output, exist_ok = True)
+    
+    ## the tiles are drawn with Pillow, and skipped if it is not installed
+    if (tile_zooms is not None) and (tiles.Image is None):
+        print('Pillow is not installed, skipping the tile pyramids (install it with: pip install Pillow)')
+        tile_zooms = None
+    
+    tasks = [dict(x, output = output, plots = plots, cache = cache_directory, tiles = tile_zooms, incremental = incremental)
+             for x in areas]
+    results = pipeline.run_tasks(run_area, tasks, workers = workers)
+    
+    if plots == 'defer':
+        for result, area in zip(results, tasks):
+            if result['status'] == 'done':
+                plot_area(result, area)
+    
+    ## the tiles of each study area, drawn with all workers
+    if tile_zooms is not None:
+        for result, area in zip(results, tasks):
+            if result['status'] == 'done':
+                tiles.build_tiles(shapes = result['eas']['shape'], categories = result['eas']['category'],
+                                  directory = os.path.join(output, area['name'], 'tiles'), zooms = tile_zooms,
+                                  crs = area['crs_out'] or area['crs'], workers = workers)
+    
+    summary = pd.DataFrame([{x: y[x] for x in ['name', 'status', 'n_eas', 'seconds', 'error']} for y in results])
+    summary.to_csv(os.path.join(output, 'batch_summary.csv'), index = False)
+    
+    return(summary)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Run the geographic segmentation for every study area in a manifest.')
+    parser.add_argument('manifest', help = 'JSON manifest of study areas')
+    parser.add_argument('--output', default = 'batch_output', help = 'output folder, one sub-folder per study area')
+    parser.add_argument('--workers', type = int, default = 1, help = 'number of study areas segmented at the same time')
+    parser.add_argument('--plots', choices = ['skip', 'defer'], default = 'skip',
+                        help = 'skip plots, or draw them once all study areas are segmented')
+    parser.add_argument('--tiles', type = int, nargs = 2, default = None, metavar = ('MIN_ZOOM', 'MAX_ZOOM'),
+                        help = 'build a PNG tile pyramid of the EAs of each study area for these zoom levels')
+    parser.add_argument('--cache', default = None, help = 'folder of the stage cache, to reuse unchanged study areas')
+    parser.add_argument('--only', nargs = '*', default = None, help = 'names of the study areas to run (default all)')
+    parser.add_argument('--incremental', action = 'store_true',
+                        help = 'update the EAs of the previous run of each study area, only redoing the EAs touched by changes')
+    args = parser.parse_args()
+    
+    areas = read_manifest(args.manifest)
+    
+    if args.only is not None:
+        areas = [x for x in areas if x['name'] in args.only]
+    
+    summary = run_batch(areas = areas, output = args.output, workers = args.workers,
+                        plots = args.plots, cache_directory = args.cache, incremental = args.incremental,
+                        tile_zooms = None if args.tiles is None else range(args.tiles[0], args.tiles[1] + 1))
+    
+    print(summary.to_string(index = False))
+    
+    ## a non-zero exit code if any study area failed
+    raise SystemExit(int((summary['status'] != 'done').any()))
@@ -0,0 +1,436 @@
+'''
+Benchmark the pipeline stages on synthetic study areas
+
+Each stage (create_grids, split_grids_polygon, split_grids_line, split_multiline, count_within_grid,
+export_shapefile and a sweep over three grid sizes) is timed and memory-profiled separately, for the original function and its faster
+variants, and the results are written to a JSON file that can be compared between commits:
+
+    python benchmarks/run_benchmarks.py --sizes small medium
+    python benchmarks/run_benchmarks.py --sizes medium --baseline benchmarks/results/<commit>.json
+    python benchmarks/run_benchmarks.py --compare old.json new.json
+'''
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import shapely
+
+## the functions are imported from the root of the repository, as in the notebook
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import functions.clean_data as clean_data
+import functions.multires as multires
+import functions.pipeline as pipeline
+import functions.points as points
+import functions.profiling as profiling
+import functions.reproject as reproject
+import benchmarks.synthetic as synthetic
+
+
+def prepare_inputs(data):
+    '''
+    purpose
+    # run the pipeline once with the fast functions, so that each stage can be benchmarked on the output of the stage before it
+    
+    inputs
+    # data: the layers of a synthetic study area (see synthetic.make_dataset)
+    
+    outputs
+    # data: the same dictionary with the inputs of every stage added
+    '''
+    
+    grids = clean_data.create_grids_box(shape = data['area_source'], meters = data['meters'])[['shape']]
+    grids['shape'] = reproject.transform_shapes(grids['shape'], src_crs = synthetic.CRS_SOURCE,
+                                                dst_crs = synthetic.CRS_DESTINATION)
+    grids.reset_index(inplace = True)
+    
+    trim = clean_data.split_grids_polygon_index(grids = grids['shape'], boundaries = data['df_study_area']['shape'])
+    
+    lines = pd.concat([clean_data.split_multiline(df = data['df_roads'], shape_name = 'shape')['shape'],
+                       clean_data.split_multiline(df = data['df_rivers'], shape_name = 'shape')['shape']],
+                      ignore_index = True)
+    
+    eas = clean_data.split_grids_lines(grids = trim, shape_name = 'shape', index_name = 'index',
+                                       boundary_layers = {'lines': lines})
+    
+    data.update({'grids': grids, 'trim': trim, 'lines': lines, 'eas': eas})
+    
+    return(data)
+
+def export_original(df, directory):
+    clean_data.export_shapefile(df = df, shape_name = 'shape', field_names = [['index', 'N'], ['bd_index', 'N']],
+                                file_name = os.path.join(directory, 'eas'))
+    
+    return(df)
+
+def export_bulk(df, directory):
+    clean_data.export_shapefile_bulk(df = df, shape_name = 'shape', field_names = [['index', 'N'], ['bd_index', 'N']],
+                                     file_name = os.path.join(directory, 'eas'))
+    
+    return(df)
+
+def sweep_inputs(d):
+    ## the layers of segment_area, and three grid sizes around the grid size of the study area
+    line_layers = {'roads': d['df_roads']['shape'], 'rivers': d['df_rivers']['shape']}
+    count_layers = {'_fb': (d['fb'], True), '_roof': (points.PointStore.from_shapes(d['roofs']), False)}
+    
+    return(line_layers, count_layers, [d['meters'] // 2, d['meters'], d['meters'] * 2])
+
+def sweep_separate(d):
+    ## one run per grid size, with the origin of the sweep so that the EAs are the same
+    line_layers, count_layers, resolutions = sweep_inputs(d)
+    origin = clean_data.grid_origin(d['area_source'], max(resolutions))
+    
+    eas = [pipeline.segment_area(study_area = d['area_source'], meters = x, line_layers = line_layers, count_layers = count_layers,
+                                 tolerance = 0.1, projected = True, origin = origin) for x in resolutions]
+    
+    return(pd.concat(eas, ignore_index = True))
+
+def sweep_multires(d):
+    line_layers, count_layers, resolutions = sweep_inputs(d)
+    
+    eas = multires.segment_resolutions(study_area = d['area_source'], resolutions = resolutions,
+                                       line_layers = line_layers, count_layers = count_layers, tolerance = 0.1)
+    
+    return(pd.concat(list(eas.values()), ignore_index = True))
+
+## the benchmarked functions: the stage, the name of the function, and a function of the inputs and a scratch folder
+STAGES = [
+    {'stage': 'create_grids', 'function': 'create_grids',
+     'run': lambda d, tmp: clean_data.create_grids(shape = d['area_source'], meters = d['meters'])},
+    {'stage': 'create_grids', 'function': 'create_grids_box',
+     'run': lambda d, tmp: clean_data.create_grids_box(shape = d['area_source'], meters = d['meters'])},
+    
+    {'stage': 'split_grids_polygon', 'function': 'split_grids_polygon',
+     'run': lambda d, tmp: clean_data.split_grids_polygon(grids = d['grids']['shape'], boundaries = d['df_study_area']['shape'])},
+    {'stage': 'split_grids_polygon', 'function': 'split_grids_polygon_index',
+     'run': lambda d, tmp: clean_data.split_grids_polygon_index(grids = d['grids']['shape'], boundaries = d['df_study_area']['shape'])},
+    
+    {'stage': 'split_grids_line', 'function': 'split_grids_line',
+     'run': lambda d, tmp: clean_data.split_grids_line(grids = d['trim'], shape_name = 'shape', index_name = 'index', boundaries = d['lines'])},
+    {'stage': 'split_grids_line', 'function': 'split_grids_line_index',
+     'run': lambda d, tmp: clean_data.split_grids_line_index(grids = d['trim'], shape_name = 'shape', index_name = 'index', boundaries = d['lines'])},
+    {'stage': 'split_grids_line', 'function': 'split_grids_lines',
+     'run': lambda d, tmp: clean_data.split_grids_lines(grids = d['trim'], shape_name = 'shape', index_name = 'index', boundary_layers = {'lines': d['lines']})},
+    
+    {'stage': 'split_multiline', 'function': 'split_multiline',
+     'run': lambda d, tmp: clean_data.split_multiline(df = d['df_roads'], shape_name = 'shape')},
+    
+    {'stage': 'count_within_grid_points', 'function': 'count_within_grid',
+     'run': lambda d, tmp: clean_data.count_within_grid(grid_shapes = d['eas']['shape'], check_shapes = d['roofs'],
+                                                         append_names = '_roof', check_shape = False)},
+    {'stage': 'count_within_grid_points', 'function': 'count_within_grid_index',
+     'run': lambda d, tmp: clean_data.count_within_grid_index(grid_shapes = d['eas']['shape'], check_shapes = d['roofs'],
+                                                               append_names = '_roof', check_shape = False)},
+    {'stage': 'count_within_grid_polygons', 'function': 'count_within_grid',
+     'run': lambda d, tmp: clean_data.count_within_grid(grid_shapes = d['eas']['shape'], check_shapes = d['fb'],
+                                                         append_names = '_fb', check_shape = True)},
+    {'stage': 'count_within_grid_polygons', 'function': 'count_within_grid_index',
+     'run': lambda d, tmp: clean_data.count_within_grid_index(grid_shapes = d['eas']['shape'], check_shapes = d['fb'],
+                                                               append_names = '_fb', check_shape = True)},
+    
+    {'stage': 'export_shapefile', 'function': 'export_shapefile',
+     'run': lambda d, tmp: export_original(d['eas'], tmp)},
+    {'stage': 'export_shapefile', 'function': 'export_shapefile_bulk',
+     'run': lambda d, tmp: export_bulk(d['eas'], tmp)},
+    
+    {'stage': 'resolution_sweep', 'function': 'segment_area',
+     'run': lambda d, tmp: sweep_separate(d)},
+    {'stage': 'resolution_sweep', 'function': 'segment_resolutions',
+     'run': lambda d, tmp: sweep_multires(d)}]
+
+
+def measure(run, data, memory):
+    '''
+    purpose
+    # run one function on the inputs and measure it
+    
+    inputs
+    # run: the function to measure, which takes the inputs and a scratch folder
+    # data: the inputs of the stages (see prepare_inputs)
+    # memory: whether to trace the Python allocations (slower, so timing runs do not trace)
+    
+    outputs
+    # result: a dictionary with the seconds, the number of output rows and, if memory, the peak Python and resident memory in MB
+    '''
+    
+    directory = tempfile.mkdtemp(prefix = 'benchmark_')
+    
+    try:
+        reset = profiling.reset_peak_rss() if memory == True else False
+        rss_start = profiling.rss_mb('VmRSS')
+    
+        if memory == True:
+            tracemalloc.start()
+    
+        start = time.perf_counter()
+        output = run(data, directory)
+        seconds = time.perf_counter() - start
+    
+        result = {'seconds': seconds, 'rows': int(len(output))}
+    
+        if memory == True:
+            result['python_peak_mb'] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+            tracemalloc.stop()
+    
+            ## the resident memory also covers the GEOS and numpy allocations that tracemalloc does not see
+            rss_peak = profiling.rss_mb('VmHWM')
+            result['rss_peak_mb'] = (rss_peak - rss_start) if (reset == True) and (rss_peak is not None) else None
+    finally:
+        shutil.rmtree(directory, ignore_errors = True)
+    
+    return(result)
+
+def _measure_child(run, data, memory, connection):
+    try:
+        connection.send({'status': 'ok', **measure(run, data, memory)})
+    except Exception as e:
+        connection.send({'status': 'error', 'error': '%s: %s' % (type(e).__name__, e)})
+    finally:
+        connection.close()
+
+def measure_isolated(run, data, memory, timeout):
+    '''
+    purpose
+    # measure one run in a forked process, so that the stages do not share memory peaks or caches,
+    # and a run that takes longer than the timeout is stopped and recorded instead of stalling the benchmark
+    
+    inputs
+    # run, data, memory: see measure
+    # timeout: the maximum number of seconds of the run (None for no limit)
+    
+    outputs
+    # result: the result of measure with a status ('ok', 'error' or 'timeout')
+    '''
+    
+    ## without fork (e.g. Windows) the inputs cannot be shared with a child process, so the run is measured here
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        try:
+            return({'status': 'ok', **measure(run, data, memory)})
+        except Exception as e:
+            return({'status': 'error', 'error': '%s: %s' % (type(e).__name__, e)})
+    
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex = False)
+    
+    process = context.Process(target = _measure_child, args = (run, data, memory, sender))
+    process.start()
+    sender.close()
+    
+    result = receiver.recv() if receiver.poll(timeout) else {'status': 'timeout', 'timeout': timeout}
+    
+    if process.is_alive():
+        process.terminate()
+    
+    process.join()
+    
+    return(result)
+
+def benchmark_size(size_name, params, stages, functions, repeat, timeout, seed):
+    '''
+    purpose
+    # benchmark the selected stages on one synthetic study area
+    
+    inputs
+    # size_name: the name of the size (see synthetic.SIZES)
+    # params: the parameters of synthetic.make_dataset
+    # stages: the names of the stages to run (None for all)
+    # functions: the names of the functions to run (None for all)
+    # repeat: the number of timing runs of each function (the fastest is reported)
+    # timeout: the maximum number of seconds of each run
+    # seed: the seed of the random generator
+    
+    outputs
+    # results: a list of dictionaries, one per function
+    '''
+    
+    data = prepare_inputs(synthetic.make_dataset(seed = seed, **params))
+    
+    inputs = {'grids': len(data['grids']), 'trim': len(data['trim']), 'eas': len(data['eas']),
+              'lines': len(data['lines']), 'roofs': len(data['roofs']), 'fb': len(data['fb'])}
+    
+    print('%s: %s' % (size_name, ', '.join('%s %s' % (x, inputs[x]) for x in inputs)))
+    
+    results = []
+    
+    for x in STAGES:
+        if ((stages is not None) and (x['stage'] not in stages)) or ((functions is not None) and (x['function'] not in functions)):
+            continue
+    
+        ## timing runs, stopped at the first run that does not finish
+        runs = []
+    
+        for i in range(repeat):
+            runs.append(measure_isolated(x['run'], data, memory = False, timeout = timeout))
+    
+            if runs[-1]['status'] != 'ok':
+                break
+    
+        result = {'size': size_name, 'stage': x['stage'], 'function': x['function'], 'inputs': inputs,
+                  'status': runs[-1]['status'], 'seconds': None, 'seconds_all': [], 'rows': None,
+                  'python_peak_mb': None, 'rss_peak_mb': None}
+    
+        if runs[-1]['status'] == 'ok':
+            result['seconds_all'] = [r['seconds'] for r in runs]
+            result['seconds'] = min(result['seconds_all'])
+            result['rows'] = runs[-1]['rows']
+    
+            ### one more run for the memory, as tracing slows down the run
+            memory = measure_isolated(x['run'], data, memory = True, timeout = None if timeout is None else 10 * timeout)
+    
+            if memory['status'] == 'ok':
+                result['python_peak_mb'] = memory['python_peak_mb']
+                result['rss_peak_mb'] = memory['rss_peak_mb']
+        else:
+            result.update({k: runs[-1][k] for k in runs[-1] if k != 'status'})
+    
+        results.append(result)
+        print(format_result(result))
+    
+    return(results)
+
+def format_result(result):
+    if result['status'] != 'ok':
+        return('  %-28s %-28s %s' % (result['stage'], result['function'], result['status']))
+    
+    memory = '' if result['rss_peak_mb'] is None else ' %10.1f MB rss' % result['rss_peak_mb']
+    python = '' if result['python_peak_mb'] is None else ' %10.1f MB python' % result['python_peak_mb']
+    
+    return('  %-28s %-28s %10.3f s %8d rows%s%s' % (result['stage'], result['function'], result['seconds'],
+                                                     result['rows'], python, memory))
+
+def git_commit():
+    '''
+    purpose
+    # the commit of the repository, and whether it has uncommitted changes, so that results can be matched to the code
+    
+    outputs
+    # commit: the commit hash (None outside a git repository)
+    # dirty: whether the working tree has changes
+    '''
+    
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd = ROOT, capture_output = True,
+                                text = True, check = True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd = ROOT,
+                                capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return(None, None)
+    
+    return(commit, len(status) > 0)
+
+def environment():
+    import shapefile
+    
+    return({'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'numpy': np.__version__, 'pandas': pd.__version__, 'shapely': shapely.__version__,
+            'geos': shapely.geos_version_string, 'pyshp': shapefile.__version__})
+
+def compare_results(baseline, current):
+    '''
+    purpose
+    # print the change in time and memory of each function between two result files
+    
+    inputs
+    # baseline: the results of the older commit (dictionary loaded from JSON)
+    # current: the results of the newer commit
+    
+    outputs
+    # comparison: a dataframe with one row per function and size that is in both files
+    '''
+    
+    keys = ['size', 'stage', 'function']
+    columns = keys + ['status', 'seconds', 'rss_peak_mb', 'python_peak_mb']
+    
+    old = pd.DataFrame(baseline['results'], columns = columns)
+    new = pd.DataFrame(current['results'], columns = columns)
+    
+    comparison = old.merge(new, on = keys, suffixes = ('_old', '_new'))
+    
+    for x in ['seconds', 'rss_peak_mb', 'python_peak_mb']:
+        comparison[x + '_ratio'] = pd.to_numeric(comparison[x + '_new'], errors = 'coerce') / pd.to_numeric(comparison[x + '_old'], errors = 'coerce')
+    
+    print('baseline %s (%s), current %s (%s)' % (str(baseline.get('commit'))[:10], baseline.get('created'),
+                                                 str(current.get('commit'))[:10], current.get('created')))
+    
+    with pd.option_context('display.width', 200, 'display.max_rows', None, 'display.float_format', '{:.3f}'.format):
+        print(comparison[keys + ['status_old', 'status_new', 'seconds_old', 'seconds_new', 'seconds_ratio',
+                                 'rss_peak_mb_ratio', 'python_peak_mb_ratio']].to_string(index = False))
+    
+    return(comparison)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark the pipeline stages on synthetic study areas')
+    parser.add_argument('--sizes', nargs = '+', default = ['small'],
+                        help = 'sizes of the synthetic study areas: ' + ', '.join(synthetic.SIZES) + ' or custom (default: small)')
+    parser.add_argument('--stages', nargs = '+', default = None, help = 'only run these stages (default: all)')
+    parser.add_argument('--functions', nargs = '+', default = None, help = 'only run these functions (default: all)')
+    parser.add_argument('--repeat', type = int, default = 3, help = 'timing runs of each function, the fastest is reported (default: 3)')
+    parser.add_argument('--timeout', type = float, default = 300, help = 'seconds after which a run is stopped and recorded as a timeout (default: 300)')
+    parser.add_argument('--seed', type = int, default = 0, help = 'seed of the synthetic data (default: 0)')
+    parser.add_argument('--output', default = None, help = 'JSON results file (default: benchmarks/results/<commit>.json)')
+    parser.add_argument('--baseline', default = None, help = 'JSON results file of an older commit to compare with')
+    parser.add_argument('--compare', nargs = 2, default = None, metavar = ('BASELINE', 'CURRENT'),
+                        help = 'only compare two JSON results files')
+    
+    ## the custom size starts from medium, with any of these overrides
+    for x in synthetic.SIZES['medium']:
+        parser.add_argument('--' + x, type = int, default = None, help = 'custom size: ' + x)
+    
+    args = parser.parse_args()
+    
+    if args.compare is not None:
+        with open(args.compare[0]) as f_old, open(args.compare[1]) as f_new:
+            compare_results(json.load(f_old), json.load(f_new))
+        return
+    
+    sizes = dict(synthetic.SIZES)
+    sizes['custom'] = {x: synthetic.SIZES['medium'][x] if getattr(args, x) is None else getattr(args, x) for x in synthetic.SIZES['medium']}
+    
+    unknown = [x for x in args.sizes if x not in sizes]
+    
+    if len(unknown) > 0:
+        parser.error('unknown sizes: ' + ', '.join(unknown))
+    
+    commit, dirty = git_commit()
+    
+    report = {'commit': commit, 'dirty': dirty, 'created': datetime.datetime.now().isoformat(timespec = 'seconds'),
+              'environment': environment(), 'seed': args.seed, 'repeat': args.repeat, 'timeout': args.timeout,
+              'sizes': {x: sizes[x] for x in args.sizes}, 'results': []}
+    
+    for x in args.sizes:
+        report['results'] += benchmark_size(x, sizes[x], stages = args.stages, functions = args.functions,
+                                            repeat = args.repeat, timeout = args.timeout, seed = args.seed)
+    
+    output = args.output
+    
+    if output is None:
+        output = os.path.join(ROOT, 'benchmarks', 'results', (commit or 'nogit')[:10] + ('-dirty' if dirty else '') + '.json')
+    
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok = True)
+    
+    with open(output, 'w') as f:
+        json.dump(report, f, indent = 2)
+    
+    print('results written to ' + output)
+    
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            compare_results(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+import numpy as np
+import pandas as pd
+import shapely
+
+import functions.reproject as reproject
+
+## the sizes of the synthetic study areas
+### radius: the radius of the study area in meters
+### meters: the width and height of each grid
+### roads, rivers: the number of roads and rivers (random walks of 1 km steps)
+### roofs: the number of roof points, fb: the number of FB polygons
+SIZES = {'small': {'radius': 3000, 'meters': 500, 'roads': 10, 'rivers': 3, 'roofs': 5000, 'fb': 1000},
+         'medium': {'radius': 10000, 'meters': 500, 'roads': 40, 'rivers': 8, 'roofs': 50000, 'fb': 10000},
+         'large': {'radius': 30000, 'meters': 500, 'roads': 150, 'rivers': 20, 'roofs': 500000, 'fb': 50000}}
+
+## centre of the synthetic study areas (UTM zone 35S, the CRS of the notebook)
+CENTRE = (400000, 8000000)
+CRS_SOURCE = 'epsg:32735'
+CRS_DESTINATION = 'epsg:4326'
+
+
+def study_area(radius, rng, vertices = 60):
+    '''
+    purpose
+    # a synthetic study area: an irregular polygon around CENTRE
+    
+    inputs
+    # radius: the average distance of the boundary from the centre in meters
+    # rng: a numpy random generator
+    # vertices: the number of vertices of the boundary
+    
+    outputs
+    # area: a Polygon in CRS_SOURCE
+    '''
+    
+    angle = np.linspace(0, 2 * np.pi, vertices, endpoint = False)
+    distance = radius * (1 + 0.2 * rng.uniform(-1, 1, vertices))
+    
+    return(shapely.Polygon(np.column_stack([CENTRE[0] + distance * np.cos(angle),
+                                            CENTRE[1] + distance * np.sin(angle)])))
+
+def line_network(n_lines, radius, rng, steps = 20, step_meters = 1000, multi_share = 0.3):
+    '''
+    purpose
+    # a synthetic road or river network: random walks that start inside the study area
+    # a share of the lines are cut into pieces and stored as MultiLineStrings, as in OSM extracts
+    
+    inputs
+    # n_lines: the number of lines
+    # radius: the radius of the study area in meters
+    # rng: a numpy random generator
+    # steps: the number of steps of each walk
+    # step_meters: the length of each step
+    # multi_share: the share of lines stored as MultiLineStrings
+    
+    outputs
+    # lines: a list of LineStrings and MultiLineStrings in CRS_SOURCE
+    '''
+    
+    lines = []
+    
+    for i in range(n_lines):
+        start = np.array(CENTRE) + rng.uniform(-radius, radius, 2)
+        direction = rng.uniform(0, 2 * np.pi) + np.cumsum(rng.normal(0, 0.3, steps))
+    
+        coords = np.vstack([start, start + np.cumsum(step_meters * np.column_stack([np.cos(direction), np.sin(direction)]), axis = 0)])
+    
+        ## cut the walk into 2 or 3 pieces
+        if rng.uniform() < multi_share:
+            cuts = np.sort(rng.choice(np.arange(2, steps - 1), size = rng.integers(1, 3), replace = False))
+            pieces = [coords[x:y + 1] for x, y in zip(np.r_[0, cuts], np.r_[cuts, steps])]
+            lines.append(shapely.MultiLineString(pieces))
+        else:
+            lines.append(shapely.LineString(coords))
+    
+    return(lines)
+
+def point_cloud(n_points, radius, rng, clusters = 50, spread = 1500):
+    '''
+    purpose
+    # a synthetic cloud of roof points, clustered around villages
+    
+    inputs
+    # n_points: the number of points
+    # radius: the radius of the study area in meters
+    # rng: a numpy random generator
+    # clusters: the number of villages
+    # spread: the standard deviation of the distance of a roof from its village
+    
+    outputs
+    # x, y: arrays with the coordinates of the points in CRS_SOURCE
+    '''
+    
+    centres = np.array(CENTRE) + rng.uniform(-radius, radius, (clusters, 2))
+    xy = centres[rng.integers(0, clusters, n_points)] + rng.normal(0, spread, (n_points, 2))
+    
+    return(xy[:, 0], xy[:, 1])
+
+def make_dataset(radius, meters, roads, rivers, roofs, fb, seed = 0):
+    '''
+    purpose
+    # generate the layers of a synthetic study area, in the same format as the notebook after loading the shapefiles
+    
+    inputs
+    # radius, meters, roads, rivers, roofs, fb: the size of the study area (see SIZES)
+    # seed: the seed of the random generator
+    
+    outputs
+    # data: a dictionary with
+    ## area_source: the study area in CRS_SOURCE (to create the grids)
+    ## df_study_area: a dataframe with the study area in CRS_DESTINATION
+    ## df_roads, df_rivers: dataframes with the lines (some are MultiLineStrings) and their attributes
+    ## roofs: a series of roof Points, fb: a series of FB Polygons with df_fb_values (population attributes)
+    ## meters: the width and height of each grid
+    '''
+    
+    rng = np.random.default_rng(seed)
+    
+    area = study_area(radius, rng)
+    
+    ## roads and rivers, with the attributes used to filter them in the notebook
+    road_lines = reproject.transform_shapes(pd.Series(line_network(roads, radius, rng)), CRS_SOURCE, CRS_DESTINATION)
+    river_lines = reproject.transform_shapes(pd.Series(line_network(rivers, radius, rng, steps = 30)), CRS_SOURCE, CRS_DESTINATION)
+    
+    df_roads = pd.DataFrame({'highway': rng.choice(['primary', 'secondary', 'tertiary', 'residential'], roads),
+                             'surface': rng.choice(['paved', 'unpaved'], roads),
+                             'shape': list(road_lines)})
+    df_rivers = pd.DataFrame({'waterway': rng.choice(['river', 'stream'], rivers),
+                              'name': ['river_' + str(x) for x in range(rivers)],
+                              'shape': list(river_lines)})
+    
+    ## roofs as Points, FB as small squares around a share of the roofs
+    x, y = point_cloud(roofs, radius, rng)
+    lon, lat = reproject.transform_xy(x, y, CRS_SOURCE, CRS_DESTINATION)
+    
+    fb_pos = rng.choice(roofs, size = min(fb, roofs), replace = False)
+    fb_shapes = shapely.box(lon[fb_pos] - 0.0002, lat[fb_pos] - 0.0002, lon[fb_pos] + 0.0002, lat[fb_pos] + 0.0002)
+    
+    data = {'area_source': area,
+            'df_study_area': pd.DataFrame({'shape_id': [0],
+                                           'shape': list(reproject.transform_shapes(pd.Series([area]), CRS_SOURCE, CRS_DESTINATION))}),
+            'df_roads': df_roads,
+            'df_rivers': df_rivers,
+            'roofs': pd.Series(shapely.points(lon, lat)),
+            'fb': pd.Series(fb_shapes),
+            'df_fb_values': pd.DataFrame({'population': rng.gamma(2, 2, len(fb_pos))}),
+            'meters': meters}
+    
+    return(data)
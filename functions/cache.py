@@ -0,0 +1,284 @@
+import hashlib
+import inspect
+import json
+import os
+import pickle
+
+import functions.profiling as profiling
+
+## shapefile parts that change the content of a shapefile
+SHAPEFILE_PARTS = ['.shp', '.shx', '.dbf', '.prj', '.cpg']
+
+## file hashes already computed in this session, keyed by (path, size, modified time)
+_file_hashes = {}
+
+
+def shapefile_parts(file_name):
+    '''
+    purpose
+    # the files that make up an input (all parts for a shapefile, otherwise the file itself)
+    
+    inputs
+    # file_name: the path of a file, or of a shapefile with or without the .shp extension
+    
+    outputs
+    # paths: a list of existing paths
+    '''
+    
+    base, extension = os.path.splitext(file_name)
+    
+    if extension.lower() in SHAPEFILE_PARTS + ['']:
+        paths = [base + x for x in SHAPEFILE_PARTS if os.path.exists(base + x)]
+    
+        if len(paths) > 0:
+            return(paths)
+    
+    return([file_name])
+
+def hash_file(path, block_size = 1 << 20):
+    '''
+    purpose
+    # the sha256 hash of the content of a file (cached while the file is unchanged)
+    
+    inputs
+    # path: the path of the file
+    # block_size: the number of bytes read at a time
+    
+    outputs
+    # digest: the hash as a hex string
+    '''
+    
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    
+    if key not in _file_hashes:
+        digest = hashlib.sha256()
+    
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                digest.update(block)
+    
+        _file_hashes[key] = digest.hexdigest()
+    
+    return(_file_hashes[key])
+
+def hash_function(function):
+    '''
+    purpose
+    # a hash of the code of a stage: the qualified name and source of the function, and the source files of the
+    # modules it calls into (e.g. functions/clean_data.py for lambda: clean_data.create_grids_box(...)) and of the
+    # modules they import, so that switching the engine of a stage, or editing the engine, gives the stage a new key
+    
+    inputs
+    # function: the function that runs the stage
+    
+    outputs
+    # digest: the hash as a hex string
+    
+    notes
+    # only modules in the folder of the function (or below it) are hashed, not installed packages
+    '''
+    
+    digest = hashlib.sha256()
+    digest.update((function.__module__ + '.' + function.__qualname__).encode())
+    
+    try:
+        digest.update(inspect.getsource(function).encode())
+    except (OSError, TypeError):
+        digest.update(function.__code__.co_code)
+    
+    ## the modules of the names the function uses (e.g. clean_data in clean_data.create_grids_box), and the modules they import
+    folder = os.path.dirname(os.path.abspath(inspect.getfile(function)))
+    modules = [inspect.getmodule(function.__globals__.get(x)) for x in function.__code__.co_names]
+    paths = set()
+    
+    while len(modules) > 0:
+        module = modules.pop()
+        path = getattr(module, '__file__', None)
+    
+        if (path is None) or (os.path.abspath(path).startswith(folder + os.sep) == False) or (os.path.abspath(path) in paths):
+            continue
+    
+        paths.add(os.path.abspath(path))
+        modules += [inspect.getmodule(x) for x in vars(module).values() 
+                    if inspect.ismodule(x) or inspect.isfunction(x) or inspect.isclass(x)]
+    
+    for path in sorted(paths):
+        digest.update(hash_file(path).encode())
+    
+    return(digest.hexdigest())
+
+def hash_inputs(stage, files = [], params = {}, parents = [], code = None):
+    '''
+    purpose
+    # the key of a stage: a hash of the stage name, the content of its input files, its parameters, the keys of earlier stages
+    # and the code that runs it
+    
+    inputs
+    # stage: the name of the stage, e.g. 'create_grids'
+    # files: a list of input files (shapefiles include all of their parts)
+    # params: a dictionary of parameters, e.g. {'meters': 500}
+    # parents: a list of keys of the stages this stage depends on
+    # code: optional hash of the code of the stage (see hash_function)
+    
+    outputs
+    # key: the hash as a hex string
+    '''
+    
+    digest = hashlib.sha256()
+    digest.update(stage.encode())
+    
+    for file_name in files:
+        for path in shapefile_parts(file_name):
+            digest.update(os.path.basename(path).encode())
+            digest.update(hash_file(path).encode())
+    
+    digest.update(json.dumps(params, sort_keys = True, default = str).encode())
+    
+    for parent in parents:
+        digest.update(parent.encode())
+    
+    if code is not None:
+        digest.update(code.encode())
+    
+    return(digest.hexdigest())
+
+
+class StageCache:
+    '''
+    purpose
+    # store the output of pipeline stages on local disk, keyed by a hash of their inputs,
+    # and remove the least recently used outputs when the cache is larger than max_bytes
+    
+    inputs
+    # directory: the folder to store the outputs in
+    # max_bytes: the maximum size of the cache in bytes
+    # profiler: optional profiling.Profiler that measures every stage run through the cache (cache hits included)
+    
+    outputs
+    # a StageCache
+    '''
+    
+    def __init__(self, directory = 'cache', max_bytes = 5 * 1024 ** 3, profiler = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.profiler = profiler
+    
+        os.makedirs(directory, exist_ok = True)
+    
+    def path(self, key):
+        return(os.path.join(self.directory, key + '.pkl'))
+    
+    def get(self, key):
+        '''
+        purpose
+        # read the output of a stage from the cache
+    
+        inputs
+        # key: the key of the stage (see hash_inputs)
+    
+        outputs
+        # hit: whether the output was in the cache
+        # value: the output (None if not in the cache)
+        '''
+    
+        if os.path.exists(self.path(key)) == False:
+            return(False, None)
+    
+        with open(self.path(key), 'rb') as f:
+            value = pickle.load(f)
+    
+        ## mark as recently used
+        os.utime(self.path(key))
+    
+        return(True, value)
+    
+    def put(self, key, value):
+        '''
+        purpose
+        # write the output of a stage to the cache, and evict old outputs if the cache is too large
+    
+        inputs
+        # key: the key of the stage (see hash_inputs)
+        # value: the output of the stage
+    
+        outputs - none
+        '''
+    
+        ## write to a temporary file first so that a failed write never leaves a broken output
+        temp_path = self.path(key) + '.tmp'
+    
+        with open(temp_path, 'wb') as f:
+            pickle.dump(value, f, protocol = pickle.HIGHEST_PROTOCOL)
+    
+        os.replace(temp_path, self.path(key))
+    
+        self.evict(keep = key)
+    
+    def evict(self, keep = None):
+        '''
+        purpose
+        # remove the least recently used outputs until the cache is smaller than max_bytes
+    
+        inputs
+        # keep: a key that should not be removed (e.g. the output that was just written)
+    
+        outputs - none
+        '''
+    
+        entries = [os.path.join(self.directory, x) for x in os.listdir(self.directory) if x.endswith('.pkl')]
+        entries = sorted([(os.stat(x).st_mtime, os.stat(x).st_size, x) for x in entries])
+    
+        total_bytes = sum([x[1] for x in entries])
+    
+        for modified, size, path in entries:
+            if total_bytes <= self.max_bytes:
+                break
+    
+            if (keep is not None) and (path == self.path(keep)):
+                continue
+    
+            os.remove(path)
+            total_bytes -= size
+    
+    def run(self, stage, function, files = [], params = {}, parents = [], rows_in = None):
+        '''
+        purpose
+        # return the cached output of a stage, or run the stage and cache its output
+    
+        inputs
+        # stage: the name of the stage, e.g. 'create_grids'
+        # function: a function without inputs that runs the stage, e.g. lambda: clean_data.create_grids(...)
+        # files: a list of input files of the stage
+        # params: a dictionary of parameters of the stage
+        # parents: a list of keys of the stages this stage depends on
+        # rows_in: the number of rows going into the stage (for the profiler)
+        ## the code of function is part of the key (see hash_function), so a changed engine is run again
+    
+        outputs
+        # value: the output of the stage
+        # key: the key of the stage, to use as a parent of later stages
+        '''
+    
+        key = hash_inputs(stage = stage, files = files, params = params, parents = parents, code = hash_function(function))
+    
+        if self.profiler is None:
+            return(self._run(key, function), key)
+    
+        with self.profiler.stage(stage, rows_in = rows_in) as record:
+            value = self._run(key, function, record)
+            record['rows_out'] = profiling.count_rows(value)
+    
+        return(value, key)
+    
+    def _run(self, key, function, record = None):
+        hit, value = self.get(key)
+    
+        if hit == False:
+            value = function()
+            self.put(key, value)
+    
+        if record is not None:
+            record['cached'] = hit
+    
+        return(value)
@@ -1,8 +1,15 @@
 import pandas as pd
 import numpy as np
+import shapely
+from shapely import STRtree
 from shapely.geometry import shape, MultiLineString
 from shapely.ops import polygonize
 import shapefile
+from concurrent.futures import ThreadPoolExecutor
+
+import functions.load_data as load_data
+import functions.points as points
+import functions.profiling as profiling
 
 
 def create_shape_df_shp(shapefiles):
@@ -41,14 +48,146 @@ def create_grids(shape, meters):
     
     x_grids = np.arange(shape.bounds[0] - meters, shape.bounds[2] + meters, meters)
     y_grids = np.arange(shape.bounds[1] - meters, shape.bounds[3] + meters, meters)
-
+    
     x_lines = [((x1, yi), (x2, yi)) for x1, x2 in zip(x_grids[:-1], x_grids[1:]) for yi in y_grids]
     y_lines = [((xi, y1), (xi, y2)) for y1, y2 in zip(y_grids[:-1], y_grids[1:]) for xi in x_grids]
     
     grids = list(polygonize(MultiLineString(x_lines + y_lines)))
-
+    profiling.count('polygonize')
+    
     return(pd.DataFrame.from_dict({'shape': grids}))
     
+def grid_lines(shape, meters, origin = None):
+    '''
+    purpose
+    # the x and y coordinates of the grid lines that cover a shape
+    
+    inputs
+    # shape: the shape that forms the exterior of grids
+    # meters: the width and heigh of each grid
+    # origin: the lower left corner of the grids, defaults to the same corner as create_grids (see grid_origin)
+    
+    outputs
+    # x_grids: an array with the x coordinates of the vertical grid lines
+    # y_grids: an array with the y coordinates of the horizontal grid lines
+    '''
+    
+    if origin is None:
+        origin = grid_origin(shape, meters)
+    
+    x_grids = np.arange(origin[0], shape.bounds[2] + meters, meters)
+    y_grids = np.arange(origin[1], shape.bounds[3] + meters, meters)
+    
+    return(x_grids, y_grids)
+
+def iter_grids_box(shape, meters, origin = None, clip = False, chunk_cells = 1000000, 
+                   rows = None, cols = None):
+    '''
+    purpose
+    # create grids within a shape directly as boxes (vectorized), one band of grid rows at a time
+    
+    inputs
+    # shape: the shape that forms the exterior of grids
+    # meters: the width and heigh of each grid
+    # origin: the lower left corner of the grids, defaults to the same corner as create_grids (see grid_origin)
+    # clip: whether to only keep grids that intersect the shape
+    # chunk_cells: the approximate number of grids built at a time, which limits memory use
+    # rows: optional (start, stop) range of grid rows to build, defaults to all rows
+    # cols: optional (start, stop) range of grid columns to build, defaults to all columns
+    
+    outputs
+    # a generator of dataframes with the grids (shape) and the row and column of each grid
+    '''
+    
+    x_grids, y_grids = grid_lines(shape = shape, meters = meters, origin = origin)
+    
+    n_rows = max(len(y_grids) - 1, 0)
+    n_cols = max(len(x_grids) - 1, 0)
+    
+    row_start, row_stop = (0, n_rows) if rows is None else (max(rows[0], 0), min(rows[1], n_rows))
+    col_start, col_stop = (0, n_cols) if cols is None else (max(cols[0], 0), min(cols[1], n_cols))
+    
+    chunk_rows = max(1, chunk_cells // max(col_stop - col_start, 1))
+    
+    ## prepare the shape once for the clip tests
+    if clip == True:
+        shapely.prepare(shape)
+    
+    ## build the grids one band of rows at a time
+    for band_start in range(row_start, row_stop, chunk_rows):
+        row, col = np.meshgrid(np.arange(band_start, min(band_start + chunk_rows, row_stop)), 
+                               np.arange(col_start, col_stop), indexing = 'ij')
+        row = row.ravel()
+        col = col.ravel()
+        
+        grids = shapely.box(x_grids[col], y_grids[row], x_grids[col + 1], y_grids[row + 1])
+        
+        if clip == True:
+            keep = shapely.intersects(shape, grids)
+            grids, row, col = grids[keep], row[keep], col[keep]
+        
+        yield pd.DataFrame({'shape': grids, 'row': row, 'col': col})
+
+def create_grids_box(shape, meters, origin = None, clip = False, chunk_cells = 1000000, 
+                     rows = None, cols = None):
+    '''
+    purpose
+    # create grids within a shape directly as boxes (vectorized), instead of polygonizing a mesh of lines
+    
+    inputs
+    # shape: the shape that forms the exterior of grids
+    # meters: the width and heigh of each grid
+    # origin: the lower left corner of the grids, defaults to the same corner as create_grids (see grid_origin)
+    # clip: whether to only keep grids that intersect the shape
+    # chunk_cells: the approximate number of grids built at a time (see iter_grids_box)
+    # rows: optional (start, stop) range of grid rows to build, defaults to all rows
+    # cols: optional (start, stop) range of grid columns to build, defaults to all columns
+    
+    outputs
+    # df_grids: a dataframe with the grids (shape) and the row and column of each grid
+    '''
+    
+    grid_chunks = list(iter_grids_box(shape = shape, meters = meters, origin = origin, 
+                                      clip = clip, chunk_cells = chunk_cells, 
+                                      rows = rows, cols = cols))
+    
+    if len(grid_chunks) == 0:
+        return(pd.DataFrame({'shape': [], 'row': [], 'col': []}))
+    
+    return(pd.concat(grid_chunks, ignore_index = True))
+    
+def explode_multipart(shapes, types = [4, 5, 6, 7]):
+    '''
+    purpose
+    # split multipart shapes into their parts for all shapes at once, keeping the position of the shape each part came from
+    # so that attributes can be carried over by repeating rows (e.g. df.iloc[source_pos]) instead of a merge
+    
+    inputs
+    # shapes: a series or array of shapes
+    # types: the shapely type ids that are split (4 MultiPoint, 5 MultiLineString, 6 MultiPolygon, 7 GeometryCollection),
+    ## all other shapes are kept as they are
+    
+    outputs
+    # parts: an array with the parts of the split shapes and the other shapes, in the order of shapes
+    # source_pos: an array with the position in shapes of each part
+    '''
+    
+    shapes = np.asarray(shapes, dtype = object)
+    multi = np.isin(shapely.get_type_id(shapes), types)
+    
+    ## the number of parts of each shape (empty multipart shapes have no parts and are dropped)
+    n_parts = np.where(multi, shapely.get_num_geometries(shapes), 1)
+    source_pos = np.repeat(np.arange(len(shapes)), n_parts)
+    
+    ## the parts come out in the order of their shape, so they fill the rows of the multipart shapes in order
+    part_multi = np.repeat(multi, n_parts)
+    
+    parts = np.empty(len(source_pos), dtype = object)
+    parts[~part_multi] = shapes[~multi]
+    parts[part_multi] = shapely.get_parts(shapes[multi])
+    
+    return(parts, source_pos)
+
 def split_grids_polygon(grids, boundaries):
     '''
     purpose
@@ -61,27 +200,96 @@ def split_grids_polygon(grids, boundaries):
     outputs
     # pd.DataFrame(grid_list): a dataframe containing the new list of grids
     '''
-    grid_list = []
+    index_list, shape_list, bd_list = [], [], []
     
-    for index, grid in grids.iteritems():    
-        for bd_index, bd_shape in boundaries.iteritems():
+    for index, grid in profiling.progress(grids.items(), total = len(grids), label = 'split_grids_polygon'):    
+        for bd_index, bd_shape in boundaries.items():
+            
+            # if the grid intersects the EA then keep the part inside the EA
+            profiling.count('intersects')
             
-            # if the grid intersects the EA then split into 2 and add both to the list
             if grid.intersects(bd_shape) == True:                
                 grid_inside = grid.intersection(bd_shape) # inside grid
+                profiling.count('intersection')
                 
-                if grid_inside.geom_type == 'Polygon':
-                    grid_list.append({'index': index,
-                                      'shape': grid_inside,
-                                      'bd_index': bd_index})
-                
-                if grid_inside.geom_type == 'MultiPolygon':
-                    for ele in [x for x in list(grid_inside)]:
-                        grid_list.append({'index': index,
-                                          'shape': ele,
-                                          'bd_index': bd_index})
+                if grid_inside.geom_type in ['Polygon', 'MultiPolygon']:
+                    index_list.append(index)
+                    shape_list.append(grid_inside)
+                    bd_list.append(bd_index)
+    
+    # split the MultiPolygons into Polygons in one go
+    return(_explode_pairs(index_list, shape_list, bd_list))
+
+def _explode_pairs(index_list, shape_list, bd_list):
+    '''
+    purpose
+    # the output of split_grids_polygon / split_grids_line from the lists of kept (grid, boundary) pairs,
+    # with the MultiPolygons split into Polygons and the grid and boundary indexes repeated for each part
     
-    return(pd.DataFrame(grid_list))
+    inputs
+    # index_list: the index of the grid of each pair
+    # shape_list: the Polygon or MultiPolygon of each pair
+    # bd_list: the boundary index of each pair
+    
+    outputs
+    # grid_df: a dataframe with index, shape and bd_index columns, one row per Polygon
+    '''
+    
+    parts, source_pos = explode_multipart(pd.Series(shape_list, dtype = object).values, types = [6])
+    
+    grid_df = pd.DataFrame({'index': pd.Series(index_list, dtype = object).values[source_pos],
+                            'shape': parts,
+                            'bd_index': pd.Series(bd_list, dtype = object).values[source_pos]})
+    
+    return(grid_df.infer_objects())
+
+def split_grids_polygon_index(grids, boundaries):
+    '''
+    purpose
+    # allocate grids to specific boundaries and only keep portion within a boundary, using a spatial index
+    # grids fully inside a boundary are kept as they are, grids outside all boundaries are skipped, 
+    # and only the grids crossing a boundary are intersected
+    
+    inputs
+    # grids: a column of grids from a dataframe
+    # boundaries: a column of boundaries from a dataframe
+    
+    outputs
+    # grid_df: a dataframe containing the new list of grids (same format as split_grids_polygon)
+    '''
+    
+    grid_array = np.asarray(grids.values)
+    bd_array = np.asarray(boundaries.values)
+    
+    ## candidate (boundary, grid) pairs from the grid bounding boxes
+    tree = STRtree(grid_array)
+    bd_pos, grid_pos = tree.query(bd_array, predicate = 'intersects')
+    profiling.count('strtree_query', len(bd_array))
+    profiling.count('strtree_pairs', len(bd_pos))
+    
+    ## keep the order of split_grids_polygon (grids, then boundaries)
+    order = np.lexsort((bd_pos, grid_pos))
+    bd_pos, grid_pos = bd_pos[order], grid_pos[order]
+    
+    ## grids fully inside a boundary are copied, the rest are intersected with the boundary
+    shapely.prepare(bd_array)
+    inside = shapely.contains(bd_array[bd_pos], grid_array[grid_pos])
+    
+    grid_inside = grid_array[grid_pos].copy()
+    grid_inside[~inside] = shapely.intersection(grid_array[grid_pos[~inside]], bd_array[bd_pos[~inside]])
+    profiling.count('contains', len(bd_pos))
+    profiling.count('intersection', (~inside).sum())
+    
+    ## only keep Polygons and MultiPolygons, and split MultiPolygons into Polygons
+    polygon = np.isin(shapely.get_type_id(grid_inside), [3, 6])
+    parts, part_pos = explode_multipart(grid_inside[polygon], types = [6])
+    pair_pos = np.flatnonzero(polygon)[part_pos]
+    
+    grid_df = pd.DataFrame({'index': np.asarray(grids.index)[grid_pos[pair_pos]],
+                            'shape': parts,
+                            'bd_index': np.asarray(boundaries.index)[bd_pos[pair_pos]]})
+    
+    return(grid_df)
 
 def split_grids_line(grids, shape_name, index_name, boundaries):
     '''
@@ -98,19 +306,179 @@ def split_grids_line(grids, shape_name, index_name, boundaries):
     pd.DataFrame(grid_list): a dataframe with the split grids and indexes
     '''
     
-    grid_list = []
+    index_list, shape_list, bd_list = [], [], []
     
-    for index, grid in grids.iterrows():    
-        for bd_index, bd_shape in boundaries.iteritems():
+    for index, grid in profiling.progress(grids.iterrows(), total = len(grids), label = 'split_grids_line'):    
+        for bd_index, bd_shape in boundaries.items():
             grid_outside = grid[shape_name].difference(bd_shape.buffer(1e-6))
+            profiling.count('buffer')
+            profiling.count('difference')
+            profiling.count('intersects')
             
             if (grid[shape_name].intersects(bd_shape) == True) & (grid_outside.geom_type == 'MultiPolygon'):
-                for ele in [x for x in list(grid_outside)]:
-                        grid_list.append({'index': grid['index'],
-                                          'shape': ele,
-                                          'bd_index': grid[index_name]}) 
+                index_list.append(grid['index'])
+                shape_list.append(grid_outside)
+                bd_list.append(grid[index_name])
+    
+    # split the MultiPolygons into Polygons in one go
+    return(_explode_pairs(index_list, shape_list, bd_list))
+    
+
+def _split_by_lines(grid_array, line_array, tolerance = 1e-6):
+    '''
+    purpose
+    # split each grid by all lines crossing it in one difference
+    
+    inputs
+    # grid_array: an array of grids/EAs
+    # line_array: an array of lines used to split the grids/EAs
+    # tolerance: the width of the buffer around each line (in the units of the CRS)
+    
+    outputs
+    # piece_pos: the position in grid_array of each piece
+    # pieces: an array of the pieces of all grids that were split into more than one part
+    # grid_pos, line_pos: the positions of all (grid, line) pairs that intersect
+    '''
+    
+    ## candidate (grid, line) pairs from a spatial index of the lines
+    tree = STRtree(line_array)
+    grid_pos, line_pos = tree.query(grid_array, predicate = 'intersects')
+    profiling.count('strtree_query', len(grid_array))
+    profiling.count('strtree_pairs', len(grid_pos))
+    
+    order = np.lexsort((line_pos, grid_pos))
+    grid_pos, line_pos = grid_pos[order], line_pos[order]
+    
+    if len(grid_pos) == 0:
+        return(grid_pos, np.empty(0, dtype = object), grid_pos, line_pos)
+    
+    ## buffer each line that crosses a grid once
+    line_buffer = np.empty(len(line_array), dtype = object)
+    line_used = np.unique(line_pos)
+    line_buffer[line_used] = shapely.buffer(line_array[line_used], tolerance)
+    profiling.count('buffer', len(line_used))
+    
+    ## clip the buffered lines to each grid, so that only the local part of long lines is unioned
+    grid_bounds = shapely.bounds(grid_array[grid_pos])
+    line_clip = np.array([shapely.clip_by_rect(line_buffer[line], *bounds) 
+                          for line, bounds in zip(line_pos, grid_bounds)], dtype = object)
+    profiling.count('clip_by_rect', len(line_pos))
+    
+    ## union of the buffered lines crossing each grid
+    split_grids, starts = np.unique(grid_pos, return_index = True)
+    cutters = np.empty(len(split_grids), dtype = object)
     
-    return(pd.DataFrame(grid_list))
+    for i, group in enumerate(np.split(line_clip, starts[1:])):
+        cutters[i] = group[0] if len(group) == 1 else shapely.union_all(group)
+    
+    profiling.count('union', (np.diff(np.r_[starts, len(line_clip)]) > 1).sum())
+    
+    ## remove the lines from the grids and keep the grids that were split into more than one part
+    grid_outside = shapely.difference(grid_array[split_grids], cutters)
+    profiling.count('difference', len(split_grids))
+    multi = shapely.get_type_id(grid_outside) == 6
+    
+    pieces, part_pos = explode_multipart(grid_outside[multi], types = [6])
+    piece_pos = split_grids[multi][part_pos]
+    
+    return(piece_pos, pieces, grid_pos, line_pos)
+
+def split_grids_line_index(grids, shape_name, index_name, boundaries, tolerance = 1e-6):
+    '''
+    purpose
+    # split grids that intersect any line, using a spatial index and one difference per grid
+    
+    inputs
+    # grids: a dataframe that contains grids/EAs
+    # shape_name: the column name for the grids/EAs within the dataframe
+    # index_name: the column name for the primary index of the grids/EAs within the dataframe
+    # boundaries: a series with all lines that you want to use to split the grids/EAs
+    # tolerance: the width of the buffer around each line (in the units of the CRS)
+    
+    outputs
+    # grid_df: a dataframe with the split grids and indexes (same format as split_grids_line)
+    '''
+    
+    piece_pos, pieces, grid_pos, line_pos = _split_by_lines(
+            grid_array = np.asarray(grids[shape_name].values), 
+            line_array = np.asarray(boundaries.values), tolerance = tolerance)
+    
+    grid_df = pd.DataFrame({'index': grids['index'].values[piece_pos],
+                            'shape': pieces,
+                            'bd_index': grids[index_name].values[piece_pos]})
+    
+    return(grid_df)
+    
+
+def split_grids_lines(grids, shape_name, index_name, boundary_layers, tolerance = 1e-6):
+    '''
+    purpose
+    # split grids by several layers of lines (e.g. roads and rivers) in one pass, and merge with the grids that were not split
+    
+    inputs
+    # grids: a dataframe that contains grids/EAs
+    # shape_name: the column name for the grids/EAs within the dataframe
+    # index_name: the column name for the primary index of the grids/EAs within the dataframe
+    # boundary_layers: a dictionary with the layer name as key and a series of lines as value
+    # tolerance: the width of the buffer around each line (in the units of the CRS)
+    
+    outputs
+    # grid_df: a dataframe with all grids/EAs, where
+    ## index: the row position of each grid/EA
+    ## bd_index: the index_name of the grid that each grid/EA comes from
+    ## bd_layers: the names of the layers whose lines border the grid/EA and split it from another piece of its grid, 
+    ## separated by commas (empty if not split)
+    
+    notes
+    # a line borders a piece if it is within twice the tolerance of the piece, so a line that ends inside a grid 
+    ## without splitting it (e.g. a dead-end road) borders only one piece and is not listed
+    '''
+    
+    grid_array = np.asarray(grids[shape_name].values)
+    
+    ## all lines in one array, with the name of the layer of each line
+    layer_names = list(boundary_layers.keys())
+    line_array = np.concatenate([np.asarray(boundary_layers[x].values) for x in layer_names] + [np.empty(0, dtype = object)])
+    line_layer = np.repeat(np.arange(len(layer_names)), [len(boundary_layers[x]) for x in layer_names])
+    
+    piece_pos, pieces, grid_pos, line_pos = _split_by_lines(
+            grid_array = grid_array, line_array = line_array, tolerance = tolerance)
+    
+    ## lines that border each piece - the (piece, line) pairs of the lines crossing the grid of the piece
+    bordering = pd.DataFrame({'grid': grid_pos, 'line': line_pos}).merge(
+            pd.DataFrame({'grid': piece_pos, 'piece': np.arange(len(piece_pos))}), on = 'grid')
+    bordering = bordering[shapely.dwithin(pieces[bordering['piece'].values], line_array[bordering['line'].values], 
+                                          2 * tolerance)]
+    
+    ## a line splits the pieces it borders if it borders more than one piece of the grid
+    bordering = bordering[bordering.groupby(['grid', 'line'])['piece'].transform('size').values > 1]
+    
+    ## layers that split each piece
+    crossing = pd.DataFrame({'piece': bordering['piece'].values, 
+                             'layer': line_layer[bordering['line'].values]}).drop_duplicates()
+    crossing = crossing.sort_values(['piece', 'layer'])
+    crossing['layer'] = np.array(layer_names + [''], dtype = object)[crossing['layer'].values]
+    piece_layers = crossing.groupby('piece')['layer'].agg(','.join).reindex(np.arange(len(piece_pos)), fill_value = '')
+    
+    ## split pieces replace their grid, all other grids are kept as they are
+    split = np.zeros(len(grid_array), dtype = bool)
+    split[piece_pos] = True
+    keep_pos = np.flatnonzero(~split)
+    
+    source_pos = np.concatenate([keep_pos, piece_pos])
+    shapes = np.concatenate([grid_array[keep_pos], pieces])
+    layers = np.concatenate([np.full(len(keep_pos), '', dtype = object), piece_layers.values.astype(object)])
+    
+    order = np.argsort(source_pos, kind = 'stable')
+    source_pos, shapes, layers = source_pos[order], shapes[order], layers[order]
+    
+    grid_df = grids.iloc[source_pos].reset_index(drop = True)
+    grid_df[shape_name] = shapes
+    grid_df['bd_index'] = grids[index_name].values[source_pos]
+    grid_df['bd_layers'] = layers
+    grid_df['index'] = np.array(range(0, grid_df.shape[0])) # index with row position
+    
+    return(grid_df)
     
 
 def split_multiline(df, shape_name):
@@ -126,20 +494,11 @@ def split_multiline(df, shape_name):
     line_df_final: a dataframe with all shapes (including split multilines and shapes that were not originally multilines)
     '''
     
-    line_list = []
+    ## split the multilines for all rows at once, and repeat the attributes of each row for its lines
+    parts, source_pos = explode_multipart(df[shape_name].values, types = [5])
     
-    for index, row in df.iterrows():
-        if row[shape_name].geom_type == 'MultiLineString':
-            for ele in [x for x in list(row[shape_name])]:
-                        line_list.append({'index': index,
-                                          'shape': ele})
-        else:
-            line_list.append({'index': index,
-                              'shape': row[shape_name]})
-    
-    line_df = pd.DataFrame.from_dict(line_list)
-    line_df_final = line_df.merge(df.drop(shape_name, axis = 1), 
-                                  right_index = True, left_on = 'index')
+    line_df = pd.DataFrame({'index': np.asarray(df.index)[source_pos], 'shape': parts})
+    line_df_final = pd.concat([line_df, df.drop(shape_name, axis = 1).iloc[source_pos].reset_index(drop = True)], axis = 1)
     
     return(line_df_final)
     
@@ -152,7 +511,7 @@ def count_within_grid(grid_shapes, check_shapes,
     
     inputs
     # grid_shapes: a series of grids, formatted as Polygons
-    # df_check: a series of Polygons or Points, the function checks whether these fall within the grid_shapes
+    # df_check: a series of Polygons or Points (or a points.PointStore), the function checks whether these fall within the grid_shapes
     # append_names: suffix for all dataframe column names
     # check_shape: whether the check object is a Polygon (if false then assumed ot be a Point) 
     
@@ -160,12 +519,16 @@ def count_within_grid(grid_shapes, check_shapes,
     # intersect_df: a dataframe listing whether any check_shapes falls within each grid
     '''
     
+    ## a PointStore is converted to a series of Points
+    if isinstance(check_shapes, points.PointStore):
+        check_shapes = check_shapes.to_series()
+    
     ## list to store all results
     intersect_list = []
     others_list = []
     
     ## loop through shapes of grid
-    for index_grid, grid in grid_shapes.iteritems():
+    for index_grid, grid in profiling.progress(grid_shapes.items(), total = len(grid_shapes), label = 'count_within_grid'):
                 
         ## reset object so that loop works properly
         intersect = False
@@ -178,6 +541,7 @@ def count_within_grid(grid_shapes, check_shapes,
         ### distance from representative - separate for Polygon vs. Point
         x_check_dist = check_shapes.apply(lambda x: abs(x.representative_point().x - x_grid))
         y_check_dist = check_shapes.apply(lambda x: abs(x.representative_point().y - y_grid))
+        profiling.count('representative_point', 2 * len(check_shapes) + 2)
                 
         ### sort the dataframe
         xy_check_dist = x_check_dist + y_check_dist
@@ -191,7 +555,7 @@ def count_within_grid(grid_shapes, check_shapes,
         loop_others = []
         
         ## loop through all shapes/points of check
-        for index_check, check in check_shapes_sorted.iteritems():
+        for index_check, check in check_shapes_sorted.items():
             
             ## if a shape then
             if check_shape == True:
@@ -213,6 +577,7 @@ def count_within_grid(grid_shapes, check_shapes,
             
             ### end loop and add to dictionary
             if (index_check == xy_check_sorted[-1]) or (loop_outside_count == limit_check):  
+                profiling.count('intersects' if check_shape == True else 'within', loop_inside_count + loop_outside_count)
                 
                 ### add up all elements of each list
                 if (len(loop_others) == 0) & (check_others.shape[0] != 0):
@@ -269,6 +634,336 @@ def count_within_grid(grid_shapes, check_shapes,
     return(intersect_df_final)
     
 
+def _check_values(check_shapes):
+    '''
+    purpose
+    # the check shapes as an array, and their index
+    
+    inputs
+    # check_shapes: a series of Polygons or Points, or a points.PointStore
+    
+    outputs
+    # check_array: an array of shapely shapes
+    # check_index: the index of the check shapes (row positions for a PointStore)
+    '''
+    
+    if isinstance(check_shapes, points.PointStore):
+        return(check_shapes.shapes(), pd.RangeIndex(len(check_shapes)))
+    
+    return(np.asarray(check_shapes.values), check_shapes.index)
+
+def _intersect_frame(grid_index, counts, n_check, append_names,
+                     limit_check = 100, others = None):
+    '''
+    purpose
+    # build the intersect_count / intersect_no_count / intersect columns from per grid counts
+    
+    inputs
+    # grid_index: the index of the grids, in the same order as counts
+    # counts: an array with the number of check shapes within each grid
+    # n_check: the total number of check shapes
+    # append_names: suffix for all dataframe column names
+    # limit_check: the cap for the number of check shapes outside each grid (as in count_within_grid)
+    # others: optional dataframe with summed attributes for each grid, in the same order as counts
+    
+    outputs
+    # intersect_df: a dataframe in the same format as the output of count_within_grid
+    '''
+    
+    counts = np.asarray(counts)
+    
+    intersect_df = pd.DataFrame({'intersect_count': counts,
+                                 'intersect_no_count': np.minimum(limit_check, n_check - counts),
+                                 'intersect': counts > 0})
+    
+    ## add the summed attributes as extra columns
+    if others is not None:
+        intersect_df = pd.concat([intersect_df, others.reset_index(drop = True)], axis = 1)
+    
+    ## append the column names
+    intersect_df = intersect_df.add_suffix(append_names)
+    intersect_df['index'] = np.asarray(grid_index)
+    
+    return(intersect_df)
+
+def _sum_pairs(grid_array, check_array, grid_pos, check_pos, values, 
+               check_shape = True, apportion = False):
+    '''
+    purpose
+    # sum attributes of the check shapes within each grid, from the (grid, check shape) pairs of a spatial index query
+    
+    inputs
+    # grid_array: an array of grids
+    # check_array: an array of check shapes
+    # grid_pos, check_pos: the positions of each pair in grid_array and check_array
+    # values: a dataframe of numeric attributes, one row per check shape (in the order of check_array)
+    # check_shape: whether the check object is a Polygon (if false then assumed to be a Point)
+    # apportion: whether to split Polygons between grids by the share of their area in each grid
+    
+    outputs
+    # sums: a dataframe with the summed attributes, one row per grid (in the order of grid_array)
+    '''
+    
+    ## the share of each check shape in each grid
+    weights = np.ones(len(grid_pos))
+    
+    if (apportion == True) and (check_shape == True):
+        overlap = shapely.area(shapely.intersection(grid_array[grid_pos], check_array[check_pos]))
+        profiling.count('intersection', len(grid_pos))
+        area = shapely.area(check_array[check_pos])
+    
+        weights = np.divide(overlap, area, out = np.ones(len(grid_pos)), where = area > 0)
+    
+    ## one weighted sum per attribute over all pairs
+    sums = pd.DataFrame(index = range(len(grid_array)))
+    
+    for column in values.columns:
+        column_values = np.nan_to_num(values[column].values[check_pos].astype(np.float64))
+        column_sums = np.bincount(grid_pos, weights = column_values * weights, minlength = len(grid_array))
+    
+        ### keep whole numbers as integers when nothing is apportioned
+        if (np.issubdtype(values[column].dtype, np.integer)) and ((apportion == False) or (check_shape == False)):
+            column_sums = np.rint(column_sums).astype(values[column].dtype)
+    
+        sums[column] = column_sums
+    
+    return(sums)
+
+def aggregate_within_grid(grid_shapes, check_shapes, check_others, 
+                          check_shape = True, apportion = False):
+    '''
+    purpose
+    # sum numeric attributes of the check shapes (e.g. the FB population) within each grid, in one grouped reduction
+    # over all (grid, check shape) pairs instead of a loop over the check shapes of each grid
+    
+    inputs
+    # grid_shapes: a series of grids, formatted as Polygons
+    # check_shapes: a series of Polygons or Points (or a points.PointStore)
+    # check_others: a dataframe of attributes of the check shapes (same index, row positions for a PointStore),
+    ## only the numeric columns are summed
+    # check_shape: whether the check object is a Polygon (if false then assumed to be a Point)
+    # apportion: whether a Polygon that straddles several grids is split between them by the share of its area in each grid
+    ## (if false then its whole value is added to every grid it intersects, as in count_within_grid)
+    
+    outputs
+    # others_df: a dataframe with the summed attributes of each grid (same index as grid_shapes)
+    '''
+    
+    grid_array = np.asarray(grid_shapes.values)
+    check_array, check_index = _check_values(check_shapes)
+    
+    ## pairs of (grid, check) positions - intersects for Polygons, within for Points
+    tree = STRtree(check_array)
+    predicate = 'intersects' if check_shape == True else 'contains'
+    grid_pos, check_pos = tree.query(grid_array, predicate = predicate)
+    profiling.count('strtree_query', len(grid_array))
+    profiling.count('strtree_pairs', len(grid_pos))
+    
+    others_df = _sum_pairs(grid_array = grid_array, check_array = check_array, grid_pos = grid_pos, check_pos = check_pos,
+                           values = check_others.reindex(check_index).select_dtypes('number'),
+                           check_shape = check_shape, apportion = apportion)
+    
+    others_df.index = grid_shapes.index
+    
+    return(others_df)
+
+def count_within_grid_index(grid_shapes, check_shapes, 
+                            append_names, limit_check = 100, 
+                            check_shape = True, check_others = pd.DataFrame(), apportion = False):
+    '''
+    purpose
+    # count how many Points or Shapes are within a column of Shapes using a spatial index (STRtree)
+    # the check shapes are indexed once and every grid is queried in bulk, instead of sorting all check shapes for each grid
+    
+    inputs
+    # grid_shapes: a series of grids, formatted as Polygons
+    # check_shapes: a series of Polygons or Points (or a points.PointStore), the function checks whether these fall within the grid_shapes
+    # append_names: suffix for all dataframe column names
+    # limit_check: the cap for the intersect_no_count column (kept for consistency with count_within_grid)
+    # check_shape: whether the check object is a Polygon (if false then assumed to be a Point) 
+    # check_others: a dataframe of numeric attributes of the check shapes (same index), summed within each grid
+    # apportion: whether to split the attributes of Polygons that straddle several grids by area (see aggregate_within_grid)
+    
+    outputs
+    # intersect_df: a dataframe listing whether any check_shapes falls within each grid (same columns as count_within_grid)
+    
+    notes
+    # all check shapes within a grid are counted, while count_within_grid stops after limit_check misses
+    '''
+    
+    grid_array = np.asarray(grid_shapes.values)
+    check_array, check_index = _check_values(check_shapes)
+    
+    ## pairs of (grid, check) positions - intersects for Polygons, within for Points
+    tree = STRtree(check_array)
+    predicate = 'intersects' if check_shape == True else 'contains'
+    grid_pos, check_pos = tree.query(grid_array, predicate = predicate)
+    profiling.count('strtree_query', len(grid_array))
+    profiling.count('strtree_pairs', len(grid_pos))
+    
+    counts = np.bincount(grid_pos, minlength = len(grid_array))
+    
+    ## sum the other attributes within each grid
+    others = None
+    
+    if check_others.shape[0] != 0:
+        others = _sum_pairs(grid_array = grid_array, check_array = check_array, grid_pos = grid_pos, check_pos = check_pos,
+                            values = check_others.reindex(check_index).select_dtypes('number'),
+                            check_shape = check_shape, apportion = apportion)
+    
+    return(_intersect_frame(grid_index = grid_shapes.index, counts = counts, 
+                            n_check = len(check_array), append_names = append_names, 
+                            limit_check = limit_check, others = others))
+    
+
+def count_within_grid_chunks(grid_shapes, chunks, append_names, 
+                             limit_check = 100, check_shape = True):
+    '''
+    purpose
+    # count how many Points or Shapes are within a column of Shapes, reading the check shapes chunk by chunk
+    # the grids are indexed once, and only one chunk of check shapes is held in memory at a time
+    
+    inputs
+    # grid_shapes: a series of grids, formatted as Polygons
+    # chunks: an iterable of chunks of check shapes (see load_data.read_shp_chunks)
+    # append_names: suffix for all dataframe column names
+    # limit_check: the cap for the intersect_no_count column (kept for consistency with count_within_grid)
+    # check_shape: whether the check object is a Polygon (if false then assumed to be a Point) 
+    
+    outputs
+    # intersect_df: a dataframe listing whether any check_shapes falls within each grid (same columns as count_within_grid)
+    '''
+    
+    grid_array = np.asarray(grid_shapes.values)
+    tree = STRtree(grid_array)
+    predicate = 'intersects' if check_shape == True else 'within'
+    
+    counts = np.zeros(len(grid_array), dtype = np.int64)
+    n_check = 0
+    
+    ## add the counts of each chunk
+    for chunk in chunks:
+        check_array = load_data.chunk_shapes(chunk)
+        check_pos, grid_pos = tree.query(check_array, predicate = predicate)
+        profiling.count('strtree_query', len(check_array))
+        profiling.count('strtree_pairs', len(grid_pos))
+        
+        counts += np.bincount(grid_pos, minlength = len(grid_array))
+        n_check += len(check_array)
+    
+    return(_intersect_frame(grid_index = grid_shapes.index, counts = counts, 
+                            n_check = n_check, append_names = append_names, 
+                            limit_check = limit_check))
+
+def grid_origin(shape, meters):
+    '''
+    purpose
+    # the lower left corner of the grids made by create_grids
+    
+    inputs
+    # shape: the shape that forms the exterior of grids
+    # meters: the width and heigh of each grid
+    
+    outputs
+    # (x, y): the coordinates of the lower left corner of the first grid
+    '''
+    
+    return((shape.bounds[0] - meters, shape.bounds[1] - meters))
+
+def bin_points_grid(x, y, origin, meters):
+    '''
+    purpose
+    # find the row and column of the grid that each point falls in by floor division
+    
+    inputs
+    # x: an array of x coordinates in the CRS of the grids (meters)
+    # y: an array of y coordinates in the CRS of the grids (meters)
+    # origin: the lower left corner of the grids (see grid_origin)
+    # meters: the width and heigh of each grid
+    
+    outputs
+    # row: an array with the grid row of each point
+    # col: an array with the grid column of each point
+    '''
+    
+    col = np.floor((np.asarray(x) - origin[0]) / meters).astype(np.int64)
+    row = np.floor((np.asarray(y) - origin[1]) / meters).astype(np.int64)
+    
+    return(row, col)
+
+def count_within_grid_binned(grid_shapes, check_shapes, origin, meters, 
+                             append_names, limit_check = 100, tolerance = 1e-6):
+    '''
+    purpose
+    # count how many Points are within each grid by computing the owning grid of each point directly
+    # grids that were not cut by split_grids_polygon / split_grids_line are found by floor division, 
+    # only points that fall in cut grids are tested against the grid shapes
+    
+    inputs
+    # grid_shapes: a series of grids/EAs in the projected CRS (meters) used by create_grids
+    # check_shapes: a series of Points (or a points.PointStore) in the same CRS as grid_shapes
+    # origin: the lower left corner of the grids (see grid_origin)
+    # meters: the width and heigh of each grid
+    # append_names: suffix for all dataframe column names
+    # limit_check: the cap for the intersect_no_count column (kept for consistency with count_within_grid)
+    # tolerance: relative area tolerance used to decide whether a grid is still a full grid
+    
+    outputs
+    # intersect_df: a dataframe listing whether any check_shapes falls within each grid (same columns as count_within_grid)
+    
+    notes
+    # the fast path needs each full grid to be the only EA of its square - a square that holds several EAs
+    ## (e.g. a grid copied by overlapping study area boundaries) is tested exactly, like a cut grid
+    '''
+    
+    grid_array = np.asarray(grid_shapes.values)
+    
+    ## coordinates of the points, straight from the arrays of a PointStore
+    if isinstance(check_shapes, points.PointStore):
+        check_x, check_y = check_shapes.x, check_shapes.y
+    else:
+        check_x, check_y = shapely.get_x(check_shapes.values), shapely.get_y(check_shapes.values)
+    
+    ## owning grid of each EA, from a point inside the EA
+    grid_points = shapely.point_on_surface(grid_array)
+    grid_row, grid_col = bin_points_grid(x = shapely.get_x(grid_points), y = shapely.get_y(grid_points), 
+                                         origin = origin, meters = meters)
+    
+    n_cols = grid_col.max() + 1 if len(grid_array) > 0 else 1
+    grid_key = grid_row * n_cols + grid_col
+    
+    ## full grids (not trimmed or split) hold every point in their square, if no other EA shares the square
+    whole = (shapely.area(grid_array) >= meters ** 2 * (1 - tolerance)) & ~pd.Index(grid_key).duplicated(keep = False)
+    
+    ## owning grid of each point
+    point_row, point_col = bin_points_grid(x = check_x, y = check_y, origin = origin, meters = meters)
+    
+    on_grid = (point_row >= 0) & (point_col >= 0) & (point_col < n_cols)
+    point_key = np.where(on_grid, point_row * n_cols + point_col, -1)
+    
+    ## fast path - points in full grids
+    whole_pos = np.flatnonzero(whole)
+    whole_match = pd.Index(grid_key[whole_pos]).get_indexer(point_key)
+    
+    counts = np.bincount(whole_pos[whole_match[whole_match >= 0]], minlength = len(grid_array))
+    
+    ## fallback - exact tests for points in cut grids only
+    split_pos = np.flatnonzero(~whole)
+    split_points = (whole_match < 0) & np.isin(point_key, grid_key[split_pos])
+    
+    if (split_points.any() == True):
+        tree = STRtree(grid_array[split_pos])
+        point_index, split_index = tree.query(shapely.points(check_x[split_points], check_y[split_points]), 
+                                              predicate = 'within')
+        profiling.count('strtree_query', split_points.sum())
+        profiling.count('strtree_pairs', len(point_index))
+        counts += np.bincount(split_pos[split_index], minlength = len(grid_array))
+    
+    return(_intersect_frame(grid_index = grid_shapes.index, counts = counts, 
+                            n_check = len(check_x), append_names = append_names, 
+                            limit_check = limit_check))
+    
+
 def export_shapefile(df, shape_name, field_names, file_name):
     '''
     purpose
@@ -292,11 +987,143 @@ def export_shapefile(df, shape_name, field_names, file_name):
         w.field(x[0], x[1])
     
     # loop through all grids and save
-    for index, row in df.iterrows():
+    for index, row in profiling.progress(df.iterrows(), total = len(df), label = 'export_shapefile'):
         rec = row[[x[0] for x in field_names]]
         
         w.record(*rec.values)
         w.shape(row[shape_name])
     
     w.balance()
-    w.close()
\ No newline at end of file
+    w.close()
+
+def shape_parts(shapes):
+    '''
+    purpose
+    # the coordinate parts of each shape in the form used by shapefile.Writer, extracted for all shapes at once
+    
+    inputs
+    # shapes: an array of Points, LineStrings or Polygons (or their Multi versions)
+    
+    outputs
+    # parts: a list with, for each shape, a list of parts (each a list of [x, y]) - None for missing or empty shapes
+    ## Polygon rings are oriented as in shapefiles: outer rings clockwise, holes counterclockwise
+    '''
+    
+    parts = [None] * len(shapes)
+    
+    ## single parts (Polygons, LineStrings, Points) and the shape each part came from
+    singles, shape_pos = shapely.get_parts(shapes, return_index = True)
+    polygon = shapely.get_type_id(singles) == 3
+    
+    ## one ring per Polygon part (outer ring then holes), one line per LineString / Point part
+    rings, ring_pos = shapely.get_rings(singles[polygon], return_index = True)
+    outer = np.r_[True, ring_pos[1:] != ring_pos[:-1]] if len(ring_pos) > 0 else np.zeros(0, dtype = bool)
+    
+    lines = np.concatenate([rings, singles[~polygon]])
+    line_shape = np.concatenate([shape_pos[polygon][ring_pos], shape_pos[~polygon]])
+    line_outer = np.concatenate([outer, np.zeros((~polygon).sum(), dtype = bool)])
+    line_ring = np.concatenate([np.ones(len(rings), dtype = bool), np.zeros((~polygon).sum(), dtype = bool)])
+    
+    ## keep the parts of each shape together and in order
+    order = np.argsort(line_shape, kind = 'stable')
+    lines, line_shape, line_outer, line_ring = lines[order], line_shape[order], line_outer[order], line_ring[order]
+    
+    coords = shapely.get_coordinates(lines)
+    n_coords = shapely.get_num_coordinates(lines)
+    starts = np.r_[0, np.cumsum(n_coords)[:-1]].astype(np.int64)
+    
+    ### signed area of each ring (shoelace), negative when clockwise
+    cross = np.zeros(coords.shape[0])
+    cross[:-1] = coords[:-1, 0] * coords[1:, 1] - coords[1:, 0] * coords[:-1, 1]
+    cross[starts + n_coords - 1] = 0
+    signed_area = np.add.reduceat(cross, starts) if coords.shape[0] > 0 else np.zeros(0)
+    
+    reverse = line_ring & (((line_outer == True) & (signed_area > 0)) | ((line_outer == False) & (signed_area < 0)))
+    
+    coords = coords.tolist()
+    
+    for i in range(len(lines)):
+        part = coords[starts[i]:starts[i] + n_coords[i]]
+    
+        if parts[line_shape[i]] is None:
+            parts[line_shape[i]] = []
+    
+        parts[line_shape[i]].append(part[::-1] if reverse[i] else part)
+    
+    return(parts)
+
+def export_shapefile_bulk(df, shape_name, field_names, file_name):
+    '''
+    purpose
+    # export a shapefile using a dataframe what holds shapes (same inputs and output as export_shapefile),
+    # taking the attributes out as arrays once and the coordinates of all shapes at once
+    
+    inputs
+    # df: dataframe with shapes
+    # shape_name: name of column that holds the shapes
+    # field_names: list of column names and type of field (string, integer, etc.)
+    # file_name
+    
+    outputs
+    # a shapefile
+    '''
+    
+    shapes = np.asarray(df[shape_name].values)
+    
+    ## the shapefile type from the shapes (all shapes in a shapefile have one type)
+    type_ids = set(shapely.get_type_id(shapes[~shapely.is_missing(shapes)]).tolist())
+    
+    if type_ids <= {3, 6}:
+        shape_type = shapefile.POLYGON
+    elif type_ids <= {1, 2, 5}:
+        shape_type = shapefile.POLYLINE
+    elif type_ids <= {0}:
+        shape_type = shapefile.POINT
+    elif type_ids <= {4}:
+        shape_type = shapefile.MULTIPOINT
+    else:
+        raise ValueError('cannot write a mix of Points, Lines and Polygons to one shapefile')
+    
+    parts = shape_parts(shapes)
+    records = list(zip(*[df[x[0]].values.tolist() for x in field_names])) if len(field_names) > 0 else [()] * len(shapes)
+    
+    # save shapefiles
+    w = shapefile.Writer(file_name, shapeType = shape_type)
+    
+    # shapefile fields
+    for x in field_names:
+        w.field(x[0], x[1])
+    
+    # loop through the pre-extracted records and parts
+    for record, shape_part in zip(records, parts):
+        w.record(*record)
+    
+        if shape_part is None:
+            w.null()
+        elif shape_type == shapefile.POLYGON:
+            w.poly(shape_part)
+        elif shape_type == shapefile.POLYLINE:
+            w.line(shape_part)
+        elif shape_type == shapefile.POINT:
+            w.point(*shape_part[0][0])
+        else:
+            w.multipoint([x[0] for x in shape_part])
+    
+    w.close()
+
+def export_shapefiles(layers, workers = 4):
+    '''
+    purpose
+    # export several shapefiles at the same time, one thread per shapefile
+    
+    inputs
+    # layers: a list of dictionaries with the inputs of export_shapefile_bulk (df, shape_name, field_names, file_name)
+    # workers: the number of threads
+    
+    outputs
+    # the shapefiles
+    '''
+    
+    with ThreadPoolExecutor(max_workers = max(1, workers)) as executor:
+        for result in [executor.submit(export_shapefile_bulk, **x) for x in layers]:
+            result.result() # raise any error of the export
\ No newline at end of file
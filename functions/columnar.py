@@ -0,0 +1,153 @@
+import json
+import numpy as np
+import shapely
+import pyproj
+
+## pyarrow is only needed for the GeoParquet / Feather files
+try:
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+## version of the GeoParquet metadata written in the 'geo' key of the file
+GEOPARQUET_VERSION = '1.0.0'
+
+## GeoParquet names of the shapely geometry types (by shapely type id)
+GEOMETRY_TYPES = ['Point', 'LineString', 'LineString', 'Polygon', 'MultiPoint',
+                  'MultiLineString', 'MultiPolygon', 'GeometryCollection']
+
+
+def _require_pyarrow():
+    if pyarrow is None:
+        raise ImportError('pyarrow is required for GeoParquet / Feather files, install it with: pip install pyarrow')
+
+def geo_metadata(shapes, shape_name, crs = 'epsg:4326'):
+    '''
+    purpose
+    # the GeoParquet 'geo' metadata of a column of shapes
+    
+    inputs
+    # shapes: an array of shapes
+    # shape_name: the name of the column of shapes
+    # crs: the CRS of the shapes (None if unknown)
+    
+    outputs
+    # metadata: a dictionary with the GeoParquet metadata
+    '''
+    
+    type_ids = np.unique(shapely.get_type_id(shapes[~shapely.is_missing(shapes)]))
+    column = {'encoding': 'WKB', 'geometry_types': [GEOMETRY_TYPES[x] for x in type_ids]}
+    
+    ## the bbox is left out when there are no shapes to bound (a NaN bbox is invalid GeoParquet)
+    if (~shapely.is_missing(shapes) & ~shapely.is_empty(shapes)).any():
+        column['bbox'] = [float(x) for x in shapely.total_bounds(shapes)]
+    
+    ## longitude / latitude is written as OGC:CRS84, the GeoParquet default axis order
+    if crs is not None:
+        crs = pyproj.CRS('OGC:CRS84') if pyproj.CRS(crs) == pyproj.CRS('epsg:4326') else pyproj.CRS(crs)
+        column['crs'] = crs.to_json_dict()
+    
+    return({'version': GEOPARQUET_VERSION, 'primary_column': shape_name, 'columns': {shape_name: column}})
+
+def to_table(df, shape_name, crs = 'epsg:4326'):
+    '''
+    purpose
+    # convert a dataframe that holds shapes into an arrow table, with the shapes as WKB in one call
+    
+    inputs
+    # df: dataframe with shapes
+    # shape_name: name of column that holds the shapes
+    # crs: the CRS of the shapes
+    
+    outputs
+    # table: an arrow table with typed attribute columns, a WKB column and the 'geo' metadata
+    '''
+    
+    _require_pyarrow()
+    
+    shapes = np.asarray(df[shape_name].values)
+    
+    df_out = df.assign(**{shape_name: shapely.to_wkb(shapes)})
+    
+    table = pyarrow.Table.from_pandas(df_out, preserve_index = False)
+    
+    metadata = dict(table.schema.metadata or {})
+    metadata[b'geo'] = json.dumps(geo_metadata(shapes, shape_name = shape_name, crs = crs)).encode()
+    
+    return(table.replace_schema_metadata(metadata))
+
+def export_parquet(df, shape_name, file_name, crs = 'epsg:4326', compression = 'zstd'):
+    '''
+    purpose
+    # export a dataframe that holds shapes as a GeoParquet file in one write
+    
+    inputs
+    # df: dataframe with shapes
+    # shape_name: name of column that holds the shapes
+    # file_name: the path of the file, e.g. data/EA_information.parquet
+    # crs: the CRS of the shapes
+    # compression: the compression of the file
+    
+    outputs
+    # a GeoParquet file
+    '''
+    
+    pyarrow.parquet.write_table(to_table(df, shape_name = shape_name, crs = crs), file_name, compression = compression)
+
+def export_feather(df, shape_name, file_name, crs = 'epsg:4326', compression = 'lz4'):
+    '''
+    purpose
+    # export a dataframe that holds shapes as a Feather (arrow IPC) file in one write, with the same metadata as export_parquet
+    
+    inputs
+    # df: dataframe with shapes
+    # shape_name: name of column that holds the shapes
+    # file_name: the path of the file, e.g. data/EA_information.feather
+    # crs: the CRS of the shapes
+    # compression: the compression of the file
+    
+    outputs
+    # a Feather file
+    '''
+    
+    pyarrow.feather.write_feather(to_table(df, shape_name = shape_name, crs = crs), file_name, compression = compression)
+
+def read_columnar(file_name, columns = None):
+    '''
+    purpose
+    # load a GeoParquet or Feather file written by export_parquet / export_feather (or another GeoParquet writer)
+    
+    inputs
+    # file_name: the path of the file (.parquet or .feather)
+    # columns: the columns to read (None for all columns)
+    
+    outputs
+    # df: a dataframe with the shapes as shapely shapes
+    # crs: the CRS of the shapes as a pyproj CRS (None if unknown)
+    '''
+    
+    _require_pyarrow()
+    
+    if file_name.endswith('.feather') or file_name.endswith('.arrow'):
+        table = pyarrow.feather.read_table(file_name, columns = columns)
+    else:
+        table = pyarrow.parquet.read_table(file_name, columns = columns)
+    
+    metadata = json.loads((table.schema.metadata or {}).get(b'geo', b'{"columns": {}}'))
+    
+    df = table.to_pandas()
+    crs = None
+    
+    ## convert every WKB column back to shapes
+    for name, column in metadata['columns'].items():
+        if name in df.columns:
+            df[name] = shapely.from_wkb(df[name].values)
+    
+        if (name == metadata.get('primary_column')) and ('crs' in column):
+            crs = pyproj.CRS.from_json_dict(column['crs'])
+        elif (name == metadata.get('primary_column')) and ('crs' not in column):
+            crs = pyproj.CRS('OGC:CRS84')
+    
+    return(df, crs)
@@ -0,0 +1,322 @@
+import hashlib
+import os
+import pickle
+import numpy as np
+import pandas as pd
+import shapely
+from shapely import STRtree
+
+import functions.clean_data as clean_data
+import functions.pipeline as pipeline
+import functions.points as points
+import functions.reproject as reproject
+
+
+def shape_hashes(shapes):
+    '''
+    purpose
+    # a hash of every shape, used to find the shapes that changed between two runs
+    
+    inputs
+    # shapes: a series of shapes
+    
+    outputs
+    # hashes: an array of 64 bit hashes (one per shape) of the WKB of each shape, the same in every session
+    '''
+    
+    wkb = shapely.to_wkb(np.asarray(shapes.values))
+    digests = b''.join([hashlib.blake2b(x, digest_size = 8).digest() for x in wkb])
+    
+    return(np.frombuffer(digests, dtype = np.uint64))
+
+def changed_shapes(old_shapes, new_shapes):
+    '''
+    purpose
+    # the shapes that were added to or removed from a layer
+    
+    inputs
+    # old_shapes: a series of shapes (or a PointStore) from the previous run
+    # new_shapes: a series of shapes (or a PointStore) from this run
+    
+    outputs
+    # changed: an array with the added and the removed shapes (once per shape whose number of copies changed)
+    
+    notes
+    # the layers are compared as multisets, so removing one of two identical shapes (e.g. a duplicated roof point) 
+    ## is a change
+    '''
+    
+    if isinstance(old_shapes, points.PointStore):
+        old_shapes = old_shapes.to_series()
+    
+    if isinstance(new_shapes, points.PointStore):
+        new_shapes = new_shapes.to_series()
+    
+    ## the number of copies of each shape in both layers
+    old_hashes, old_first, old_counts = np.unique(shape_hashes(old_shapes), return_index = True, return_counts = True)
+    new_hashes, new_first, new_counts = np.unique(shape_hashes(new_shapes), return_index = True, return_counts = True)
+    
+    old_in_new = pd.Series(new_counts, index = new_hashes).reindex(old_hashes, fill_value = 0).values
+    new_in_old = pd.Series(old_counts, index = old_hashes).reindex(new_hashes, fill_value = 0).values
+    
+    ## shapes with more copies now were added, shapes with fewer copies now were removed
+    added = np.asarray(new_shapes.values)[new_first[new_counts > new_in_old]]
+    removed = np.asarray(old_shapes.values)[old_first[old_counts > old_in_new]]
+    
+    return(np.concatenate([added, removed]))
+
+def pack_shapes(shapes):
+    '''
+    purpose
+    # convert a series of shapes to WKB in one call, which is much faster to pickle than shapely objects
+    
+    inputs
+    # shapes: a series of shapes, or a PointStore (kept as is)
+    
+    outputs
+    # packed: a dictionary with the WKB array, index and name of the series (or the PointStore)
+    '''
+    
+    if isinstance(shapes, points.PointStore):
+        return(shapes)
+    
+    return({'wkb': shapely.to_wkb(np.asarray(shapes.values)), 'index': shapes.index, 'name': shapes.name})
+
+def unpack_shapes(packed):
+    '''
+    purpose
+    # the series of shapes packed by pack_shapes
+    '''
+    
+    if isinstance(packed, points.PointStore):
+        return(packed)
+    
+    return(pd.Series(shapely.from_wkb(packed['wkb']), index = packed['index'], name = packed['name']))
+
+def save_snapshot(directory, eas, line_layers, count_layers, settings):
+    '''
+    purpose
+    # save the EAs and input layers of a run, so that the next run only updates what changed
+    
+    inputs
+    # directory: the folder for the snapshot
+    # eas: the EAs of the run, as returned by pipeline.segment_area
+    # line_layers: a dictionary with the layer name as key and a series of lines as value
+    # count_layers: a dictionary with the column suffix as key and (series of shapes, check_shape) as value
+    # settings: a dictionary with the settings of the run (meters, crs, crs_out, limit_check, tolerance)
+    
+    outputs - none
+    '''
+    
+    os.makedirs(directory, exist_ok = True)
+    
+    snapshot = {'eas': eas.drop(columns = 'shape'), 'ea_shapes': pack_shapes(eas['shape']), 'settings': settings,
+                'line_layers': {x: pack_shapes(line_layers[x]) for x in line_layers},
+                'count_layers': {x: (pack_shapes(count_layers[x][0]), count_layers[x][1]) for x in count_layers}}
+    
+    with open(os.path.join(directory, 'snapshot.pkl.tmp'), 'wb') as f:
+        pickle.dump(snapshot, f, protocol = pickle.HIGHEST_PROTOCOL)
+    
+    os.replace(os.path.join(directory, 'snapshot.pkl.tmp'), os.path.join(directory, 'snapshot.pkl'))
+
+def load_snapshot(directory):
+    '''
+    purpose
+    # load the snapshot of the previous run (see save_snapshot)
+    
+    inputs
+    # directory: the folder of the snapshot
+    
+    outputs
+    # snapshot: a dictionary with eas, line_layers, count_layers and settings (None if there is no snapshot)
+    '''
+    
+    if os.path.exists(os.path.join(directory, 'snapshot.pkl')) == False:
+        return(None)
+    
+    with open(os.path.join(directory, 'snapshot.pkl'), 'rb') as f:
+        snapshot = pickle.load(f)
+    
+    eas = snapshot.pop('ea_shapes')
+    snapshot['eas'].insert(1, 'shape', unpack_shapes(eas))
+    snapshot['line_layers'] = {x: unpack_shapes(snapshot['line_layers'][x]) for x in snapshot['line_layers']}
+    snapshot['count_layers'] = {x: (unpack_shapes(snapshot['count_layers'][x][0]), snapshot['count_layers'][x][1])
+                                for x in snapshot['count_layers']}
+    
+    return(snapshot)
+
+def changed_cells(study_area, meters, cells, changed, crs, crs_out):
+    '''
+    purpose
+    # the grids (row, col) whose footprint touches any changed shape
+    
+    inputs
+    # study_area: the shape of the study area in crs (meters)
+    # meters: the width and heigh of each grid
+    # cells: a dataframe with the row and col of the grids to check
+    # changed: an array of changed shapes in crs_out
+    # crs: the CRS of the study area
+    # crs_out: the CRS of the EAs (None to keep crs)
+    
+    outputs
+    # cells_changed: a dataframe with the grids (shape in crs, row, col) that touch a changed shape
+    '''
+    
+    x_grids, y_grids = clean_data.grid_lines(shape = study_area, meters = meters)
+    
+    row = cells['row'].values
+    col = cells['col'].values
+    boxes = shapely.box(x_grids[col], y_grids[row], x_grids[col + 1], y_grids[row + 1])
+    
+    boxes_out = boxes if crs_out is None else reproject.transform_shapes(boxes, crs, crs_out)
+    
+    box_pos = np.unique(STRtree(boxes_out).query(changed, predicate = 'intersects')[1])
+    
+    return(pd.DataFrame({'shape': boxes[box_pos], 'row': row[box_pos], 'col': col[box_pos]}))
+
+def update_eas(eas, study_area, meters, line_layers, count_layers, changed_lines, changed_counts,
+               crs = 'epsg:32735', crs_out = 'epsg:4326', limit_check = 100, tolerance = 1e-6):
+    '''
+    purpose
+    # update the EAs of a previous run: re-split only the grids touched by changed lines,
+    # and recount only the EAs touched by changed population shapes (or re-split)
+    
+    inputs
+    # eas: the EAs of the previous run, as returned by pipeline.segment_area
+    # study_area: the shape of the study area in crs (meters)
+    # meters: the width and heigh of each grid
+    # line_layers: a dictionary with the layer name as key and the new series of lines (in crs_out) as value
+    # count_layers: a dictionary with the column suffix as key and (new series of shapes in crs_out, check_shape) as value
+    # changed_lines: an array of lines that were added or removed (see changed_shapes)
+    # changed_counts: a dictionary with the column suffix as key and an array of added or removed shapes as value
+    # crs: the CRS of the study area
+    # crs_out: the CRS of the EAs (None to keep crs)
+    # limit_check: the cap for the intersect_no_count columns
+    # tolerance: the width of the buffer around each line (in the units of crs_out)
+    
+    outputs
+    # eas_new: the updated EAs, with new ea_ids only for EAs that were re-split
+    # summary: a dictionary with the number of grids re-split and EAs recounted
+    '''
+    
+    ## re-split the grids touched by changed lines
+    all_cells = eas[['row', 'col']].drop_duplicates()
+    cells = changed_cells(study_area = study_area, meters = meters, cells = all_cells,
+                          changed = changed_lines, crs = crs, crs_out = crs_out)
+    
+    new_pieces = pipeline.empty_eas()
+    
+    if cells.shape[0] > 0:
+        study_area_out = study_area if crs_out is None else reproject.transform_shapes(study_area, crs, crs_out)
+        cells_out = cells['shape'] if crs_out is None else reproject.transform_shapes(cells['shape'], crs, crs_out)
+        envelope = shapely.box(*shapely.total_bounds(np.asarray(cells_out.values)))
+        
+        new_pieces = pipeline.split_cells(
+                cells = cells, boundaries = pd.Series([study_area_out]), crs = crs, crs_out = crs_out, tolerance = tolerance,
+                line_layers = {x: pipeline.subset_layer(pipeline.layer_tree(line_layers[x]), line_layers[x], envelope)
+                               for x in line_layers})
+    
+    cell_key = pd.MultiIndex.from_frame(eas[['row', 'col']])
+    resplit = cell_key.isin(pd.MultiIndex.from_frame(cells[['row', 'col']]))
+    
+    new_pieces['ea_id'] = 0
+    eas_new = pipeline.order_eas(pd.concat([eas[~resplit], new_pieces], ignore_index = True))
+    
+    ## new ea_ids for the re-split EAs, all other EAs keep their ea_id
+    new_ea = eas_new['ea_id'].values == 0
+    first_id = eas['ea_id'].max() + 1 if eas.shape[0] > 0 else 1
+    eas_new.loc[new_ea, 'ea_id'] = first_id + np.arange(new_ea.sum())
+    eas_new['ea_id'] = eas_new['ea_id'].astype(np.int64)
+    
+    ## recount the EAs touched by changed population shapes, and the re-split EAs
+    recount = {}
+    ea_tree = STRtree(np.asarray(eas_new['shape'].values))
+    
+    for append_names, (check_shapes, check_shape) in count_layers.items():
+        touched = np.zeros(eas_new.shape[0], dtype = bool)
+        touched[ea_tree.query(changed_counts.get(append_names, np.empty(0, dtype = object)), predicate = 'intersects')[1]] = True
+        touched = touched | new_ea
+    
+        layer_counts = clean_data.count_within_grid_index(
+                grid_shapes = eas_new['shape'][touched], check_shapes = check_shapes, append_names = append_names,
+                check_shape = check_shape, limit_check = limit_check)
+    
+        for column in ['intersect_count', 'intersect', 'intersect_no_count']:
+            eas_new.loc[touched, column + append_names] = layer_counts[column + append_names].values
+    
+        ## the size of the layer may have changed, which changes intersect_no_count for all EAs
+        eas_new['intersect_count' + append_names] = eas_new['intersect_count' + append_names].astype(np.int64)
+        eas_new['intersect' + append_names] = eas_new['intersect' + append_names].astype(bool)
+        eas_new['intersect_no_count' + append_names] = np.minimum(
+                limit_check, len(check_shapes) - eas_new['intersect_count' + append_names].values)
+    
+        recount[append_names] = int(touched.sum())
+    
+    summary = {'grids_resplit': int(cells.shape[0]), 'eas_new': int(new_ea.sum()), 'eas_recounted': recount}
+    
+    return(eas_new, summary)
+
+def export_eas(eas, csv_file, shapefile_name, columns, field_names):
+    '''
+    purpose
+    # rewrite the EA outputs of a run (EA_information.csv and the EA shapefile) with the updated EAs
+    
+    inputs
+    # eas: the EAs
+    # csv_file: the path of the EA csv, e.g. data/EA_information.csv
+    # shapefile_name: the path of the EA shapefile, e.g. shapefiles/grids_final_4326
+    # columns: the columns written to the csv
+    # field_names: list of column names and type of field for the shapefile (see clean_data.export_shapefile_bulk)
+    
+    outputs - none
+    '''
+    
+    eas[columns].to_csv(csv_file, index = False)
+    
+    clean_data.export_shapefile_bulk(df = eas, shape_name = 'shape', field_names = field_names, file_name = shapefile_name)
+
+def run_incremental(directory, study_area, meters, line_layers, count_layers,
+                    crs = 'epsg:32735', crs_out = 'epsg:4326', limit_check = 100, tolerance = 1e-6):
+    '''
+    purpose
+    # run the segmentation, only updating the EAs touched by changes since the previous run saved in directory
+    # (a full run is done when there is no snapshot, or when the grid settings changed)
+    
+    inputs
+    # directory: the folder of the snapshot
+    # study_area, meters, line_layers, count_layers, crs, crs_out, limit_check, tolerance: see pipeline.segment_area
+    
+    outputs
+    # eas: the EAs
+    # summary: a dictionary describing what was updated
+    '''
+    
+    settings = {'meters': meters, 'crs': crs, 'crs_out': crs_out, 'limit_check': limit_check,
+                'tolerance': tolerance, 'study_area': shapely.to_wkb(study_area),
+                'line_layers': sorted(line_layers.keys()), 'count_layers': sorted(count_layers.keys())}
+    
+    snapshot = load_snapshot(directory)
+    
+    ## full run
+    if (snapshot is None) or (snapshot['settings'] != settings):
+        eas = pipeline.segment_area(study_area = study_area, meters = meters, line_layers = line_layers,
+                                    count_layers = count_layers, crs = crs, crs_out = crs_out,
+                                    limit_check = limit_check, tolerance = tolerance)
+        summary = {'full_run': True}
+    
+    ## update the previous run
+    else:
+        changed_lines = np.concatenate([changed_shapes(snapshot['line_layers'][x], line_layers[x]) for x in line_layers]
+                                       + [np.empty(0, dtype = object)])
+        changed_counts = {x: changed_shapes(snapshot['count_layers'][x][0], count_layers[x][0]) for x in count_layers}
+    
+        eas, summary = update_eas(eas = snapshot['eas'], study_area = study_area, meters = meters,
+                                  line_layers = line_layers, count_layers = count_layers,
+                                  changed_lines = changed_lines, changed_counts = changed_counts,
+                                  crs = crs, crs_out = crs_out, limit_check = limit_check, tolerance = tolerance)
+        summary['full_run'] = False
+    
+    save_snapshot(directory = directory, eas = eas, line_layers = line_layers,
+                  count_layers = count_layers, settings = settings)
+    
+    return(eas, summary)
@@ -0,0 +1,212 @@
+import pandas as pd
+import numpy as np
+import shapely
+from shapely.geometry import shape
+import shapefile
+
+## pyshp shape types that hold a single point per record
+POINT_TYPES = [shapefile.POINT, shapefile.POINTM, shapefile.POINTZ]
+
+
+def chunk_frame(x, y, shapes, records, field_names):
+    '''
+    purpose
+    # create one chunk from the lists filled while reading a shapefile
+    
+    inputs
+    # x: a list of x coordinates (None if the shapefile does not hold points)
+    # y: a list of y coordinates (None if the shapefile does not hold points)
+    # shapes: a list of shapes (None if the shapefile holds points)
+    # records: a list of records
+    # field_names: the names of the fields in the records
+    
+    outputs
+    # chunk: a dictionary with x and y arrays (points), a shapes array (other shapes) and a records dataframe
+    '''
+    
+    return({'x': None if x is None else np.array(x, dtype = float),
+            'y': None if y is None else np.array(y, dtype = float),
+            'shapes': None if shapes is None else np.array(shapes, dtype = object),
+            'records': pd.DataFrame(records, columns = field_names)})
+
+def read_shp_chunks(shapefiles, chunk_size = 100000, fields = None, where = None, bbox = None):
+    '''
+    purpose
+    # read a shapefile in chunks, so that memory use stays flat however large the shapefile is
+    # records rejected by where or bbox are skipped while reading, so they never reach a chunk
+    
+    inputs
+    # shapefiles: a shapefile.Reader
+    # chunk_size: the number of records in each chunk
+    # fields: the names of the fields to read (None for all fields)
+    # where: optional dictionary of attribute conditions (see record_filter), e.g. {'highway': ['primary', 'secondary']}
+    # bbox: optional (minx, miny, maxx, maxy) in the CRS of the shapefile, only shapes that overlap it are read
+    ## (pyshp skips the other shapes from their header, and does not read their records)
+    
+    outputs
+    # a generator of chunks, each a dictionary with
+    ## x, y: arrays with the coordinates of each point (only for Point shapefiles, otherwise None)
+    ## shapes: an array of shapely shapes (only for other shapefiles, otherwise None)
+    ## records: a dataframe with the fields of each record
+    '''
+    
+    field_names = [i[0] for i in shapefiles.fields[1:]] if fields is None else list(fields)
+    points = shapefiles.shapeType in POINT_TYPES
+    
+    ## the fields of the attribute conditions are read too, and the records are indexed by field name
+    where = {} if where is None else where
+    read_fields = None if fields is None else field_names + [x for x in where if x not in field_names]
+    keep = record_filter(where) if len(where) > 0 else None
+    
+    x, y, shapes, records = [], [], [], []
+    
+    for shape_record in shapefiles.iterShapeRecords(fields = read_fields, bbox = bbox):
+    
+        if (keep is not None) and (keep(shape_record.record) == False):
+            continue
+    
+        ## points are kept as coordinates only, other shapes are converted to shapely
+        if points == True:
+            point = shape_record.shape.points
+            x.append(point[0][0] if len(point) > 0 else np.nan)
+            y.append(point[0][1] if len(point) > 0 else np.nan)
+        else:
+            shapes.append(shape(shape_record.shape) if len(shape_record.shape.points) > 0 else None)
+    
+        records.append([shape_record.record[x] for x in field_names])
+    
+        ### return the chunk and start a new one
+        if len(records) == chunk_size:
+            yield chunk_frame(x = x if points else None, y = y if points else None,
+                              shapes = None if points else shapes,
+                              records = records, field_names = field_names)
+    
+            x, y, shapes, records = [], [], [], []
+    
+    if len(records) > 0:
+        yield chunk_frame(x = x if points else None, y = y if points else None,
+                          shapes = None if points else shapes,
+                          records = records, field_names = field_names)
+
+def chunk_shapes(chunk):
+    '''
+    purpose
+    # the shapes of a chunk as an array of shapely shapes (Points are created from the coordinates)
+    
+    inputs
+    # chunk: a chunk from read_shp_chunks
+    
+    outputs
+    # shapes: an array of shapely shapes
+    '''
+    
+    if chunk['shapes'] is not None:
+        return(chunk['shapes'])
+    
+    return(shapely.points(chunk['x'], chunk['y']))
+
+def record_filter(where):
+    '''
+    purpose
+    # a test of the attributes of a record, from a dictionary of conditions
+    
+    inputs
+    # where: a dictionary with a field name as key and, as value, either
+    ## a list / set / tuple of the values to keep (e.g. {'highway': ['primary', 'secondary']}),
+    ## a function of the field value that returns True to keep the record, or
+    ## a single value to keep
+    
+    outputs
+    # keep: a function of a record (a pyshp record) that returns whether to keep it
+    '''
+    
+    tests = []
+    
+    for value in where.values():
+        if callable(value):
+            tests.append(value)
+        elif isinstance(value, (list, set, tuple, frozenset)):
+            tests.append(frozenset(value).__contains__)
+        else:
+            tests.append(lambda x, value = value: x == value)
+    
+    names = list(where.keys())
+    
+    return(lambda record: all(test(record[x]) for test, x in zip(tests, names)))
+
+def load_layer(file_name, fields = None, where = None, bbox = None, clip = None):
+    '''
+    purpose
+    # read a shapefile into a dataframe (same format as clean_data.create_shape_df_shp), applying attribute filters 
+    # and a bounding box / polygon clip while reading, so that rejected records are never converted to shapes
+    ## the attribute filter is applied to the dbf first, then only the shapes of the kept records are read,
+    ## and shapes whose bounding box is outside bbox are skipped from their header without being parsed
+    
+    inputs
+    # file_name: the path of the shapefile (or a shapefile.Reader)
+    # fields: the names of the fields to keep (None for all fields)
+    # where: optional dictionary of attribute conditions (see record_filter), e.g. {'highway': ['primary', 'secondary']}
+    # bbox: optional (minx, miny, maxx, maxy) in the CRS of the shapefile, only shapes that overlap it are read
+    # clip: optional shape (e.g. the study area) in the CRS of the shapefile, only shapes that intersect it are kept
+    ## (its bounds are used as bbox if no bbox is given)
+    
+    outputs
+    # df_shapes: a dataframe with the fields of the kept records and their shapes (shape column)
+    ## records with an empty or missing shape are kept with a None shape, unless a clip is given:
+    ## they cannot intersect the clip shape, so they are dropped with the other shapes outside it
+    '''
+    
+    reader = file_name if isinstance(file_name, shapefile.Reader) else shapefile.Reader(file_name)
+    
+    field_names = [i[0] for i in reader.fields[1:]] if fields is None else list(fields)
+    where = {} if where is None else where
+    
+    if (bbox is None) and (clip is not None):
+        bbox = clip.bounds
+    
+    ## attribute filter on the dbf only, keeping the records that pass (pyshp returns the fields in the order of the file)
+    read_fields = field_names + [x for x in where if x not in field_names]
+    
+    if len(where) > 0:
+        keep = record_filter(where)
+        records = {}
+    
+        for i, record in enumerate(reader.iterRecords(fields = read_fields)):
+            if keep(record):
+                records[i] = [record[x] for x in field_names]
+    
+        ### only the shapes of the kept records are read
+        shapes = [(i, reader.shape(i, bbox = bbox)) for i in records]
+    else:
+        records = None
+        shapes = [(x.oid, x) for x in reader.iterShapes(bbox = bbox) if x is not None]
+    
+    ## shapes outside the bounding box are skipped or returned as None by pyshp, empty shapes are kept as None shapes
+    shapes = [(i, x) for i, x in shapes if x is not None]
+    positions = [i for i, x in shapes]
+    
+    if reader.shapeType in POINT_TYPES:
+        coords = np.array([x.points[0] if len(x.points) > 0 else (np.nan, np.nan) for i, x in shapes], dtype = float).reshape(-1, 2)
+        shape_array = shapely.points(coords[:, 0], coords[:, 1])
+        shape_array[np.isnan(coords[:, 0])] = None
+    else:
+        shape_array = np.array([shape(x) if len(x.points) > 0 else None for i, x in shapes] + [None], dtype = object)[:-1]
+    
+    ## records of the kept shapes
+    if records is None:
+        if len(positions) == len(reader):
+            record_list = [[x[y] for y in field_names] for x in reader.iterRecords(fields = field_names)]
+        else:
+            record_list = [[x[y] for y in field_names] for x in [reader.record(i, fields = field_names) for i in positions]]
+    else:
+        record_list = [records[i] for i in positions]
+    
+    df_shapes = pd.DataFrame(record_list, columns = field_names)
+    df_shapes['shape'] = shape_array
+    
+    ## exact test against the clip shape
+    if clip is not None:
+        shapely.prepare(clip)
+        df_shapes = df_shapes[shapely.intersects(clip, shape_array)].reset_index(drop = True)
+    
+    return(df_shapes)
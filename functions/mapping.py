@@ -1,6 +1,10 @@
 
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection, PolyCollection
 import numpy as np
+import shapely
+
+import functions.points as points
 
 def plot_set_up(plot_title, x_label = '', y_label = '', 
                 plot_height = 7, plot_width = 7, plot_aspect = 'equal'):
@@ -86,7 +90,7 @@ def shape_plot(axis, shape_object, alpha = 1, color = 'red',
 def shape_plot_df(axis, shapes, include_label, label_name, alpha = 1, color = 'red', line = False):
     '''
     purpose
-    # loop through all shapes in a dataframe and plot them
+    # plot all shapes in a dataframe column as one collection (see shape_collection)
     
     inputs
     # axis: the axis object for the plot
@@ -103,13 +107,162 @@ def shape_plot_df(axis, shapes, include_label, label_name, alpha = 1, color = 'r
     '''
     
     
-    for index, row in shapes.iteritems():
-        label = np.where(index == shapes.index[-1], label_name, '') 
-        include = np.where((index == shapes.index[-1]) & (include_label), True, False)
-        
-        shape_plot(axis = axis, shape_object = row, 
-                   color = color, alpha = alpha, 
-                   label_name = label, include_label = include, line = line)
+    shape_collection(axis = axis, shapes = shapes, alpha = alpha, color = color, 
+                     include_label = include_label, label_name = label_name, line = line)
+
+def shape_coordinates(shapes, line = False):
+    '''
+    purpose
+    # the coordinates of a column of shapes, extracted for all shapes at once
+    
+    inputs
+    # shapes: a series (or array) of shapes
+    # line: boolean for whether the shapes are lines (or Polygons), True if lines
+    
+    outputs
+    # segments: a list of coordinate arrays, one per line or outer ring of each Polygon (Multi shapes give several)
+    # shape_pos: the position of the shape each segment came from
+    '''
+    
+    shapes = np.asarray(shapes.values if hasattr(shapes, 'values') else shapes)
+    parts, shape_pos = shapely.get_parts(shapes, return_index = True)
+    
+    ## the outline of each Polygon
+    if line == False:
+        polygon = shapely.get_type_id(parts) == 3
+        parts, shape_pos = shapely.get_exterior_ring(parts[polygon]), shape_pos[polygon]
+    
+    coords, part_pos = shapely.get_coordinates(parts, return_index = True)
+    
+    ## split the coordinates into one array per part (parts without coordinates are dropped)
+    kept = np.unique(part_pos)
+    segments = np.split(coords, np.flatnonzero(np.diff(part_pos)) + 1) if len(coords) > 0 else []
+    
+    return(segments, shape_pos[kept])
+
+def shape_collection(axis, shapes, alpha = 1, color = 'red', include_label = False, label_name = None, 
+                     line = False, fill = False):
+    '''
+    purpose
+    # plot a whole column of shapes as a single LineCollection (outlines) or PolyCollection (filled Polygons)
+    
+    inputs
+    # axis: the axis object for the plot
+    # shapes: a series (or array) of shapes
+    # alpha: alpha of the shapes
+    # color: the color of the shapes, or an (n, 4) array with one RGBA color per shape
+    # include_label: whether to include the label of the shapes in the legend
+    # label_name: the label of the shapes
+    # line: boolean for whether the shapes are lines (or Polygons), True if lines
+    # fill: whether to fill the Polygons (only the outer rings are filled)
+    
+    outputs
+    # collection: the collection added to the axis
+    '''
+    
+    segments, shape_pos = shape_coordinates(shapes, line = line)
+    
+    ## one color per shape is repeated for each of its segments
+    colors = np.asarray(color)[shape_pos] if np.ndim(color) == 2 else color
+    
+    if (fill == True) and (line == False):
+        collection = PolyCollection(segments, facecolors = colors, edgecolors = colors, alpha = alpha)
+    else:
+        collection = LineCollection(segments, colors = colors, alpha = alpha)
+    
+    collection.set_label(label_name if include_label == True else '_nolegend_')
+    
+    axis.add_collection(collection)
+    axis.autoscale_view()
+    
+    return(collection)
+
+def group_colors(grouped_df, colors = 30):
+    '''
+    purpose
+    # the color of each group, in the same order as loop_many_shapes
+    
+    inputs
+    # grouped_df: a groupby dataframe
+    # colors: the number of colors to spread over the rainbow colormap
+    
+    outputs
+    # group_color: a dictionary with the group label as key and the color as value
+    '''
+    
+    colors = iter(plt.get_cmap('rainbow')(np.linspace(0, 1, colors)))
+    
+    return({label: next(colors) for label, df in grouped_df})
+
+def group_collection(axis, grouped_df, colors = 30, shape_column = 'shape', alpha = 1, 
+                     line = False, fill = False, include_label = True):
+    '''
+    purpose
+    # plot the shapes of all groups (e.g. EA categories) as a single collection, one color per group as in loop_many_shapes
+    
+    inputs
+    # axis: the axis object for the plot
+    # grouped_df: a groupby dataframe, grouped by the column that you want each unique value to be a different color
+    # colors: the number of colors to spread over the rainbow colormap
+    # shape_column: the name of the column that contains shapes
+    # alpha: alpha of the shapes
+    # line: boolean for whether the shapes are lines (or Polygons), True if lines
+    # fill: whether to fill the Polygons
+    # include_label: whether to include the groups in the legend
+    
+    outputs
+    # collection: the collection added to the axis
+    '''
+    
+    group_color = group_colors(grouped_df, colors = colors)
+    
+    shapes = []
+    shape_colors = []
+    
+    for label, df in grouped_df:
+        shapes.append(np.asarray(df[shape_column].values))
+        shape_colors.append(np.tile(group_color[label], (df.shape[0], 1)))
+    
+    shapes = np.concatenate(shapes) if len(shapes) > 0 else np.empty(0, dtype = object)
+    shape_colors = np.concatenate(shape_colors) if len(shape_colors) > 0 else np.empty((0, 4))
+    
+    collection = shape_collection(axis = axis, shapes = shapes, color = shape_colors, alpha = alpha, 
+                                  line = line, fill = fill)
+    
+    ## an empty line per group for the legend
+    if include_label == True:
+        for label in group_color:
+            axis.plot([], [], color = group_color[label], alpha = alpha, label = label)
+    
+    return(collection)
+
+def point_plot(axis, point_object, alpha = 1, color = 'red', size = 1,
+               include_label = False, label_name = None):
+    '''
+    purpose
+    # plot a layer of points (e.g. roofs) as one scatter
+    
+    inputs
+    # axis: the axis object for the plot
+    # point_object: a points.PointStore, or a series of shapely Points
+    # alpha: alpha of the points
+    # color: the color of the points
+    # size: the size of the points
+    # include_label: whether to include the label of the points in the legend
+    # label_name: the label of the points
+    
+    outputs - none, the plot is shown
+    '''
+    
+    # extract the x and y coordinates of the points
+    if isinstance(point_object, points.PointStore):
+        x, y = point_object.x, point_object.y
+    else:
+        x, y = shapely.get_x(point_object.values), shapely.get_y(point_object.values)
+    
+    # plot the points
+    axis.scatter(x, y, s = size, color = color, alpha = alpha, 
+                 label = label_name if include_label == True else None)
 
 def loop_many_shapes(grouped_df, colors = 30, shape_column = None, shape_name_column = None):
     
@@ -131,11 +284,11 @@ def loop_many_shapes(grouped_df, colors = 30, shape_column = None, shape_name_co
     graph_input_list = [] # list to create dataframe with all graph inputs
     
     ## colors for the plot
-    colors = iter(plt.get_cmap('rainbow')(np.linspace(0, 1, colors)))
+    group_color = group_colors(grouped_df, colors = colors)
     
     ### loop through all groups of label
     for label, df in grouped_df:
-        color = next(colors) # return the next color in the list        
+        color = group_color[label] # the color of the group
         loop_count = 0 ## loop counter
         
         ### loop through all rows
@@ -0,0 +1,332 @@
+import numpy as np
+import pandas as pd
+import shapely
+from shapely import STRtree
+
+import functions.clean_data as clean_data
+import functions.pipeline as pipeline
+import functions.points as points
+import functions.profiling as profiling
+import functions.reproject as reproject
+
+## the status of each grid: outside the study area, a whole grid (no trimming or splitting), or a grid that is trimmed or split
+OUTSIDE = 0
+WHOLE = 1
+SPLIT = 2
+
+
+def resolution_factors(resolutions):
+    '''
+    purpose
+    # check that the grids of a resolution sweep are aligned, and find how many of the finest grids fit in each grid
+    
+    inputs
+    # resolutions: a list with the width and heigh of the grids of each resolution, e.g. [250, 500, 1000]
+    
+    outputs
+    # resolutions: the resolutions from the finest to the coarsest
+    # factors: the width of each resolution in finest grids (1 for the finest)
+    '''
+    
+    resolutions = sorted(set(resolutions))
+    factors = [int(round(x / resolutions[0])) for x in resolutions]
+    
+    ## every grid must be made of whole finest grids, so that the counts can be summed
+    if any([abs(x - y * resolutions[0]) > 1e-9 * x for x, y in zip(resolutions, factors)]):
+        raise ValueError('every resolution must be a multiple of the finest resolution, e.g. [250, 500, 1000]')
+    
+    return(resolutions, factors)
+
+def roll_up(array, factor):
+    '''
+    purpose
+    # sum the values of the finest grids into the grids that are factor times wider (quadtree style for a factor of 2)
+    
+    inputs
+    # array: a 2d array with a value per finest grid (grid row, grid column)
+    # factor: the width of the coarser grids in finest grids
+    
+    outputs
+    # rolled: a 2d array with the sum of the values within each coarser grid
+    '''
+    
+    return(_blocks(array, factor, fill = 0).sum(axis = (1, 3)))
+
+def roll_up_status(status, factor):
+    '''
+    purpose
+    # the status of the coarser grids from the status of the finest grids within them
+    ## a grid is whole if all its finest grids are whole, outside if all are outside, and otherwise trimmed or split
+    
+    inputs
+    # status: a 2d array with the status of each finest grid (OUTSIDE, WHOLE or SPLIT)
+    # factor: the width of the coarser grids in finest grids
+    
+    outputs
+    # status_rolled: a 2d array with the status of each coarser grid
+    '''
+    
+    blocks = _blocks(status, factor, fill = OUTSIDE)
+    low = blocks.min(axis = (1, 3))
+    high = blocks.max(axis = (1, 3))
+    
+    return(np.where(high == OUTSIDE, OUTSIDE, np.where((low == WHOLE) & (high == WHOLE), WHOLE, SPLIT)).astype(np.int8))
+
+def _blocks(array, factor, fill):
+    ## pad the rows and columns to a multiple of factor (the extra grids are outside the study area), and cut into blocks
+    n_rows = -(-array.shape[0] // factor)
+    n_cols = -(-array.shape[1] // factor)
+    
+    padded = np.full((n_rows * factor, n_cols * factor), fill, dtype = array.dtype)
+    padded[:array.shape[0], :array.shape[1]] = array
+    
+    return(padded.reshape(n_rows, factor, n_cols, factor))
+
+def grid_status(study_area, x_grids, y_grids, line_layers, tolerance = 0.1):
+    '''
+    purpose
+    # find which grids are outside the study area, whole, or need to be trimmed or split
+    
+    inputs
+    # study_area: the shape of the study area, in the CRS of the grids (meters)
+    # x_grids, y_grids: the grid lines (see clean_data.grid_lines)
+    # line_layers: a dictionary with the layer name as key and a series of lines (in the CRS of the grids) as value
+    # tolerance: the width of the buffer around each line
+    
+    outputs
+    # status: a 2d array with the status of each grid (grid row, grid column)
+    '''
+    
+    n_rows, n_cols = len(y_grids) - 1, len(x_grids) - 1
+    
+    row, col = np.meshgrid(np.arange(n_rows), np.arange(n_cols), indexing = 'ij')
+    row, col = row.ravel(), col.ravel()
+    
+    grids = shapely.box(x_grids[col], y_grids[row], x_grids[col + 1], y_grids[row + 1])
+    
+    ## grids inside the study area are whole, grids on its boundary are trimmed
+    shapely.prepare(study_area)
+    status = np.where(shapely.contains_properly(study_area, grids), WHOLE,
+                      np.where(shapely.intersects(study_area, grids), SPLIT, OUTSIDE)).astype(np.int8)
+    profiling.count('contains', len(grids))
+    profiling.count('intersects', len(grids))
+    
+    ## grids within the tolerance of a line are split
+    line_array = np.concatenate([np.asarray(line_layers[x].values) for x in line_layers] + [np.empty(0, dtype = object)])
+    
+    if len(line_array) > 0:
+        grids_buffer = shapely.box(x_grids[col] - tolerance, y_grids[row] - tolerance,
+                                   x_grids[col + 1] + tolerance, y_grids[row + 1] + tolerance)
+    
+        grid_pos = np.unique(STRtree(line_array).query(grids_buffer, predicate = 'intersects')[0])
+        profiling.count('strtree_query', len(grids_buffer))
+        status[grid_pos[status[grid_pos] == WHOLE]] = SPLIT
+    
+    return(status.reshape(n_rows, n_cols))
+
+def bin_layer(check_shapes, origin, meters, n_rows, n_cols):
+    '''
+    purpose
+    # bin a population layer once at the finest resolution: the range of finest grids that the box around each shape touches
+    ## the ranges are closed, so a shape on the edge of a grid also touches the grid next to it
+    
+    inputs
+    # check_shapes: a series of Polygons or Points (or a points.PointStore), in the CRS of the grids (meters)
+    # origin: the lower left corner of the grids
+    # meters: the width and heigh of the finest grids
+    # n_rows, n_cols: the number of finest grid rows and columns
+    
+    outputs
+    # bins: a dictionary with the lowest and highest grid row and column of each shape (row_low, row_high, col_low, col_high),
+    ## and counts: a 2d array with the number of shapes that are within a single finest grid
+    '''
+    
+    if isinstance(check_shapes, points.PointStore):
+        bounds = np.column_stack([check_shapes.x, check_shapes.y, check_shapes.x, check_shapes.y])
+    else:
+        bounds = shapely.bounds(np.asarray(check_shapes.values))
+    
+    ## the low edge rounds down only when the shape is strictly inside the grid, and the high edge always rounds down
+    bins = {'row_low': (np.ceil((bounds[:, 1] - origin[1]) / meters) - 1).astype(np.int64),
+            'row_high': np.floor((bounds[:, 3] - origin[1]) / meters).astype(np.int64),
+            'col_low': (np.ceil((bounds[:, 0] - origin[0]) / meters) - 1).astype(np.int64),
+            'col_high': np.floor((bounds[:, 2] - origin[0]) / meters).astype(np.int64)}
+    
+    single = _single(bins, 1, n_rows, n_cols)
+    
+    bins['counts'] = np.bincount(bins['row_low'][single] * n_cols + bins['col_low'][single],
+                                 minlength = n_rows * n_cols).reshape(n_rows, n_cols)
+    bins['single'] = single
+    
+    return(bins)
+
+def _single(bins, factor, n_rows, n_cols):
+    ## shapes within a single grid of the resolution (n_rows and n_cols are the number of finest grids)
+    return((bins['row_low'] // factor == bins['row_high'] // factor) & (bins['col_low'] // factor == bins['col_high'] // factor) &
+           (bins['row_low'] >= 0) & (bins['row_high'] < n_rows) & (bins['col_low'] >= 0) & (bins['col_high'] < n_cols))
+
+def level_eas(study_area, status, origin, meters, line_layers, tolerance = 0.1):
+    '''
+    purpose
+    # create the EAs of one resolution: whole grids are kept as boxes, only trimmed or split grids are trimmed and split
+    
+    inputs
+    # study_area: the shape of the study area, in the CRS of the grids (meters)
+    # status: a 2d array with the status of each grid of the resolution (see roll_up_status)
+    # origin: the lower left corner of the grids
+    # meters: the width and heigh of each grid
+    # line_layers: a dictionary with the layer name as key and a series of lines (in the CRS of the grids) as value
+    # tolerance: the width of the buffer around each line
+    
+    outputs
+    # eas: a dataframe with the EAs (index, shape, row, col, piece, bd_layers), ordered as in pipeline.build_eas
+    '''
+    
+    x_grids = origin[0] + meters * np.arange(status.shape[1] + 1)
+    y_grids = origin[1] + meters * np.arange(status.shape[0] + 1)
+    
+    def grid_boxes(cell_status):
+        row, col = np.nonzero(status == cell_status)
+    
+        return(pd.DataFrame({'shape': shapely.box(x_grids[col], y_grids[row], x_grids[col + 1], y_grids[row + 1]),
+                             'row': row.astype(np.int64), 'col': col.astype(np.int64)}))
+    
+    eas_whole = grid_boxes(WHOLE)
+    eas_whole['bd_layers'] = ''
+    
+    eas_split = pipeline.split_cells(cells = grid_boxes(SPLIT), boundaries = pd.Series([study_area]),
+                                     line_layers = line_layers, crs = None, crs_out = None, tolerance = tolerance)
+    
+    return(pipeline.order_eas(pd.concat([eas_whole, eas_split, pipeline.empty_eas()], ignore_index = True)))
+
+def level_counts(eas, whole, check_shapes, check_shape, bins, factor, n_rows, n_cols):
+    '''
+    purpose
+    # count the population shapes/points within the EAs of one resolution
+    ## shapes within a single whole grid are counted from the binned counts, all other shapes are tested against the EAs
+    
+    inputs
+    # eas: a dataframe with the EAs of the resolution (see level_eas)
+    # whole: an array with whether each EA is a whole grid
+    # check_shapes: a series of Polygons or Points (or a points.PointStore), in the CRS of the EAs
+    # check_shape: whether the check object is a Polygon (if false then assumed to be a Point)
+    # bins: the bins of the layer (see bin_layer)
+    # factor: the width of the grids of the resolution in finest grids
+    # n_rows, n_cols: the number of finest grid rows and columns
+    
+    outputs
+    # counts: an array with the number of check shapes within each EA
+    '''
+    
+    ## binned counts of the shapes within a single grid of this resolution
+    rolled = roll_up(bins['counts'], factor)
+    
+    single = _single(bins, factor, n_rows, n_cols)
+    extra = single & ~bins['single']
+    np.add.at(rolled, (bins['row_low'][extra] // factor, bins['col_low'][extra] // factor), 1)
+    
+    row, col = eas['row'].values, eas['col'].values
+    counts = np.where(whole, rolled[row, col], 0)
+    
+    ## exact tests for the shapes that are not within a single grid, or are within a trimmed or split grid
+    grid_key = row * rolled.shape[1] + col
+    split_keys = np.unique(grid_key[~whole])
+    
+    check_pos = np.flatnonzero(~single | np.isin((bins['row_low'] // factor) * rolled.shape[1] + bins['col_low'] // factor,
+                                                 split_keys))
+    
+    if len(check_pos) > 0:
+        if isinstance(check_shapes, points.PointStore):
+            check_array = shapely.points(check_shapes.x[check_pos], check_shapes.y[check_pos])
+        else:
+            check_array = np.asarray(check_shapes.values)[check_pos]
+    
+        tree = STRtree(np.asarray(eas['shape'].values))
+        check_index, ea_pos = tree.query(check_array, predicate = 'intersects' if check_shape == True else 'within')
+        profiling.count('strtree_query', len(check_array))
+        profiling.count('strtree_pairs', len(ea_pos))
+    
+        ## shapes within a single whole grid were already counted
+        counts += np.bincount(ea_pos, minlength = len(counts))
+    
+    return(counts)
+
+def segment_resolutions(study_area, resolutions, line_layers = {}, count_layers = {},
+                        crs = 'epsg:32735', crs_out = 'epsg:4326', limit_check = 100, tolerance = 0.1):
+    '''
+    purpose
+    # run the geographic segmentation for several grid sizes at once (e.g. 250 m, 500 m and 1 km EAs)
+    # the grids of all resolutions share one origin, so that each grid is made of whole finest grids:
+    ## the population layers are binned once at the finest resolution and the counts are summed into the coarser grids,
+    ## the grids inside the study area and away from lines are found once, and only the other grids are trimmed and split
+    
+    inputs
+    # study_area: the shape of the study area in crs (meters)
+    # resolutions: a list with the width and heigh of the grids of each resolution, each a multiple of the finest
+    # line_layers: a dictionary with the layer name as key and a series of lines (in crs_out) as value
+    # count_layers: a dictionary with the column suffix as key and (series of shapes or PointStore in crs_out, check_shape) as value
+    # crs: the CRS of the study area, used to create the grids
+    # crs_out: the CRS of the EAs, lines and population data (None to keep crs)
+    # limit_check: the cap for the intersect_no_count columns
+    # tolerance: the width of the buffer around each line in meters
+    
+    outputs
+    # eas: a dictionary with the resolution as key and the EAs as value, in the same format as pipeline.segment_area
+    
+    notes
+    # all the overlay work is done in crs, as in pipeline.segment_area with projected = True
+    # the EAs of a resolution are the same as pipeline.segment_area with the origin of the coarsest resolution
+    ## (clean_data.grid_origin(study_area, max(resolutions))), which can differ from the origin of a single run
+    '''
+    
+    resolutions, factors = resolution_factors(resolutions)
+    finest = resolutions[0]
+    
+    ## one origin for all resolutions, the corner of the coarsest grids
+    origin = clean_data.grid_origin(study_area, resolutions[-1])
+    x_grids, y_grids = clean_data.grid_lines(shape = study_area, meters = finest, origin = origin)
+    n_rows, n_cols = len(y_grids) - 1, len(x_grids) - 1
+    
+    ## the lines and population layers are reprojected to crs once
+    if crs_out is not None:
+        line_layers, count_layers = pipeline.project_layers(line_layers = line_layers, count_layers = count_layers,
+                                                            src_crs = crs_out, dst_crs = crs)
+    
+    ## one pass at the finest resolution
+    status = grid_status(study_area = study_area, x_grids = x_grids, y_grids = y_grids,
+                         line_layers = line_layers, tolerance = tolerance)
+    
+    bins = {x: bin_layer(count_layers[x][0], origin = origin, meters = finest, n_rows = n_rows, n_cols = n_cols)
+            for x in count_layers}
+    
+    eas_all = {}
+    
+    for meters, factor in zip(resolutions, factors):
+        level_status = roll_up_status(status, factor)
+    
+        eas = level_eas(study_area = study_area, status = level_status, origin = origin, meters = meters,
+                        line_layers = line_layers, tolerance = tolerance)
+    
+        whole = level_status[eas['row'].values, eas['col'].values] == WHOLE
+    
+        ## counts of each layer, in the format of pipeline.count_eas
+        counts = []
+    
+        for append_names, (check_shapes, check_shape) in count_layers.items():
+            layer_counts = level_counts(eas = eas, whole = whole, check_shapes = check_shapes, check_shape = check_shape,
+                                        bins = bins[append_names], factor = factor, n_rows = n_rows, n_cols = n_cols)
+    
+            counts.append(clean_data._intersect_frame(grid_index = eas.index, counts = layer_counts,
+                                                      n_check = len(check_shapes), append_names = append_names,
+                                                      limit_check = limit_check).drop('index', axis = 1))
+    
+        eas = pd.concat([eas] + counts, axis = 1)
+        eas['ea_id'] = np.array(range(1, eas.shape[0] + 1))
+    
+        ## the only reprojection of the EAs
+        if crs_out is not None:
+            eas['shape'] = reproject.transform_shapes(eas['shape'], src_crs = crs, dst_crs = crs_out)
+    
+        eas_all[meters] = eas
+    
+    return(eas_all)
@@ -0,0 +1,439 @@
+import numpy as np
+import pandas as pd
+import shapely
+from shapely import STRtree
+from concurrent.futures import ProcessPoolExecutor
+
+import functions.clean_data as clean_data
+import functions.points as points
+import functions.reproject as reproject
+
+
+def run_tasks(function, tasks, workers = 1):
+    '''
+    purpose
+    # run a function over a list of tasks, in a process pool if more than one worker is requested
+    
+    inputs
+    # function: a module level function that takes one task
+    # tasks: a list of tasks
+    # workers: the number of processes to use (1 runs the tasks in this process)
+    
+    outputs
+    # results: a list with the result of each task, in the same order as tasks
+    '''
+    
+    if (workers is None) or (workers <= 1) or (len(tasks) <= 1):
+        return([function(x) for x in tasks])
+    
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+        results = list(executor.map(function, tasks))
+    
+    return(results)
+
+def tile_ranges(n_rows, n_cols, tile_cells = None):
+    '''
+    purpose
+    # partition the rows and columns of the grids into square tiles of grids
+    
+    inputs
+    # n_rows: the number of grid rows
+    # n_cols: the number of grid columns
+    # tile_cells: the width and heigh of each tile in grids (None for a single tile)
+    
+    outputs
+    # tiles: a list of dictionaries with the (start, stop) rows and columns of each tile
+    '''
+    
+    if tile_cells is None:
+        return([{'rows': (0, n_rows), 'cols': (0, n_cols)}])
+    
+    tiles = [{'rows': (row, min(row + tile_cells, n_rows)), 'cols': (col, min(col + tile_cells, n_cols))}
+             for row in range(0, n_rows, tile_cells) for col in range(0, n_cols, tile_cells)]
+    
+    return(tiles)
+
+def tile_envelope(x_grids, y_grids, tile, meters, crs, crs_out, margin = 1e-6):
+    '''
+    purpose
+    # the bounding box of a tile of grids in the output CRS
+    
+    inputs
+    # x_grids, y_grids: the grid lines (see clean_data.grid_lines)
+    # tile: a dictionary with the (start, stop) rows and columns of the tile
+    # meters: the width and heigh of each grid
+    # crs: the CRS of the grids (meters)
+    # crs_out: the CRS the grids are reprojected to (None for no reprojection)
+    # margin: extra space added around the bounding box (in the units of crs_out)
+    
+    outputs
+    # envelope: a Polygon that contains every grid of the tile
+    '''
+    
+    tile_box = shapely.box(x_grids[tile['cols'][0]], y_grids[tile['rows'][0]],
+                           x_grids[tile['cols'][1]], y_grids[tile['rows'][1]])
+    
+    ## add the grid corners along the edges, so that the reprojected box contains all grids
+    if crs_out is not None:
+        tile_box = reproject.transform_shapes(shapely.segmentize(tile_box, meters), crs, crs_out)
+    
+    return(shapely.box(*shapely.bounds(tile_box)).buffer(margin, join_style = 'mitre'))
+
+def subset_layer(tree, shapes, envelope):
+    '''
+    purpose
+    # the shapes of a layer that intersect an envelope
+    
+    inputs
+    # tree: an STRtree of the shapes
+    # shapes: a series of shapes, or a points.PointStore
+    # envelope: the Polygon to select shapes with
+    
+    outputs
+    # shapes_subset: a series with the shapes that intersect the envelope (keeps the index), or a PointStore
+    '''
+    
+    shape_pos = np.sort(tree.query(envelope, predicate = 'intersects'))
+    
+    if isinstance(shapes, points.PointStore):
+        return(shapes.subset(shape_pos))
+    
+    return(shapes.iloc[shape_pos])
+
+def layer_tree(shapes):
+    '''
+    purpose
+    # an STRtree of a layer of shapes
+    
+    inputs
+    # shapes: a series of shapes, or a points.PointStore
+    
+    outputs
+    # tree: an STRtree
+    '''
+    
+    if isinstance(shapes, points.PointStore):
+        return(STRtree(shapes.shapes()))
+    
+    return(STRtree(np.asarray(shapes.values)))
+
+def empty_eas():
+    '''
+    purpose
+    # an empty dataframe with the columns of the EAs returned by build_tile
+    
+    inputs - none
+    
+    outputs
+    # eas: an empty dataframe
+    '''
+    
+    return(pd.DataFrame({'shape': pd.Series([], dtype = object), 'row': pd.Series([], dtype = np.int64),
+                         'col': pd.Series([], dtype = np.int64), 'bd_layers': pd.Series([], dtype = object)}))
+
+def split_cells(cells, boundaries, line_layers, crs, crs_out, tolerance = 1e-6):
+    '''
+    purpose
+    # reproject, trim and split a set of grids into EAs
+    
+    inputs
+    # cells: a dataframe with grids in crs (shape, row, col)
+    # boundaries: a series with the study area in crs_out
+    # line_layers: a dictionary with the layer name as key and a series of lines (in crs_out) as value
+    # crs: the CRS of the grids (meters)
+    # crs_out: the CRS of the EAs (None to keep crs)
+    # tolerance: the width of the buffer around each line (in the units of crs_out)
+    
+    outputs
+    # eas: a dataframe with the EAs of the grids (shape, row, col, bd_layers)
+    '''
+    
+    if cells.shape[0] == 0:
+        return(empty_eas())
+    
+    cells = cells.reset_index(drop = True)
+    
+    ## convert to the output CRS
+    if crs_out is not None:
+        cells['shape'] = reproject.transform_shapes(cells['shape'], src_crs = crs, dst_crs = crs_out)
+    
+    ## trim the grids so that they are all within the study area
+    grids_trim = clean_data.split_grids_polygon_index(grids = cells['shape'], boundaries = boundaries)
+    grids_trim['row'] = cells['row'].values[grids_trim['index'].values]
+    grids_trim['col'] = cells['col'].values[grids_trim['index'].values]
+    grids_trim['index'] = np.array(range(0, grids_trim.shape[0])) # index with row position
+    
+    ## trim the grids so that they do not overlap any lines
+    eas = clean_data.split_grids_lines(grids = grids_trim, shape_name = 'shape', index_name = 'index',
+                                       boundary_layers = line_layers, tolerance = tolerance)
+    
+    return(eas[['shape', 'row', 'col', 'bd_layers']])
+
+def build_tile(task):
+    '''
+    purpose
+    # create, reproject, trim and split the grids of one tile
+    
+    inputs
+    # task: a dictionary with the study area (in crs and crs_out) and lines of the tile, and the grid settings
+    
+    outputs
+    # eas: a dataframe with the EAs of the tile (shape, row, col, bd_layers)
+    '''
+    
+    ## create grids
+    cells = clean_data.create_grids_box(shape = task['study_area'], meters = task['meters'],
+                                        origin = task['origin'], clip = True,
+                                        rows = task['rows'], cols = task['cols'])
+    
+    return(split_cells(cells = cells, boundaries = task['boundaries'], line_layers = task['line_layers'],
+                       crs = task['crs'], crs_out = task['crs_out'], tolerance = task['tolerance']))
+
+def build_eas(study_area, meters, line_layers = {}, crs = 'epsg:32735', crs_out = 'epsg:4326',
+              tolerance = 1e-6, tile_cells = None, workers = 1, origin = None):
+    '''
+    purpose
+    # divide the study area into EAs: create grids, trim them to the study area and split them by lines, tile by tile
+    
+    inputs
+    # study_area: the shape of the study area in crs (meters)
+    # meters: the width and heigh of each grid
+    # line_layers: a dictionary with the layer name as key and a series of lines (in crs_out) as value
+    # crs: the CRS of the study area, used to create the grids
+    # crs_out: the CRS of the EAs, lines and population data (None to keep crs)
+    # tolerance: the width of the buffer around each line (in the units of crs_out)
+    # tile_cells: the width and heigh of each tile in grids (None for a single tile)
+    # workers: the number of processes to use
+    # origin: the lower left corner of the grids, defaults to the same corner as create_grids (see clean_data.grid_origin)
+    
+    outputs
+    # eas: a dataframe with the EAs (index, shape, row, col, piece, bd_layers), ordered by grid row, column and piece
+    '''
+    
+    if origin is None:
+        origin = clean_data.grid_origin(study_area, meters)
+    
+    x_grids, y_grids = clean_data.grid_lines(shape = study_area, meters = meters, origin = origin)
+    
+    study_area_out = study_area if crs_out is None else reproject.transform_shapes(study_area, crs, crs_out)
+    
+    ## index the lines once
+    line_trees = {x: STRtree(np.asarray(line_layers[x].values)) for x in line_layers}
+    
+    ## one task for each tile, with only the part of the study area and lines within the tile
+    tasks = []
+    
+    for tile in tile_ranges(n_rows = len(y_grids) - 1, n_cols = len(x_grids) - 1, tile_cells = tile_cells):
+        envelope = tile_envelope(x_grids = x_grids, y_grids = y_grids, tile = tile,
+                                 meters = meters, crs = crs, crs_out = crs_out)
+    
+        tile_box = shapely.box(x_grids[tile['cols'][0]], y_grids[tile['rows'][0]],
+                               x_grids[tile['cols'][1]], y_grids[tile['rows'][1]])
+    
+        if study_area.intersects(tile_box) == False:
+            continue
+    
+        tasks.append({'study_area': study_area.intersection(tile_box),
+                      'boundaries': pd.Series([study_area_out.intersection(envelope)]),
+                      'line_layers': {x: subset_layer(line_trees[x], line_layers[x], envelope) for x in line_layers},
+                      'meters': meters, 'origin': origin, 'rows': tile['rows'], 'cols': tile['cols'],
+                      'crs': crs, 'crs_out': crs_out, 'tolerance': tolerance})
+    
+    ## stitch the tiles together, every grid belongs to exactly one tile
+    tile_eas = run_tasks(build_tile, tasks, workers = workers)
+    eas = pd.concat([x for x in tile_eas if x.shape[0] > 0] + [empty_eas()], ignore_index = True)
+    
+    return(order_eas(eas))
+
+def order_eas(eas):
+    '''
+    purpose
+    # number the EAs within each grid and order them by grid row, column and piece
+    
+    inputs
+    # eas: a dataframe with EAs (shape, row, col, ...), the EAs of each grid in the order they were created
+    
+    outputs
+    # eas_ordered: the EAs with the piece and index (row position) columns
+    '''
+    
+    eas = eas.drop(['index', 'piece'], axis = 1, errors = 'ignore')
+    
+    eas['piece'] = eas.groupby(['row', 'col']).cumcount()
+    eas = eas.sort_values(['row', 'col', 'piece'], kind = 'stable').reset_index(drop = True)
+    eas[['row', 'col', 'piece']] = eas[['row', 'col', 'piece']].astype(np.int64)
+    eas.insert(0, 'index', np.array(range(0, eas.shape[0]))) # index with row position
+    
+    return(eas)
+
+def count_tile(task):
+    '''
+    purpose
+    # count the population shapes/points within the EAs of one tile
+    
+    inputs
+    # task: a dictionary with the EA shapes of the tile, the population layers within the tile, limit_check,
+    ## and the origin and meters of the grids if the EAs are grid boxes in a projected CRS (None otherwise)
+    
+    outputs
+    # counts: a dataframe with the count columns of all layers (same index as the EA shapes)
+    '''
+    
+    counts = []
+    
+    for append_names, (check_shapes, check_shape) in task['count_layers'].items():
+    
+        ## points in projected grids - the grid of each point is found by floor division (see clean_data.count_within_grid_binned)
+        if (check_shape == False) and (task['origin'] is not None):
+            layer_counts = clean_data.count_within_grid_binned(
+                    grid_shapes = task['shapes'], check_shapes = check_shapes, origin = task['origin'],
+                    meters = task['meters'], append_names = append_names, limit_check = task['limit_check'])
+        else:
+            layer_counts = clean_data.count_within_grid_index(
+                    grid_shapes = task['shapes'], check_shapes = check_shapes, append_names = append_names,
+                    check_shape = check_shape, limit_check = task['limit_check'])
+    
+        counts.append(layer_counts.drop('index', axis = 1).set_index(task['shapes'].index))
+    
+    return(pd.concat(counts, axis = 1) if len(counts) > 0 else pd.DataFrame(index = task['shapes'].index))
+
+def count_eas(eas, count_layers, limit_check = 100, tile_cells = None, workers = 1, origin = None, meters = None):
+    '''
+    purpose
+    # count the population shapes/points (e.g. FB and roofs) within each EA, tile by tile
+    
+    inputs
+    # eas: a dataframe with the EAs, as returned by build_eas
+    # count_layers: a dictionary with the column suffix as key (e.g. '_fb') and (series of shapes or PointStore, check_shape) as value,
+    ## where check_shape is whether the shapes are Polygons (True) or Points (False)
+    # limit_check: the cap for the intersect_no_count columns
+    # tile_cells: the width and heigh of each tile in grids (None for a single tile)
+    # workers: the number of processes to use
+    # origin: the lower left corner of the grids, if the EAs are in the projected CRS of the grids (meters) - 
+    ## the points are then counted by floor division instead of an index (None to always use an index)
+    # meters: the width and heigh of each grid (with origin)
+    
+    outputs
+    # eas_count: the EAs with the intersect_count, intersect_no_count and intersect columns of each layer
+    '''
+    
+    ## index the population layers once
+    layer_trees = {x: layer_tree(count_layers[x][0]) for x in count_layers}
+    
+    ## group the EAs by tile
+    if tile_cells is None:
+        tile_key = np.zeros(eas.shape[0], dtype = np.int64)
+    else:
+        tile_key = (eas['row'].values // tile_cells) * (eas['col'].max() // tile_cells + 1) + eas['col'].values // tile_cells
+    
+    tasks = []
+    
+    for key, tile_eas in eas.groupby(tile_key, sort = True):
+        envelope = shapely.box(*shapely.total_bounds(tile_eas['shape'].values))
+    
+        tasks.append({'shapes': tile_eas['shape'], 'limit_check': limit_check, 'origin': origin, 'meters': meters,
+                      'count_layers': {x: (subset_layer(layer_trees[x], count_layers[x][0], envelope), count_layers[x][1])
+                                       for x in count_layers}})
+    
+    tile_counts = run_tasks(count_tile, tasks, workers = workers)
+    
+    if len(tile_counts) == 0:
+        return(eas.copy())
+    
+    counts = pd.concat(tile_counts).reindex(eas.index)
+    
+    ## each tile only sees nearby shapes, so cap intersect_no_count with the size of the whole layer
+    for append_names in count_layers:
+        counts['intersect_no_count' + append_names] = np.minimum(
+                limit_check, len(count_layers[append_names][0]) - counts['intersect_count' + append_names])
+    
+    return(pd.concat([eas, counts], axis = 1))
+
+def project_layers(line_layers, count_layers, src_crs, dst_crs):
+    '''
+    purpose
+    # reproject the line and population layers in bulk (one call per layer over all coordinates)
+    
+    inputs
+    # line_layers: a dictionary with the layer name as key and a series of lines as value
+    # count_layers: a dictionary with the column suffix as key and (series of shapes or PointStore, check_shape) as value
+    # src_crs: the CRS of the layers
+    # dst_crs: the CRS to reproject the layers to
+    
+    outputs
+    # line_layers, count_layers: the same dictionaries with the layers in dst_crs
+    '''
+    
+    line_layers = {x: reproject.transform_shapes(line_layers[x], src_crs, dst_crs) for x in line_layers}
+    
+    count_projected = {}
+    
+    for append_names, (check_shapes, check_shape) in count_layers.items():
+    
+        ## points are reprojected straight from their coordinate arrays
+        if isinstance(check_shapes, points.PointStore):
+            x, y = reproject.transform_xy(check_shapes.x, check_shapes.y, src_crs, dst_crs)
+            check_shapes = points.PointStore(x = x, y = y, attributes = check_shapes.attributes, crs = dst_crs)
+        else:
+            check_shapes = reproject.transform_shapes(check_shapes, src_crs, dst_crs)
+    
+        count_projected[append_names] = (check_shapes, check_shape)
+    
+    return(line_layers, count_projected)
+
+def segment_area(study_area, meters, line_layers = {}, count_layers = {},
+                 crs = 'epsg:32735', crs_out = 'epsg:4326', limit_check = 100,
+                 tolerance = 1e-6, tile_cells = None, workers = 1, projected = False, origin = None):
+    '''
+    purpose
+    # run the geographic segmentation: create EAs from grids, trim and split them, count the population within each EA
+    
+    inputs
+    # study_area: the shape of the study area in crs (meters)
+    # meters: the width and heigh of each grid
+    # line_layers: a dictionary with the layer name as key and a series of lines (in crs_out) as value
+    # count_layers: a dictionary with the column suffix as key and (series of shapes in crs_out, check_shape) as value
+    # crs: the CRS of the study area, used to create the grids
+    # crs_out: the CRS of the EAs, lines and population data (None to keep crs)
+    # limit_check: the cap for the intersect_no_count columns
+    # tolerance: the width of the buffer around each line (in the units of crs_out, or meters if projected)
+    # tile_cells: the width and heigh of each tile in grids (None for a single tile)
+    # workers: the number of processes to use
+    # projected: whether to do all the overlay work in crs - the lines and population layers are reprojected to crs once,
+    ## the grids are trimmed, split and counted in meters, and only the final EAs are reprojected to crs_out
+    # origin: the lower left corner of the grids, defaults to the same corner as create_grids (e.g. the origin of a 
+    ## resolution sweep, see multires.segment_resolutions)
+    
+    outputs
+    # eas: a dataframe with the EAs, their grid row/column, counts and a unique ea_id (stable for the same inputs)
+    '''
+    
+    if (projected == True) and (crs_out is not None):
+        line_layers, count_layers = project_layers(line_layers = line_layers, count_layers = count_layers,
+                                                   src_crs = crs_out, dst_crs = crs)
+    
+        eas = segment_area(study_area = study_area, meters = meters, line_layers = line_layers, count_layers = count_layers,
+                           crs = crs, crs_out = None, limit_check = limit_check, tolerance = tolerance,
+                           tile_cells = tile_cells, workers = workers, origin = origin)
+    
+        ## the only reprojection of the EAs
+        eas['shape'] = reproject.transform_shapes(eas['shape'], src_crs = crs, dst_crs = crs_out)
+    
+        return(eas)
+    
+    eas = build_eas(study_area = study_area, meters = meters, line_layers = line_layers,
+                    crs = crs, crs_out = crs_out, tolerance = tolerance,
+                    tile_cells = tile_cells, workers = workers, origin = origin)
+    
+    ## without reprojection the EAs are still in the CRS of the grids, where the points can be binned
+    count_origin = None
+    
+    if crs_out is None:
+        count_origin = clean_data.grid_origin(study_area, meters) if origin is None else origin
+    
+    eas = count_eas(eas = eas, count_layers = count_layers, limit_check = limit_check,
+                    tile_cells = tile_cells, workers = workers, origin = count_origin, meters = meters)
+    
+    eas['ea_id'] = np.array(range(1, eas.shape[0] + 1))
+    
+    return(eas)
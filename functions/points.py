@@ -0,0 +1,315 @@
+import glob
+import json
+import os
+import numpy as np
+import pandas as pd
+import shapely
+import shapefile
+
+import functions.cache as cache
+import functions.load_data as load_data
+import functions.reproject as reproject
+
+
+class PointStore:
+    '''
+    purpose
+    # hold a layer of points (e.g. FB or roofs) as float64 x/y arrays instead of a column of shapely Points
+    
+    inputs
+    # x: an array of x coordinates
+    # y: an array of y coordinates
+    # attributes: optional dictionary with the attribute name as key and an array (one value per point) as value
+    # crs: optional name of the coordinate system of the points (e.g. 'epsg:4326')
+    
+    outputs
+    # a PointStore with x, y, attributes, crs and bounds
+    '''
+    
+    def __init__(self, x, y, attributes = None, crs = None):
+        self.xy = np.column_stack([np.asarray(x, dtype = np.float64), np.asarray(y, dtype = np.float64)])
+        self.attributes = {} if attributes is None else dict(attributes)
+        self.crs = crs
+    
+    @classmethod
+    def from_xy(cls, xy, attributes = None, crs = None):
+        '''
+        purpose
+        # create a PointStore around an existing (n, 2) coordinate array without copying it (e.g. a memory map)
+    
+        inputs
+        # xy: an (n, 2) array of x and y coordinates
+        # attributes: optional dictionary of attribute arrays
+        # crs: optional name of the coordinate system of the points
+    
+        outputs
+        # store: a PointStore
+        '''
+    
+        store = cls.__new__(cls)
+        store.xy = xy
+        store.attributes = {} if attributes is None else dict(attributes)
+        store.crs = crs
+    
+        return(store)
+    
+    @classmethod
+    def from_shapes(cls, shapes, attributes = None, crs = None):
+        '''
+        purpose
+        # create a PointStore from a series of shapes (Polygons are stored as a point on their surface)
+    
+        inputs
+        # shapes: a series (or array) of shapes
+        # attributes: optional dictionary of attribute arrays
+        # crs: optional name of the coordinate system of the shapes
+    
+        outputs
+        # store: a PointStore
+        '''
+    
+        shapes = np.asarray(shapes.values if isinstance(shapes, pd.Series) else shapes)
+        points = np.where(shapely.get_type_id(shapes) == 0, shapes, shapely.point_on_surface(shapes))
+    
+        return(cls(x = shapely.get_x(points), y = shapely.get_y(points), attributes = attributes, crs = crs))
+    
+    @classmethod
+    def from_shapefile(cls, shapefiles, fields = [], chunk_size = 100000, crs = None, where = None, bbox = None):
+        '''
+        purpose
+        # create a PointStore from a shapefile, reading it chunk by chunk (see load_data.read_shp_chunks)
+    
+        inputs
+        # shapefiles: a shapefile.Reader
+        # fields: the names of the fields to keep as attributes
+        # chunk_size: the number of records read at a time
+        # crs: optional name of the coordinate system of the shapefile
+        # where: optional dictionary of attribute conditions, records that fail them are skipped while reading
+        # bbox: optional (minx, miny, maxx, maxy), only the points within it are read
+    
+        outputs
+        # store: a PointStore
+        '''
+    
+        n_points = len(shapefiles)
+        xy = np.empty((n_points, 2), dtype = np.float64)
+        attributes = {}
+        start = 0
+    
+        ## fill the arrays one chunk at a time
+        for chunk in load_data.read_shp_chunks(shapefiles, chunk_size = chunk_size, fields = list(fields),
+                                                where = where, bbox = bbox):
+            stop = start + chunk['records'].shape[0]
+    
+            if chunk['shapes'] is None:
+                xy[start:stop, 0] = chunk['x']
+                xy[start:stop, 1] = chunk['y']
+            else:
+                points = shapely.point_on_surface(chunk['shapes'])
+                xy[start:stop, 0] = shapely.get_x(points)
+                xy[start:stop, 1] = shapely.get_y(points)
+    
+            ## numpy arrays of each chunk (text fields come out as object arrays, as numpy has no pandas string dtype)
+            for field in fields:
+                attributes.setdefault(field, []).append(np.asarray(chunk['records'][field]))
+    
+            start = stop
+    
+        return(cls.from_xy(xy = xy[:start], attributes = {x: np.concatenate(attributes[x]) for x in attributes}, crs = crs))
+    
+    @classmethod
+    def load(cls, file_name, mmap = True):
+        '''
+        purpose
+        # load a PointStore saved with save, memory mapping the arrays by default
+    
+        inputs
+        # file_name: the file name used in save (without extension)
+        # mmap: whether to memory map the arrays instead of reading them into memory
+    
+        outputs
+        # store: a PointStore
+        '''
+    
+        mmap_mode = 'r' if mmap == True else None
+    
+        with open(file_name + '.json') as f:
+            meta = json.load(f)
+    
+        xy = np.load(file_name + '.npy', mmap_mode = mmap_mode)
+        attributes = {x: np.load(file_name + '_' + x + '.npy', mmap_mode = mmap_mode)
+                      for x in meta['attributes']}
+    
+        return(cls.from_xy(xy = xy, attributes = attributes, crs = meta['crs']))
+    
+    def save(self, file_name):
+        '''
+        purpose
+        # save the PointStore as .npy files that can be memory mapped (see load)
+    
+        inputs
+        # file_name: the file name without extension, e.g. data/roofs_4326
+    
+        outputs
+        # file_name.npy (coordinates), file_name_<attribute>.npy (attributes) and file_name.json (description)
+        '''
+    
+        np.save(file_name + '.npy', np.ascontiguousarray(self.xy))
+    
+        ## text attributes are saved as fixed width strings so that they can be memory mapped
+        for name, values in self.attributes.items():
+            values = np.asarray(values)
+            np.save(file_name + '_' + name + '.npy', values.astype(str) if values.dtype == object else values)
+    
+        with open(file_name + '.json', 'w') as f:
+            json.dump({'attributes': list(self.attributes.keys()), 'crs': self.crs, 'n_points': len(self)}, f)
+    
+    @staticmethod
+    def exists(file_name):
+        '''
+        purpose
+        # whether a PointStore was saved with this file name
+    
+        inputs
+        # file_name: the file name used in save (without extension)
+    
+        outputs
+        # True / False
+        '''
+    
+        return(os.path.exists(file_name + '.json') and os.path.exists(file_name + '.npy'))
+    
+    def __len__(self):
+        return(self.xy.shape[0])
+    
+    @property
+    def x(self):
+        return(self.xy[:, 0])
+    
+    @property
+    def y(self):
+        return(self.xy[:, 1])
+    
+    @property
+    def bounds(self):
+        '''
+        purpose
+        # the bounding box of the points (minx, miny, maxx, maxy)
+        '''
+    
+        if len(self) == 0:
+            return((np.nan, np.nan, np.nan, np.nan))
+    
+        return((np.nanmin(self.x), np.nanmin(self.y), np.nanmax(self.x), np.nanmax(self.y)))
+    
+    def shapes(self):
+        '''
+        purpose
+        # the points as an array of shapely Points (created on request, not stored)
+        '''
+    
+        return(shapely.points(self.x, self.y))
+    
+    def to_series(self):
+        '''
+        purpose
+        # the points as a series of shapely Points, as used by the original functions
+        '''
+    
+        return(pd.Series(self.shapes()))
+    
+    def to_crs(self, crs):
+        '''
+        purpose
+        # the points reprojected to another CRS, in one call over the coordinate arrays (see reproject.transform_xy)
+    
+        inputs
+        # crs: the CRS to reproject the points to (the points must have a crs)
+    
+        outputs
+        # store: a PointStore in crs
+        '''
+    
+        x, y = reproject.transform_xy(self.x, self.y, src_crs = self.crs, dst_crs = crs)
+    
+        return(PointStore(x = x, y = y, attributes = self.attributes, crs = crs))
+    
+    def others(self):
+        '''
+        purpose
+        # the attributes as a dataframe (e.g. for the check_others input of count_within_grid)
+        '''
+    
+        return(pd.DataFrame({x: np.asarray(self.attributes[x]) for x in self.attributes}))
+    
+    def subset(self, keep):
+        '''
+        purpose
+        # a new PointStore with only some of the points
+    
+        inputs
+        # keep: a boolean mask or array of positions of the points to keep
+    
+        outputs
+        # store: a PointStore
+        '''
+    
+        return(PointStore.from_xy(xy = self.xy[keep], crs = self.crs,
+                                  attributes = {x: np.asarray(self.attributes[x])[keep] for x in self.attributes}))
+
+
+def load_points(file_name, directory = 'cache', fields = None, crs = None, where = None, clip = None):
+    '''
+    purpose
+    # read a point layer (e.g. roofs) into a PointStore and save it as .npy files, which later runs memory map
+    # instead of reading the shapefile - the files are named by a hash of the shapefile and the settings below,
+    # so a changed shapefile is read again (and the copy saved for its old version is removed)
+    
+    inputs
+    # file_name: the path of the shapefile
+    # directory: the folder for the saved PointStores
+    # fields: the names of the fields to keep as attributes (None for all fields)
+    # crs: optional name of the coordinate system of the shapefile
+    # where: optional dictionary of attribute conditions (see load_data.record_filter)
+    # clip: optional shape (e.g. the study area) in the CRS of the shapefile, only the points that intersect it are kept
+    
+    outputs
+    # store: a PointStore, memory mapped if it was saved by an earlier run
+    '''
+    
+    name = os.path.splitext(os.path.basename(file_name))[0]
+    key = cache.hash_inputs(stage = 'load_points', files = [file_name],
+                            params = {'fields': fields, 'crs': crs, 'where': where,
+                                      'clip': None if clip is None else shapely.to_wkb(clip, hex = True)},
+                            code = cache.hash_function(load_points))
+    store_file = os.path.join(directory, name + '_' + key[:16])
+    
+    if PointStore.exists(store_file):
+        return(PointStore.load(store_file, mmap = True))
+    
+    reader = shapefile.Reader(file_name)
+    fields = [x[0] for x in reader.fields[1:]] if fields is None else fields
+    
+    store = PointStore.from_shapefile(reader, fields = fields, crs = crs, where = where,
+                                      bbox = None if clip is None else clip.bounds)
+    
+    ## exact test against the clip shape
+    if clip is not None:
+        shapely.prepare(clip)
+        store = store.subset(shapely.intersects_xy(clip, store.x, store.y))
+    
+    ## remove the copies saved for older versions of the shapefile
+    for old_file in glob.glob(os.path.join(directory, name + '_' + '?' * 16 + '.json')):
+        with open(old_file) as f:
+            old_attributes = json.load(f)['attributes']
+    
+        old_file = old_file[:-len('.json')]
+    
+        for path in [old_file + '.npy', old_file + '.json'] + [old_file + '_' + x + '.npy' for x in old_attributes]:
+            if os.path.exists(path):
+                os.remove(path)
+    
+    os.makedirs(directory, exist_ok = True)
+    store.save(store_file)
+    
+    return(store)
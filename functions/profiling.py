@@ -0,0 +1,426 @@
+import cProfile
+import datetime
+import json
+import os
+import platform
+import re
+import sys
+import time
+
+## resource is only available on unix, /proc only on Linux (see _peak_rss_mb)
+try:
+    import resource
+except ImportError:
+    resource = None
+
+## pyinstrument is only needed for pyinstrument profiles of each stage
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+## the profiler that the instrumented functions report to (see Profiler.start)
+_active = None
+
+
+def _require_pyinstrument():
+    if pyinstrument is None:
+        raise ImportError('pyinstrument is required for pyinstrument profiles, install it with: pip install pyinstrument')
+
+def rss_mb(field = 'VmRSS'):
+    '''
+    purpose
+    # read the current (VmRSS) or peak (VmHWM) resident memory of this process from /proc (Linux only)
+    
+    inputs
+    # field: 'VmRSS' or 'VmHWM'
+    
+    outputs
+    # mb: the memory in MB, None if not available
+    '''
+    
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return(int(line.split()[1]) / 1024)
+    except OSError:
+        return(None)
+    
+    return(None)
+
+def reset_peak_rss():
+    '''
+    purpose
+    # reset the peak resident memory (VmHWM) of this process, so that the peak only covers the current stage or
+    ## benchmark (Linux only)
+    
+    outputs
+    # reset: whether the peak could be reset
+    '''
+    
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return(True)
+    except OSError:
+        return(False)
+
+def _peak_rss_mb():
+    '''
+    purpose
+    # the peak resident memory of this process in MB: since the last reset on Linux, otherwise since the process started
+    
+    outputs
+    # mb: the memory in MB, None if not available
+    '''
+    
+    peak = rss_mb('VmHWM')
+    
+    if (peak is None) and (resource is not None):
+        ## ru_maxrss is in KB on Linux and in bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+    
+    return(peak)
+
+def count_rows(value):
+    '''
+    purpose
+    # the number of rows of the output of a stage (the first element if the stage returns several outputs)
+    
+    inputs
+    # value: the output of a stage
+    
+    outputs
+    # rows: the number of rows, None if the output has no length
+    '''
+    
+    if isinstance(value, tuple) and (len(value) > 0):
+        value = value[0]
+    
+    try:
+        return(len(value))
+    except TypeError:
+        return(None)
+
+def _format_seconds(seconds):
+    return(str(datetime.timedelta(seconds = int(round(seconds)))))
+
+
+def count(name, n = 1):
+    '''
+    purpose
+    # add to a counter of geometry predicate or overlay calls (e.g. 'intersects', 'difference') in the current stage
+    # does nothing when no profiler is running, so the instrumented functions cost the same as before
+    
+    inputs
+    # name: the name of the counter
+    # n: the number of calls (e.g. the length of a vectorized call)
+    
+    outputs - none
+    '''
+    
+    if _active is not None:
+        _active.count(name, n)
+
+def progress(iterable, total = None, label = ''):
+    '''
+    purpose
+    # report the progress and ETA of a long loop to the running profiler (the iterable is returned as it is when no profiler is running)
+    
+    inputs
+    # iterable: the items of the loop
+    # total: the number of items (defaults to len(iterable))
+    # label: the name shown with the progress, e.g. the function name
+    
+    outputs
+    # an iterable of the same items
+    '''
+    
+    if (_active is None) or (_active.progress_seconds is None):
+        return(iterable)
+    
+    return(_active.progress(iterable, total = total, label = label))
+
+
+class Profiler:
+    '''
+    purpose
+    # record the wall time, peak resident memory, rows in and out, and geometry predicate / overlay counts of each pipeline stage,
+    # show progress with an ETA for long loops, optionally profile each stage with cProfile or pyinstrument,
+    # and write everything as a JSON run report
+    
+    inputs
+    # report_file: the path of the JSON run report (None to only keep the report in memory)
+    # profile: None, 'cprofile' or 'pyinstrument' to profile each stage
+    # profile_directory: the folder for the profile of each stage
+    # progress_seconds: the seconds between progress lines of long loops (None for no progress)
+    
+    outputs
+    # a Profiler
+    
+    notes
+    # the functions in clean_data report their counters and loops to the profiler that was started last (see start)
+    '''
+    
+    def __init__(self, report_file = None, profile = None, profile_directory = 'profiles', progress_seconds = 10):
+        if profile not in [None, 'cprofile', 'pyinstrument']:
+            raise ValueError("profile must be None, 'cprofile' or 'pyinstrument'")
+    
+        if profile == 'pyinstrument':
+            _require_pyinstrument()
+    
+        self.report_file = report_file
+        self.profile = profile
+        self.profile_directory = profile_directory
+        self.progress_seconds = progress_seconds
+    
+        self.started = None
+        self.stages = []
+        self.counters = {}
+        self._open = []
+    
+    def start(self):
+        '''
+        purpose
+        # make this the profiler that the instrumented functions report to
+    
+        outputs
+        # profiler: the same profiler, e.g. profiler = profiling.Profiler(...).start()
+        '''
+    
+        global _active
+    
+        _active = self
+        self.started = time.perf_counter()
+        self.created = datetime.datetime.now().isoformat(timespec = 'seconds')
+    
+        return(self)
+    
+    def stop(self):
+        '''
+        purpose
+        # stop reporting to this profiler, and write the run report if there is a report_file
+    
+        outputs
+        # report: the run report (see report)
+        '''
+    
+        global _active
+    
+        if _active is self:
+            _active = None
+    
+        report = self.report()
+    
+        if self.report_file is not None:
+            self.write(self.report_file)
+    
+        return(report)
+    
+    def __enter__(self):
+        return(self.start())
+    
+    def __exit__(self, *args):
+        self.stop()
+    
+    def count(self, name, n = 1):
+        ## counters go to the innermost open stage, and to the totals of the run
+        if len(self._open) > 0:
+            counters = self._open[-1]['counters']
+            counters[name] = counters.get(name, 0) + int(n)
+    
+        self.counters[name] = self.counters.get(name, 0) + int(n)
+    
+    def _update_peaks(self):
+        ## the peak since the last reset belongs to every open stage
+        peak = _peak_rss_mb()
+    
+        for record in self._open:
+            if (peak is not None) and ((record['rss_peak_mb'] is None) or (peak > record['rss_peak_mb'])):
+                record['rss_peak_mb'] = peak
+    
+    def stage(self, name, rows_in = None):
+        '''
+        purpose
+        # measure a stage of the pipeline, e.g.
+        ## with profiler.stage('export_shapefile', rows_in = len(df)) as record:
+        ##     ...
+        ##     record['rows_out'] = ...
+    
+        inputs
+        # name: the name of the stage
+        # rows_in: the number of rows going into the stage
+    
+        outputs
+        # a context manager that yields the record of the stage (a dictionary that can hold extra information)
+        '''
+    
+        return(_StageContext(self, name, rows_in))
+    
+    def run(self, name, function, rows_in = None):
+        '''
+        purpose
+        # run a stage and measure it, with the rows out taken from its output
+    
+        inputs
+        # name: the name of the stage
+        # function: a function without inputs that runs the stage, e.g. lambda: clean_data.create_grids(...)
+        # rows_in: the number of rows going into the stage
+    
+        outputs
+        # value: the output of the stage
+        '''
+    
+        with self.stage(name, rows_in = rows_in) as record:
+            value = function()
+            record['rows_out'] = count_rows(value)
+    
+        return(value)
+    
+    def progress(self, iterable, total = None, label = ''):
+        '''
+        purpose
+        # yield the items of a loop, and print the progress and ETA every progress_seconds
+    
+        inputs
+        # iterable: the items of the loop
+        # total: the number of items (defaults to len(iterable))
+        # label: the name shown with the progress
+    
+        outputs
+        # a generator of the same items
+        '''
+    
+        if total is None:
+            total = count_rows(iterable)
+    
+        start = time.perf_counter()
+        last = start
+        done = 0
+    
+        for item in iterable:
+            yield item
+            done += 1
+    
+            now = time.perf_counter()
+    
+            if now - last >= self.progress_seconds:
+                last = now
+                elapsed = now - start
+    
+                if total:
+                    eta = elapsed / done * (total - done)
+                    print('%s: %d/%d (%.0f%%), %s elapsed, ETA %s' % (label, done, total, 100 * done / total,
+                                                                       _format_seconds(elapsed), _format_seconds(eta)),
+                          file = sys.stderr, flush = True)
+                else:
+                    print('%s: %d done, %s elapsed' % (label, done, _format_seconds(elapsed)), file = sys.stderr, flush = True)
+    
+    def report(self):
+        '''
+        purpose
+        # the run report
+    
+        outputs
+        # report: a dictionary with the environment, the totals of the run and a record per stage
+        '''
+    
+        return({'created': getattr(self, 'created', None),
+                'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+                'seconds': None if self.started is None else time.perf_counter() - self.started,
+                'rss_peak_mb': _peak_rss_mb() if len(self.stages) == 0 else max([x['rss_peak_mb'] or 0 for x in self.stages]),
+                'counters': dict(self.counters),
+                'stages': list(self.stages)})
+    
+    def write(self, file_name):
+        '''
+        purpose
+        # write the run report as JSON
+    
+        inputs
+        # file_name: the path of the report, e.g. data/run_report.json
+    
+        outputs
+        # a JSON file
+        '''
+    
+        if os.path.dirname(file_name) != '':
+            os.makedirs(os.path.dirname(file_name), exist_ok = True)
+    
+        with open(file_name, 'w') as f:
+            json.dump(self.report(), f, indent = 2, default = str)
+
+
+class _StageContext:
+    '''
+    purpose
+    # the context manager returned by Profiler.stage
+    '''
+    
+    def __init__(self, profiler, name, rows_in):
+        self.profiler = profiler
+        self.record = {'stage': name, 'rows_in': rows_in, 'rows_out': None, 'seconds': None,
+                       'rss_start_mb': None, 'rss_peak_mb': None, 'counters': {}}
+        self.profile = None
+    
+    def __enter__(self):
+        profiler = self.profiler
+    
+        ## the peak so far belongs to the stages that are already open, then the peak is reset for this stage
+        profiler._update_peaks()
+        self.record['rss_peak_scope'] = 'stage' if reset_peak_rss() else 'process'
+        self.record['rss_start_mb'] = rss_mb('VmRSS')
+    
+        profiler._open.append(self.record)
+    
+        if profiler.profile == 'cprofile':
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        elif profiler.profile == 'pyinstrument':
+            self.profile = pyinstrument.Profiler()
+            self.profile.start()
+    
+        self.start = time.perf_counter()
+    
+        return(self.record)
+    
+    def __exit__(self, error_type, error, traceback):
+        profiler = self.profiler
+        self.record['seconds'] = time.perf_counter() - self.start
+    
+        if self.profile is not None:
+            self.record['profile_file'] = self._save_profile()
+    
+        profiler._update_peaks()
+        profiler._open.remove(self.record)
+    
+        if error_type is not None:
+            self.record['error'] = '%s: %s' % (error_type.__name__, error)
+    
+        profiler.stages.append(self.record)
+    
+        ## write the report after each stage, so that a run that crashes or is stopped still leaves a report
+        if profiler.report_file is not None:
+            profiler.write(profiler.report_file)
+    
+        return(False)
+    
+    def _save_profile(self):
+        profiler = self.profiler
+        os.makedirs(profiler.profile_directory, exist_ok = True)
+    
+        base = os.path.join(profiler.profile_directory, '%02d_%s' % (len(profiler.stages) + 1, re.sub(r'[^\w.-]', '_', self.record['stage'])))
+    
+        if profiler.profile == 'cprofile':
+            self.profile.disable()
+            self.profile.dump_stats(base + '.prof')
+    
+            return(base + '.prof')
+    
+        self.profile.stop()
+    
+        with open(base + '.html', 'w') as f:
+            f.write(self.profile.output_html())
+    
+        return(base + '.html')
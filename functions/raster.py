@@ -0,0 +1,146 @@
+import numpy as np
+import pandas as pd
+import shapely
+from shapely import STRtree
+
+import functions.clean_data as clean_data
+import functions.reproject as reproject
+
+## rasterio is only needed for raster inputs (e.g. the FB population GeoTIFF)
+try:
+    import rasterio
+    import rasterio.errors
+    import rasterio.features
+    import rasterio.windows
+except ImportError:
+    rasterio = None
+
+
+def _require_rasterio():
+    if rasterio is None:
+        raise ImportError('rasterio is required for raster inputs, install it with: pip install rasterio')
+
+def raster_windows(dataset, bounds, window_rows = 1024):
+    '''
+    purpose
+    # the windows (bands of rows) of a raster that cover a bounding box, so that only one band is read at a time
+    
+    inputs
+    # dataset: an open rasterio dataset
+    # bounds: the bounding box to cover (minx, miny, maxx, maxy) in the CRS of the raster
+    # window_rows: the number of raster rows in each window
+    
+    outputs
+    # windows: a list of rasterio windows (empty if the box does not overlap the raster)
+    '''
+    
+    full = rasterio.windows.Window(0, 0, dataset.width, dataset.height)
+    
+    try:
+        area = rasterio.windows.from_bounds(*bounds, transform = dataset.transform)
+        area = area.round_offsets(op = 'floor').round_lengths(op = 'ceil').intersection(full)
+    except rasterio.errors.WindowError:
+        return([])
+    
+    row_start, col_start = int(area.row_off), int(area.col_off)
+    n_rows, n_cols = int(area.height), int(area.width)
+    
+    return([rasterio.windows.Window(col_start, x, n_cols, min(window_rows, row_start + n_rows - x))
+            for x in range(row_start, row_start + n_rows, window_rows)])
+
+def zonal_sum(grid_shapes, raster_file, band = 1, grid_crs = None, window_rows = 1024):
+    '''
+    purpose
+    # sum the pixel values of a raster (e.g. the FB population density GeoTIFF) within each grid
+    # the raster is read window by window, and each window is rasterized into a mask of grid ids, so that
+    # every pixel is added to the grid that holds its centre in one bincount
+    
+    inputs
+    # grid_shapes: a series of grids, formatted as Polygons
+    # raster_file: the path of the raster
+    # band: the band of the raster to sum
+    # grid_crs: the CRS of the grids (None if the same as the raster)
+    # window_rows: the number of raster rows read at a time
+    
+    outputs
+    # sums: an array with the sum of the pixel values within each grid
+    # pixels: an array with the number of pixels with a value above 0 within each grid
+    # n_pixels: the number of pixels with a value above 0 in the windows that were read
+    '''
+    
+    _require_rasterio()
+    
+    grid_array = np.asarray(grid_shapes.values)
+    n_grids = len(grid_array)
+    
+    sums = np.zeros(n_grids + 1)
+    pixels = np.zeros(n_grids + 1, dtype = np.int64)
+    n_pixels = 0
+    
+    if n_grids == 0:
+        return(sums[1:], pixels[1:], n_pixels)
+    
+    with rasterio.open(raster_file) as dataset:
+    
+        ## the grids in the CRS of the raster
+        if (grid_crs is not None) and (dataset.crs is not None):
+            grid_array = reproject.transform_shapes(grid_array, grid_crs, dataset.crs.to_string())
+    
+        tree = STRtree(grid_array)
+    
+        for window in raster_windows(dataset, shapely.total_bounds(grid_array), window_rows = window_rows):
+            transform = dataset.window_transform(window)
+            window_box = shapely.box(*rasterio.windows.bounds(window, dataset.transform))
+    
+            ### only the grids that overlap this window are rasterized
+            grid_pos = tree.query(window_box, predicate = 'intersects')
+    
+            if len(grid_pos) == 0:
+                continue
+    
+            ### read the values, with no data and negative values as 0
+            values = dataset.read(band, window = window, masked = True).astype(np.float64)
+            values = np.nan_to_num(values.filled(0))
+            values[values < 0] = 0
+    
+            ### the grid id (position + 1) of each pixel, 0 if the pixel centre is outside all grids
+            mask = rasterio.features.rasterize(zip(grid_array[grid_pos], grid_pos + 1),
+                                               out_shape = (int(window.height), int(window.width)),
+                                               transform = transform, fill = 0, dtype = 'uint32')
+    
+            sums += np.bincount(mask.ravel(), weights = values.ravel(), minlength = n_grids + 1)
+            pixels += np.bincount(mask.ravel(), weights = (values > 0).ravel(), minlength = n_grids + 1).astype(np.int64)
+            n_pixels += int((values > 0).sum())
+    
+    return(sums[1:], pixels[1:], n_pixels)
+
+def count_within_grid_raster(grid_shapes, raster_file, append_names, limit_check = 100,
+                             band = 1, grid_crs = None, window_rows = 1024, value_name = 'population'):
+    '''
+    purpose
+    # count the populated pixels of a raster within each grid, and sum their values, without converting the raster to shapes
+    
+    inputs
+    # grid_shapes: a series of grids, formatted as Polygons
+    # raster_file: the path of the raster (e.g. the FB population GeoTIFF)
+    # append_names: suffix for all dataframe column names
+    # limit_check: the cap for the intersect_no_count column (kept for consistency with count_within_grid)
+    # band: the band of the raster to sum
+    # grid_crs: the CRS of the grids (None if the same as the raster)
+    # window_rows: the number of raster rows read at a time
+    # value_name: the name of the column with the summed pixel values
+    
+    outputs
+    # intersect_df: a dataframe with the same columns as count_within_grid, where each populated pixel counts as one shape,
+    ## and a column with the sum of the pixel values within each grid
+    
+    notes
+    # a pixel is added to the grid that holds its centre, so grids much smaller than a pixel may get no pixels
+    '''
+    
+    sums, pixels, n_pixels = zonal_sum(grid_shapes = grid_shapes, raster_file = raster_file, band = band,
+                                       grid_crs = grid_crs, window_rows = window_rows)
+    
+    return(clean_data._intersect_frame(grid_index = grid_shapes.index, counts = pixels, n_check = n_pixels,
+                                       append_names = append_names, limit_check = limit_check,
+                                       others = pd.DataFrame({value_name: sums})))
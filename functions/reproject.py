@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import Transformer
+
+## Transformer objects, cached per (source, destination) pair
+_transformers = {}
+
+def get_transformer(src_crs, dst_crs):
+    '''
+    purpose
+    # return a cached pyproj Transformer between two coordinate reference systems
+    
+    inputs
+    # src_crs: the source coordinate system (e.g. 'epsg:32735')
+    # dst_crs: the destination coordinate system (e.g. 'epsg:4326')
+    
+    outputs
+    # transformer: a Transformer with x/y (longitude/latitude) axis order
+    '''
+    
+    key = (str(src_crs).lower(), str(dst_crs).lower())
+    
+    if key not in _transformers:
+        _transformers[key] = Transformer.from_crs(src_crs, dst_crs, always_xy = True)
+    
+    return(_transformers[key])
+
+def transform_xy(x, y, src_crs, dst_crs):
+    '''
+    purpose
+    # reproject arrays of x and y coordinates in one call
+    
+    inputs
+    # x: an array of x coordinates (longitude for epsg: 4326)
+    # y: an array of y coordinates (latitude for epsg: 4326)
+    # src_crs: the source coordinate system
+    # dst_crs: the destination coordinate system
+    
+    outputs
+    # x_new: an array of reprojected x coordinates
+    # y_new: an array of reprojected y coordinates
+    '''
+    
+    transformer = get_transformer(src_crs, dst_crs)
+    x_new, y_new = transformer.transform(np.asarray(x, dtype = float), np.asarray(y, dtype = float))
+    
+    return(x_new, y_new)
+
+def transform_shapes(shapes, src_crs, dst_crs):
+    '''
+    purpose
+    # reproject a column of shapes in one call over all of their coordinates
+    
+    inputs
+    # shapes: a series (or array) of shapes, or a single shape
+    # src_crs: the source coordinate system
+    # dst_crs: the destination coordinate system
+    
+    outputs
+    # shapes_new: the reprojected shapes, in the same format as shapes (series keeps its index and name)
+    '''
+    
+    transformer = get_transformer(src_crs, dst_crs)
+    
+    ## all coordinates of all shapes are passed to the transformer as one array
+    def transform_coords(coords):
+        x_new, y_new = transformer.transform(coords[:, 0], coords[:, 1])
+        return(np.column_stack([x_new, y_new]))
+    
+    if isinstance(shapes, pd.Series):
+        shapes_new = shapely.transform(np.asarray(shapes.values), transform_coords)
+        return(pd.Series(shapes_new, index = shapes.index, name = shapes.name))
+    
+    return(shapely.transform(shapes, transform_coords))
@@ -0,0 +1,200 @@
+import itertools
+import json
+import os
+import numpy as np
+import pandas as pd
+import shapely
+from shapely import STRtree
+from concurrent.futures import ProcessPoolExecutor
+
+import functions.mapping as mapping
+import functions.reproject as reproject
+
+## Pillow is only needed to draw the tiles
+try:
+    from PIL import Image, ImageDraw
+except ImportError:
+    Image = None
+    ImageDraw = None
+
+## half the width of the web mercator (EPSG:3857) world in meters
+WORLD = 20037508.342789244
+
+
+def _require_pillow():
+    if Image is None:
+        raise ImportError('Pillow is required to draw tiles, install it with: pip install Pillow')
+
+def tile_bounds(x, y, zoom):
+    '''
+    purpose
+    # the bounding box of an XYZ tile in web mercator (EPSG:3857)
+    
+    inputs
+    # x, y: the column and row of the tile (row 0 at the top)
+    # zoom: the zoom level
+    
+    outputs
+    # bounds: (minx, miny, maxx, maxy) in meters
+    '''
+    
+    size = 2 * WORLD / 2 ** zoom
+    
+    return((-WORLD + x * size, WORLD - (y + 1) * size, -WORLD + (x + 1) * size, WORLD - y * size))
+
+def tile_range(bounds, zoom):
+    '''
+    purpose
+    # the columns and rows of the XYZ tiles that cover a bounding box
+    
+    inputs
+    # bounds: (minx, miny, maxx, maxy) in web mercator
+    # zoom: the zoom level
+    
+    outputs
+    # x_tiles, y_tiles: ranges of tile columns and rows
+    '''
+    
+    size = 2 * WORLD / 2 ** zoom
+    last = 2 ** zoom - 1
+    
+    x_min, x_max = [int(np.clip(np.floor((x + WORLD) / size), 0, last)) for x in [bounds[0], bounds[2]]]
+    y_min, y_max = [int(np.clip(np.floor((WORLD - y) / size), 0, last)) for y in [bounds[3], bounds[1]]]
+    
+    return(range(x_min, x_max + 1), range(y_min, y_max + 1))
+
+def draw_tile(task):
+    '''
+    purpose
+    # draw the shapes of one tile and save it as a PNG (run in a worker process)
+    
+    inputs
+    # task: a dictionary with the tile file, bounds and size, the shapes (web mercator) and their fill and line colors (RGBA 0-255)
+    
+    outputs
+    # file_name: the path of the saved tile
+    '''
+    
+    _require_pillow()
+    
+    minx, miny, maxx, maxy = task['bounds']
+    scale = task['tile_size'] / (maxx - minx)
+    
+    image = Image.new('RGBA', (task['tile_size'], task['tile_size']), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    
+    ## the rings of all shapes, in pixels, extracted at once
+    polygons, shape_pos = shapely.get_parts(task['shapes'], return_index = True)
+    rings, polygon_pos = shapely.get_rings(polygons, return_index = True)
+    
+    outer = np.r_[True, polygon_pos[1:] != polygon_pos[:-1]] if len(rings) > 0 else np.zeros(0, dtype = bool)
+    ring_shape = shape_pos[polygon_pos]
+    
+    coords = shapely.get_coordinates(rings)
+    pixels = np.column_stack([(coords[:, 0] - minx) * scale, (maxy - coords[:, 1]) * scale]).ravel().tolist()
+    ends = 2 * np.cumsum(shapely.get_num_coordinates(rings))
+    starts = np.r_[0, ends[:-1]]
+    
+    fill = [tuple(x) for x in task['fill'].tolist()]
+    line = [tuple(x) for x in task['line'].tolist()]
+    
+    ## larger shapes are drawn first, so that a shape inside the hole of another is drawn over it
+    ## and holes are cleared after the outer ring is filled
+    for i in range(len(rings)):
+        draw.polygon(pixels[starts[i]:ends[i]], fill = fill[ring_shape[i]] if outer[i] else (0, 0, 0, 0),
+                     outline = line[ring_shape[i]])
+    
+    os.makedirs(os.path.dirname(task['file_name']), exist_ok = True)
+    image.save(task['file_name'])
+    
+    return(task['file_name'])
+
+def build_tiles(shapes, categories, directory, zooms = range(8, 15), crs = 'epsg:4326',
+                colors = None, alpha = 0.6, tile_size = 256, workers = 1, batch_size = 1000):
+    '''
+    purpose
+    # rasterize EAs by category into a PNG tile pyramid (XYZ layout: directory/zoom/x/y.png), for quick offline browsing
+    # only tiles that hold an EA are written, and the tiles of each zoom level are drawn in parallel
+    
+    inputs
+    # shapes: a series of EA shapes
+    # categories: a series with the category of each EA
+    # directory: the folder of the tile pyramid, e.g. plots/tiles
+    # zooms: the zoom levels to build
+    # crs: the CRS of the shapes
+    # colors: the number of colors to spread over the rainbow colormap (None for one per category, as in mapping.loop_many_shapes)
+    # alpha: the alpha of the EA fill
+    # tile_size: the width and height of each tile in pixels
+    # workers: the number of processes to use
+    # batch_size: the number of tiles handed to the workers at a time
+    
+    outputs
+    # n_tiles: the number of tiles written
+    ## and directory/metadata.json with the bounds, zoom levels and the color of each category
+    '''
+    
+    _require_pillow()
+    
+    shapes = np.asarray(reproject.transform_shapes(np.asarray(shapes.values), crs, 'epsg:3857'))
+    categories = np.asarray(categories.values)
+    
+    ## the color of each category, as in the EA category maps
+    grouped = pd.DataFrame({'category': categories}).groupby('category', sort = False)
+    group_color = mapping.group_colors(grouped, colors = grouped.ngroups if colors is None else colors)
+    
+    rgba = {x: np.round(np.asarray(group_color[x]) * 255).astype(int) for x in group_color}
+    fill = np.array([np.r_[rgba[x][:3], int(round(alpha * 255))] for x in categories], dtype = int).reshape(-1, 4)
+    line = np.array([rgba[x] for x in categories], dtype = int).reshape(-1, 4)
+    
+    ## largest shapes first (see draw_tile)
+    order = np.argsort(-shapely.area(shapes), kind = 'stable')
+    shapes, fill, line = shapes[order], fill[order], line[order]
+    
+    tree = STRtree(shapes)
+    bounds = shapely.total_bounds(shapes)
+    
+    def tile_tasks():
+        for zoom in zooms:
+            x_tiles, y_tiles = tile_range(bounds, zoom)
+    
+            for x in x_tiles:
+                for y in y_tiles:
+                    box = tile_bounds(x, y, zoom)
+                    hits = np.sort(tree.query(shapely.box(*box), predicate = 'intersects'))
+    
+                    if len(hits) > 0:
+                        yield {'file_name': os.path.join(directory, str(zoom), str(x), str(y) + '.png'),
+                               'bounds': box, 'tile_size': tile_size,
+                               'shapes': shapes[hits], 'fill': fill[hits], 'line': line[hits]}
+    
+    ## one process pool for all tiles, fed a batch of tiles at a time so that memory stays flat at high zoom levels
+    n_tiles = 0
+    executor = ProcessPoolExecutor(max_workers = workers) if workers > 1 else None
+    
+    try:
+        tasks = tile_tasks()
+    
+        while True:
+            batch = list(itertools.islice(tasks, batch_size))
+    
+            if len(batch) == 0:
+                break
+    
+            if executor is None:
+                n_tiles += len([draw_tile(x) for x in batch])
+            else:
+                n_tiles += len(list(executor.map(draw_tile, batch)))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    
+    ## description of the pyramid, with the legend
+    lon, lat = reproject.transform_xy(bounds[[0, 2]], bounds[[1, 3]], 'epsg:3857', 'epsg:4326')
+    
+    with open(os.path.join(directory, 'metadata.json'), 'w') as f:
+        json.dump({'scheme': 'xyz', 'format': 'png', 'tile_size': tile_size,
+                   'minzoom': min(zooms), 'maxzoom': max(zooms),
+                   'bounds': [float(lon[0]), float(lat[0]), float(lon[1]), float(lat[1])],
+                   'categories': {str(x): '#%02x%02x%02x' % tuple(rgba[x][:3]) for x in rgba}}, f, indent = 2)
+    
+    return(n_tiles)
@@ -46,15 +46,19 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 
-from shapely.ops import transform
-from shapely.geometry import Point
 import shapefile
-from functools import partial
-import pyproj
 
 # import custom functions
 import functions.clean_data as clean_data
+import functions.load_data as load_data
 import functions.mapping as mapping
+import functions.reproject as reproject
+import functions.points as points
+import functions.cache as cache
+import functions.raster as raster
+import functions.columnar as columnar
+import functions.tiles as tiles
+import functions.profiling as profiling
 
 
 # ## 1) Put all the shapefiles on the map
@@ -62,56 +66,90 @@ import functions.mapping as mapping
 # In[2]:
 
 
-# read in data #
-roofs = shapefile.Reader('shapefiles/roofs_4326.shp')
-fb = shapefile.Reader('shapefiles/fb_roofs_4326.shp')
-study_area = shapefile.Reader('shapefiles/study_area_32735.shp')
-roads = shapefile.Reader('shapefiles/roads_4326.shp')
-rivers = shapefile.Reader('shapefiles/rivers_4326.shp')
+# input files #
+files = {'roofs': 'shapefiles/roofs_4326.shp',
+         'fb': 'shapefiles/fb_roofs_4326.shp',
+         'fb_raster': 'shapefiles/fb_population_4326.tif', # optional - the FB population GeoTIFF
+         'study_area': 'shapefiles/study_area_32735.shp',
+         'roads': 'shapefiles/roads_4326.shp',
+         'rivers': 'shapefiles/rivers_4326.shp'}
+
+# run report - time, peak memory, rows and geometry operations of each stage, with progress for long loops #
+# set profile = 'cprofile' (or 'pyinstrument') to also save a profile of each stage in the profiles folder
+profiler = profiling.Profiler(report_file = 'data/run_report.json', profile = None, progress_seconds = 30).start()
+
+# cache for the slow stages - a stage is only re-run when its input files or parameters change #
+stage_cache = cache.StageCache(directory = 'cache', max_bytes = 5 * 1024 ** 3, profiler = profiler)
 
 
 # In[3]:
 
 
-# create dataframes with shapefiles and records #
-df_roofs = clean_data.create_shape_df_shp(roofs)
-df_fb = clean_data.create_shape_df_shp(fb)
-df_study_area = clean_data.create_shape_df_shp(study_area)
-df_roads = clean_data.create_shape_df_shp(roads)
-df_rivers = clean_data.create_shape_df_shp(rivers)
+# read the study area and convert it to the standard long, latitude coordinate system (called epsg: 4326)
+crs_source = 'epsg:32735' # source coordinate system
+crs_destination = 'epsg:4326' # destination coordinate system
+
+df_study_area = load_data.load_layer(files['study_area'])
+
+df_study_area_32735 = df_study_area.copy() # save old study area
+df_study_area['shape'] = reproject.transform_shapes(
+        df_study_area['shape'], src_crs = crs_source, dst_crs = crs_destination)
 
 
 # In[4]:
 
 
-# convert to standard long, latitude coordinate system (called epsg: 4326)
-project = partial(
-    pyproj.transform,
-    pyproj.Proj(init='epsg:32735'), # source coordinate system
-    pyproj.Proj(init='epsg:4326')) # destination coordinate system
+# only keep major waterways and roads - these categories may need to be changed for other areas
+roads_keep = ['secondary', 'primary']
+waterway_keep = ['river', 'ocean', 'lake', 'sea']
 
-# convert study area to new CRS
-df_study_area_32735 = df_study_area.copy() # save old study area
-df_study_area.loc[0, 'shape'] = transform(project, df_study_area['shape'][0])
+# read the other layers - the categories and the study area are applied while reading, 
+# so records of other categories or outside the study area are never converted to shapes
+study_area_clip = df_study_area['shape'][0]
+
+df_roads = profiler.run('load_roads', function = lambda: load_data.load_layer(
+        files['roads'], where = {'highway': roads_keep}, clip = study_area_clip))
+df_rivers = profiler.run('load_rivers', function = lambda: load_data.load_layer(
+        files['rivers'], where = {'waterway': waterway_keep}, clip = study_area_clip))
+
+# the roofs are read into a PointStore (x/y arrays instead of shapely Points), which is saved in the cache folder:
+# later runs memory map it instead of reading the shapefile, until the shapefile changes
+roofs = profiler.run('load_roofs', function = lambda: points.load_points(
+        files['roofs'], directory = 'cache', fields = [], crs = crs_destination, clip = study_area_clip))
+
+# with the FB GeoTIFF the FB population is counted from the raster (see In[17]), so the FB shapefile is not read
+fb_raster = os.path.exists(files['fb_raster'])
+
+# FB points are read into a PointStore like the roofs, FB polygons are counted by intersection and split by area,
+# so they are kept as shapes
+if fb_raster == False:
+    fb_check_shape = shapefile.Reader(files['fb']).shapeType not in load_data.POINT_TYPES
+    
+    if fb_check_shape == True:
+        df_fb = profiler.run('load_fb', function = lambda: load_data.load_layer(files['fb'], clip = study_area_clip))
+        fb_shapes, df_fb_values = df_fb['shape'], df_fb.drop('shape', axis = 1)
+    else:
+        fb_shapes = profiler.run('load_fb', function = lambda: points.load_points(
+                files['fb'], directory = 'cache', crs = crs_destination, clip = study_area_clip))
+        df_fb_values = fb_shapes.others()
 
 
 # In[5]:
 
 
 # separate multiline strings
-df_roads_int = clean_data.split_multiline(df = df_roads, shape_name = 'shape')
-df_rivers_int = clean_data.split_multiline(df = df_rivers, shape_name = 'shape')
+df_roads_int = profiler.run('split_multiline_roads', rows_in = len(df_roads),
+        function = lambda: clean_data.split_multiline(df = df_roads, shape_name = 'shape'))
+df_rivers_int = profiler.run('split_multiline_rivers', rows_in = len(df_rivers),
+        function = lambda: clean_data.split_multiline(df = df_rivers, shape_name = 'shape'))
 
 
 # In[6]:
 
 
-# only keep major waterways and roads - these categories may need to be changed for other areas
-roads_keep = ['secondary', 'primary']
-waterway_keep = ['river', 'ocean', 'lake', 'sea']
-
-df_roads_final = df_roads_int[df_roads_int['highway'].isin(roads_keep)]
-df_rivers_final = df_rivers_int[df_rivers_int['waterway'].isin(waterway_keep)]
+# the roads and rivers were already filtered to the major categories when read
+df_roads_final = df_roads_int
+df_rivers_final = df_rivers_int
 
 
 # In[7]:
@@ -149,14 +187,44 @@ plt.show()
 
 
 # create grids/EAs #
-df_grids = clean_data.create_grids(shape = df_study_area_32735['shape'][0], meters = 500)
+meters = 500 # width and height of each grid
+
+# trim, split and count the grids in the metric CRS of the study area, and only reproject the final EAs to long/lat
+# (set projected to False to do this work in long/lat instead - the tolerance is then in degrees)
+projected = True
+crs_work = crs_source if projected else crs_destination
+tolerance = 0.1 if projected else 1e-6 # width of the buffer around roads and rivers (meters if projected, otherwise degrees)
+origin = clean_data.grid_origin(shape = df_study_area_32735['shape'][0], meters = meters) # lower left corner of the grids
+
+# the grids are built directly as boxes, with the row and column of each grid
+df_grids, grids_key = stage_cache.run(
+        stage = 'create_grids', files = [files['study_area']], params = {'meters': meters, 'origin': origin},
+        function = lambda: clean_data.create_grids_box(shape = df_study_area_32735['shape'][0], meters = meters, origin = origin))
 
 
 # In[9]:
 
 
-# convert to long/lat CRS #
-df_grids['shape'] = df_grids['shape'].apply(lambda x: transform(project, x))
+if projected == True:
+    # convert the study area, roads, rivers and population layers to the metric CRS once - the grids are not reprojected #
+    df_study_area_work = df_study_area_32735
+    roads_work, rivers_work = [reproject.transform_shapes(x, src_crs = crs_destination, dst_crs = crs_source)
+                               for x in [df_roads_final['shape'], df_rivers_final['shape']]]
+    roofs_work = roofs.to_crs(crs_source)
+    
+    if fb_raster == False:
+        fb_work = fb_shapes.to_crs(crs_source) if fb_check_shape == False else reproject.transform_shapes(
+                fb_shapes, src_crs = crs_destination, dst_crs = crs_source)
+else:
+    # convert the grids to long/lat CRS #
+    df_grids['shape'] = reproject.transform_shapes(
+            df_grids['shape'], src_crs = crs_source, dst_crs = crs_destination)
+    
+    df_study_area_work = df_study_area
+    roads_work, rivers_work, roofs_work = df_roads_final['shape'], df_rivers_final['shape'], roofs
+    
+    if fb_raster == False:
+        fb_work = fb_shapes
 
 
 # In[10]:
@@ -165,54 +233,39 @@ df_grids['shape'] = df_grids['shape'].apply(lambda x: transform(project, x))
 # trim the grids so that they are all within the study area
 df_grids.reset_index(inplace = True)
 
-df_grids_trim = clean_data.split_grids_polygon(
-        grids = df_grids['shape'], boundaries = df_study_area['shape'])
+df_grids_trim, trim_key = stage_cache.run(
+        stage = 'split_grids_polygon', files = [files['study_area']], parents = [grids_key], rows_in = len(df_grids),
+        params = {'crs': crs_work},
+        function = lambda: clean_data.split_grids_polygon_index(
+                grids = df_grids['shape'], boundaries = df_study_area_work['shape']))
 
 
 # In[11]:
 
 
-# trim the grids so that they do not overlap roads
-df_grids_road_trim = clean_data.split_grids_line(
-        grids = df_grids_trim, shape_name = 'shape', 
-        index_name = 'index', boundaries = df_roads_final['shape']) # roads
-
-
-# In[12]:
-
-
-# merge the two sets of grids and remove the duplicates
-df_grids_int = df_grids_road_trim.append(
-        df_grids_trim[~df_grids_trim['index'].isin(df_grids_road_trim['bd_index'])])
-
-df_grids_int['index'] = np.array(range(0, df_grids_int.shape[0])) # index with row position
-
-
-# In[13]:
+# trim the grids so that they do not overlap roads or rivers, and merge with the grids that were not split
+df_grids_final, split_key = stage_cache.run(
+        stage = 'split_grids_line', files = [files['roads'], files['rivers']], parents = [trim_key],
+        params = {'roads_keep': roads_keep, 'waterway_keep': waterway_keep, 'crs': crs_work, 'tolerance': tolerance}, 
+        rows_in = len(df_grids_trim),
+        function = lambda: clean_data.split_grids_lines(
+                grids = df_grids_trim, shape_name = 'shape', index_name = 'index', tolerance = tolerance,
+                boundary_layers = {'roads': roads_work, 'rivers': rivers_work})) # roads and rivers
 
+# the EAs in long/lat for the maps and output files - with projected = True this is the only reprojection of the EAs
+eas_4326 = df_grids_final['shape']
 
-# trim the grids so that they do not overlap rivers
-df_grids_rivers_trim = clean_data.split_grids_line(
-        grids = df_grids_int, shape_name = 'shape', 
-        index_name = 'index', boundaries = df_rivers_final['shape']) # rivers
-
-
-# In[14]:
-
-
-# merge the two sets of grids and remove the duplicates
-df_grids_final = df_grids_rivers_trim.append(
-        df_grids_int[~df_grids_int['index'].isin(df_grids_rivers_trim['bd_index'])])
-
-df_grids_final['index'] = np.array(range(0, df_grids_final.shape[0])) # index with row position
+if projected == True:
+    eas_4326 = reproject.transform_shapes(df_grids_final['shape'], src_crs = crs_source, dst_crs = crs_destination)
 
 
 # In[15]:
 
 
 # save grids shapefile
-clean_data.export_shapefile(df = df_grids_final, shape_name = 'shape', 
-                            field_names = [['index', 'N']], file_name = 'shapefiles/grids_intermediate_4326')
+with profiler.stage('export_grids_intermediate', rows_in = len(df_grids_final)):
+    clean_data.export_shapefile_bulk(df = df_grids_final.assign(shape = eas_4326), shape_name = 'shape', 
+                                     field_names = [['index', 'N']], file_name = 'shapefiles/grids_intermediate_4326')
 
 
 # In[16]:
@@ -225,7 +278,7 @@ fig, ax = mapping.plot_set_up(plot_title = 'Map of EAs after Trimming with Bound
                       plot_aspect = 'equal')
 
 # map all grids 
-mapping.shape_plot_df(axis = ax, shapes = df_grids_final['shape'], include_label = True, 
+mapping.shape_plot_df(axis = ax, shapes = eas_4326, include_label = True, 
                       label_name = 'Enumeration Areas', alpha = 0.2, color = 'grey')
 
 # finish plot
@@ -243,14 +296,42 @@ plt.show()
 # In[17]:
 
 
-# count number of FB roofs and roofs in each grid
-grid_fb = clean_data.count_within_grid(
-        grid_shapes = df_grids_final['shape'], check_shapes = df_fb['shape'], 
-        append_names = '_fb', check_shape = True, limit_check = 100)
-
-grid_roof = clean_data.count_within_grid(
-        grid_shapes = df_grids_final['shape'], check_shapes = df_roofs['shape'], 
-        append_names = '_roof', check_shape = False, limit_check = 100)
+# count number of FB roofs and roofs in each grid (using a spatial index)
+limit_check = 100
+
+# with the FB GeoTIFF the populated pixels are counted and summed directly, without converting the raster to shapes
+if fb_raster == True:
+    grid_fb, fb_key = stage_cache.run(
+            stage = 'count_within_grid_raster', files = [files['fb_raster']], parents = [split_key],
+            params = {'append_names': '_fb', 'limit_check': limit_check}, rows_in = len(df_grids_final),
+            function = lambda: raster.count_within_grid_raster(
+                    grid_shapes = df_grids_final['shape'], raster_file = files['fb_raster'], 
+                    append_names = '_fb', limit_check = limit_check, grid_crs = crs_work))
+else:
+    grid_fb, fb_key = stage_cache.run(
+            stage = 'count_within_grid_fb', files = [files['fb']], parents = [split_key],
+            params = {'append_names': '_fb', 'check_shape': fb_check_shape, 'limit_check': limit_check}, rows_in = len(df_grids_final),
+            function = lambda: clean_data.count_within_grid_index(
+                    grid_shapes = df_grids_final['shape'], check_shapes = fb_work, 
+                    append_names = '_fb', check_shape = fb_check_shape, limit_check = limit_check))
+
+# with projected grids the grid of each roof is found by floor division, 
+# and only the roofs in grids cut by the study area, roads or rivers are tested against the EA shapes
+if projected == True:
+    grid_roof, roof_key = stage_cache.run(
+            stage = 'count_within_grid_roof', files = [files['roofs']], parents = [split_key],
+            params = {'append_names': '_roof', 'origin': origin, 'meters': meters, 'limit_check': limit_check}, 
+            rows_in = len(df_grids_final),
+            function = lambda: clean_data.count_within_grid_binned(
+                    grid_shapes = df_grids_final['shape'], check_shapes = roofs_work, origin = origin, meters = meters,
+                    append_names = '_roof', limit_check = limit_check))
+else:
+    grid_roof, roof_key = stage_cache.run(
+            stage = 'count_within_grid_roof', files = [files['roofs']], parents = [split_key],
+            params = {'append_names': '_roof', 'check_shape': False, 'limit_check': limit_check}, rows_in = len(df_grids_final),
+            function = lambda: clean_data.count_within_grid_index(
+                    grid_shapes = df_grids_final['shape'], check_shapes = roofs_work, 
+                    append_names = '_roof', check_shape = False, limit_check = limit_check))
 
 grid_fb.to_csv('data/grid_fb.csv')
 grid_roof.to_csv('data/grid_roofs.csv')
@@ -259,28 +340,43 @@ grid_roof.to_csv('data/grid_roofs.csv')
 # In[18]:
 
 
-# read in data (since the previous analysis takes a long time)
-df_grids_final = clean_data.create_shape_df_shp(
-    shapefile.Reader('shapefiles/grids_intermediate_4326'))
-grid_fb = pd.read_csv('data/grid_fb.csv')
-grid_roof = pd.read_csv('data/grid_roofs.csv')
+# sum the FB population attributes in each grid - FB cells that straddle several grids are split by area
+# (with the FB GeoTIFF the population was already summed from the raster, in the population_fb column of grid_fb)
+if fb_raster == True:
+    grid_fb_population = pd.DataFrame(index = grid_fb.index)
+else:
+    fb_population_fields = list(df_fb_values.select_dtypes('number').columns)
+    
+    grid_fb_population, fb_population_key = stage_cache.run(
+            stage = 'aggregate_within_grid', files = [files['fb']], parents = [split_key],
+            params = {'fields': fb_population_fields, 'check_shape': fb_check_shape, 'apportion': True}, rows_in = len(df_grids_final),
+            function = lambda: clean_data.aggregate_within_grid(
+                    grid_shapes = df_grids_final['shape'], check_shapes = fb_work, 
+                    check_others = df_fb_values[fb_population_fields], check_shape = fb_check_shape, apportion = True))
+    
+    grid_fb_population = grid_fb_population.add_suffix('_fb_population')
 
 
 # In[19]:
 
 
-grid_fb.shape, grid_roof.shape, df_grids_final.shape # check that the lengths match for each dataset
+grid_fb.shape, grid_roof.shape, grid_fb_population.shape, df_grids_final.shape # check that the lengths match for each dataset
 
 
 # In[20]:
 
 
-# merge fb, roof, and EA datasets together
-grid_fb.reset_index(drop = True, inplace = True)
-grid_roof.reset_index(drop = True, inplace = True)
+# merge fb, roof, and EA datasets together - the EA index is kept from df_grids_final only, 
+# so that the merged dataset has no duplicate column names (which the parquet export rejects)
+grid_fb = grid_fb.drop('index', axis = 1, errors = 'ignore').reset_index(drop = True)
+grid_roof = grid_roof.drop('index', axis = 1, errors = 'ignore').reset_index(drop = True)
+grid_fb_population = grid_fb_population.drop('index', axis = 1, errors = 'ignore').reset_index(drop = True)
 df_grids_final.reset_index(drop = True, inplace = True)
 
-df_grids_final_all = pd.concat([df_grids_final, grid_fb, grid_roof], axis = 1)
+# the EAs in long/lat from here on (the counts above were done in the working CRS)
+df_grids_final['shape'] = eas_4326.values
+
+df_grids_final_all = pd.concat([df_grids_final, grid_fb, grid_roof, grid_fb_population], axis = 1)
 
 
 # ### 3b) Create unique EA IDs 
@@ -295,7 +391,8 @@ df_grids_final_all['ea_id'] = np.array(range(1, df_grids_final_all.shape[0] + 1)
 
 
 df_grids_final_clean = df_grids_final_all[['shape', 'index', 'intersect_fb', 'intersect_count_fb', 'intersect_no_count_fb', 
-                    'intersect_roof', 'intersect_count_roof', 'intersect_no_count_roof', 'ea_id']]
+                    'intersect_roof', 'intersect_count_roof', 'intersect_no_count_roof', 'ea_id'] 
+                    + (['population_fb'] if fb_raster == True else []) + list(grid_fb_population.columns)]
 
 
 # In[23]:
@@ -327,10 +424,6 @@ df_grids_final_clean['category'] = np.select(conditions, choices, default = 'Nei
 # In[25]:
 
 
-# create dictionaries for the plot
-grids_list = mapping.loop_many_shapes(grouped_df = df_grids_final_clean.groupby('category', sort=False), colors = 4,
-                                      shape_column = 'shape', shape_name_column = 'category')
-
 # plot grids, roads, and village clusters with study area
 fig, ax = mapping.plot_set_up(plot_title = 'Map of EAs with FB and Roofs',
                       plot_height = 10, plot_width = 8,
@@ -340,11 +433,9 @@ fig, ax = mapping.plot_set_up(plot_title = 'Map of EAs with FB and Roofs',
 # map study area
 mapping.shape_plot(axis = ax, shape_object = df_study_area['shape'][0], color = 'black', alpha = 1)
 
-# map all grids 
-for shape in grids_list:
-    mapping.shape_plot(axis = ax, shape_object = shape['shape'], color = shape['color'],
-                       include_label = shape['include_label'], label_name = shape['label'], 
-                       alpha = 0.4)
+# map all grids - one collection, with a color per category
+mapping.group_collection(axis = ax, grouped_df = df_grids_final_clean.groupby('category', sort=False), colors = 4,
+                         shape_column = 'shape', alpha = 0.4)
 
 # finish plot
 mapping.plot_final(ax_object = ax, fig_object = fig, 
@@ -369,20 +460,34 @@ for index, df in df_grids_final_clean.groupby('category'):
                           plot_height = 10, plot_width = 8,
                           x_label = 'Longitude', y_label = 'Latitude',
                           plot_aspect = 'equal')
-
+    
     # map study area
     mapping.shape_plot(axis = ax, shape_object = df_study_area['shape'][0], color = 'black', alpha = 1)
-
+    
     # map all grids 
     mapping.shape_plot_df(axis = ax, shapes = df['shape'], include_label = False,
                           label_name = '', alpha = 1, color = next(colors))
     
     # finish plot
     mapping.plot_final(ax_object = ax, fig_object = fig, file_name = file, save_file = True)
-
+    
     plt.show()
 
 
+# In[ ]:
+
+
+# tile pyramid of the EAs by category (plots/tiles/zoom/x/y.png) to browse large maps offline, e.g. in QGIS as an XYZ layer
+# more workers draw the tiles in parallel (on Windows / macOS this needs an if __name__ == '__main__' guard, as in batch_segmentation.py)
+# the tiles are drawn with Pillow, and skipped if it is not installed
+if tiles.Image is None:
+    print('Pillow is not installed, skipping the tile pyramid (install it with: pip install Pillow)')
+else:
+    with profiler.stage('build_tiles', rows_in = len(df_grids_final_clean)) as record:
+        record['rows_out'] = tiles.build_tiles(shapes = df_grids_final_clean['shape'], categories = df_grids_final_clean['category'], 
+                                               directory = 'plots/tiles', zooms = range(8, 16), crs = crs_destination, workers = 1)
+
+
 # In[27]:
 
 
@@ -402,22 +507,40 @@ df_grids_final_clean['category'].value_counts() / df_grids_final_clean.shape[0]
 # In[29]:
 
 
-# study area
-clean_data.export_shapefile(df = df_study_area, shape_name = 'shape', 
-                            field_names = [['shape_id', 'N']], file_name = 'shapefiles/study_area_4326')
+# study area, roads, rivers and grids with labels - written at the same time
+with profiler.stage('export_shapefiles', rows_in = len(df_grids_final_clean)):
+    clean_data.export_shapefiles(workers = 4, layers = [
+        {'df': df_study_area, 'shape_name': 'shape', 
+         'field_names': [['shape_id', 'N']], 'file_name': 'shapefiles/study_area_4326'},
+        {'df': df_roads_final, 'shape_name': 'shape', 
+         'field_names': [['highway', 'C'], ['surface', 'C']], 'file_name': 'shapefiles/roads_final_4326'},
+        {'df': df_rivers_final, 'shape_name': 'shape', 
+         'field_names': [['waterway', 'C'], ['name', 'C']], 'file_name': 'shapefiles/rivers_final_4326'},
+        {'df': df_grids_final_clean.reset_index(), 'shape_name': 'shape', 
+         'field_names': [['ea_id','N'], ['category', 'C']], 'file_name': 'shapefiles/grids_final_4326'}])
+
+
+# In[30]:
+
+
+# columnar copies of the EAs, roads and rivers - much faster to reload than the csv or shapefiles
+columnar.export_parquet(df = df_grids_final_clean.reset_index(), shape_name = 'shape', 
+                        file_name = 'data/EA_information.parquet', crs = crs_destination)
+
+columnar.export_parquet(df = df_roads_final, shape_name = 'shape', 
+                        file_name = 'data/roads_final_4326.parquet', crs = crs_destination)
+
+columnar.export_parquet(df = df_rivers_final, shape_name = 'shape', 
+                        file_name = 'data/rivers_final_4326.parquet', crs = crs_destination)
+
+# to reload the EAs
+# df_eas, crs_eas = columnar.read_columnar('data/EA_information.parquet')
+
 
-# roads
-clean_data.export_shapefile(df = df_roads_final, shape_name = 'shape', 
-                            field_names = [['highway', 'C'], ['surface', 'C']], 
-                            file_name = 'shapefiles/roads_final_4326')
+# In[31]:
 
-# rivers
-clean_data.export_shapefile(df = df_rivers_final, shape_name = 'shape', 
-                            field_names = [['waterway', 'C'], ['name', 'C']], 
-                            file_name = 'shapefiles/rivers_final_4326')
 
-# grids with labels
-clean_data.export_shapefile(df = df_grids_final_clean.reset_index(), shape_name = 'shape', 
-                            field_names = [['ea_id','N'], ['category', 'C']], 
-                            file_name = 'shapefiles/grids_final_4326')
+# finish the run report (data/run_report.json) and show the slowest stages
+run_report = profiler.stop()
 
+pd.DataFrame(run_report['stages'])[['stage', 'seconds', 'rss_peak_mb', 'rows_in', 'rows_out']].sort_values('seconds', ascending = False)
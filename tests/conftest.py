@@ -0,0 +1,45 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+## the functions are imported from the root of the repository, as in the notebook
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import functions.clean_data as clean_data
+import functions.reproject as reproject
+import benchmarks.synthetic as synthetic
+
+## a study area small enough for the original loops (count_within_grid, split_grids_line) to run in seconds
+SIZE = {'radius': 2000, 'meters': 500, 'roads': 6, 'rivers': 2, 'roofs': 600, 'fb': 150}
+
+
+@pytest.fixture(scope = 'session')
+def data():
+    '''
+    purpose
+    # the layers of a small synthetic study area (see benchmarks/synthetic.py), with the grids, trimmed grids and lines
+    # of the notebook (in long/lat) added, so that each engine can be compared with the function it replaces
+    '''
+    
+    d = synthetic.make_dataset(seed = 0, **SIZE)
+    
+    grids = clean_data.create_grids_box(shape = d['area_source'], meters = d['meters'])[['shape']]
+    grids['shape'] = reproject.transform_shapes(grids['shape'], src_crs = synthetic.CRS_SOURCE,
+                                                dst_crs = synthetic.CRS_DESTINATION)
+    grids.reset_index(inplace = True)
+    
+    trim = clean_data.split_grids_polygon_index(grids = grids['shape'], boundaries = d['df_study_area']['shape'])
+    
+    lines = pd.concat([clean_data.split_multiline(df = d['df_roads'], shape_name = 'shape')['shape'],
+                       clean_data.split_multiline(df = d['df_rivers'], shape_name = 'shape')['shape']],
+                      ignore_index = True)
+    
+    eas = clean_data.split_grids_lines(grids = trim, shape_name = 'shape', index_name = 'index',
+                                       boundary_layers = {'lines': lines})
+    
+    d.update({'grids': grids, 'trim': trim, 'lines': lines, 'eas': eas})
+    
+    return(d)
@@ -0,0 +1,37 @@
+import importlib
+
+import functions.cache as cache
+
+
+def grids_polygonize():
+    return('polygonize')
+
+def grids_box():
+    return('box')
+
+
+def test_stage_cache_code(tmp_path):
+    ## the same stage, files and parameters is only reused if it is run by the same code
+    stage_cache = cache.StageCache(directory = str(tmp_path))
+    
+    value, key = stage_cache.run(stage = 'create_grids', params = {'meters': 500}, function = grids_polygonize)
+    value_again, key_again = stage_cache.run(stage = 'create_grids', params = {'meters': 500}, function = grids_polygonize)
+    value_box, key_box = stage_cache.run(stage = 'create_grids', params = {'meters': 500}, function = grids_box)
+    
+    assert (value, value_again, value_box) == ('polygonize', 'polygonize', 'box')
+    assert key == key_again
+    assert key != key_box
+
+def test_hash_function_modules(tmp_path, monkeypatch):
+    ## editing a module that a stage calls into, or a module imported by it, changes the code of the stage
+    (tmp_path / 'stage_engine.py').write_text('import stage_helper\ndef run():\n    return(stage_helper.value())\n')
+    (tmp_path / 'stage_helper.py').write_text('def value():\n    return(1)\n')
+    (tmp_path / 'stage_script.py').write_text('import stage_engine\nstage = lambda: stage_engine.run()\n')
+    monkeypatch.syspath_prepend(str(tmp_path))
+    
+    stage = importlib.import_module('stage_script').stage
+    before = cache.hash_function(stage)
+    
+    (tmp_path / 'stage_helper.py').write_text('def value():\n    return(100)\n')
+    
+    assert cache.hash_function(stage) != before
@@ -0,0 +1,16 @@
+import numpy as np
+import shapely
+
+import functions.columnar as columnar
+
+
+def test_geo_metadata_bbox():
+    ## the bbox covers the shapes, and is left out when no shape has coordinates
+    shapes = np.array([shapely.box(0, 0, 1, 1), None, shapely.Point(3, 2)], dtype = object)
+    
+    metadata = columnar.geo_metadata(shapes, shape_name = 'shape', crs = None)
+    
+    assert metadata['columns']['shape']['bbox'] == [0, 0, 3, 2]
+    
+    for shapes in [np.array([], dtype = object), np.array([None, shapely.Point()], dtype = object)]:
+        assert 'bbox' not in columnar.geo_metadata(shapes, shape_name = 'shape', crs = None)['columns']['shape']
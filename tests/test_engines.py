@@ -0,0 +1,389 @@
+import os
+import subprocess
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+import shapefile
+import shapely
+import shapely.affinity
+
+import functions.clean_data as clean_data
+import functions.incremental as incremental
+import functions.load_data as load_data
+import functions.multires as multires
+import functions.pipeline as pipeline
+import functions.reproject as reproject
+import functions.points as points
+import benchmarks.synthetic as synthetic
+
+COUNT_COLUMNS = ['intersect_count', 'intersect_no_count', 'intersect']
+EA_COLUMNS = ['shape', 'row', 'col', 'piece', 'bd_layers', 'intersect_count_fb', 'intersect_no_count_fb', 'intersect_fb',
+              'intersect_count_roof', 'intersect_no_count_roof', 'intersect_roof']
+
+
+def same_shapes(a, b, tolerance = 1e-9):
+    ## shapes that cover the same area, up to floating point noise relative to their size
+    a, b = np.asarray(a, dtype = object), np.asarray(b, dtype = object)
+    
+    return(shapely.area(shapely.symmetric_difference(a, b)) <= tolerance * np.maximum(shapely.area(a), shapely.area(b)))
+
+def assert_same(original, new):
+    ## the same rows in the same order: the shape column up to floating point noise, the other columns by value
+    original = original.reset_index(drop = True)
+    new = new.reset_index(drop = True)
+    
+    shape_names = [x for x in original.columns if x == 'shape']
+    
+    pd.testing.assert_frame_equal(original.drop(shape_names, axis = 1), new.drop(shape_names, axis = 1),
+                                  check_dtype = False)
+    
+    for shape_name in shape_names:
+        assert same_shapes(original[shape_name].values, new[shape_name].values).all()
+
+def layers(data):
+    ## the line and population layers of the synthetic study area, as pipeline.segment_area takes them
+    line_layers = {'roads': data['df_roads']['shape'], 'rivers': data['df_rivers']['shape']}
+    count_layers = {'_fb': (data['fb'], True), '_roof': (points.PointStore.from_shapes(data['roofs']), False)}
+    
+    return(line_layers, count_layers)
+
+def counts(df, append_names):
+    ## the count columns of count_within_grid and the engines that replace it
+    return(df[[x + append_names for x in COUNT_COLUMNS]].astype(np.int64))
+
+
+## each case runs the original function and the engine that replaces it on the synthetic study area (see conftest.py),
+## and returns the two outputs that should be the same
+
+def case_count_index_points(data, tmp_path):
+    original = clean_data.count_within_grid(grid_shapes = data['eas']['shape'], check_shapes = data['roofs'],
+                                            append_names = '_roof', check_shape = False)
+    index = clean_data.count_within_grid_index(grid_shapes = data['eas']['shape'], check_shapes = data['roofs'],
+                                               append_names = '_roof', check_shape = False)
+    
+    return(counts(original, '_roof'), counts(index, '_roof'))
+
+def case_count_index_polygons(data, tmp_path):
+    original = clean_data.count_within_grid(grid_shapes = data['eas']['shape'], check_shapes = data['fb'],
+                                            append_names = '_fb', check_shape = True,
+                                            check_others = data['df_fb_values'])
+    index = clean_data.count_within_grid_index(grid_shapes = data['eas']['shape'], check_shapes = data['fb'],
+                                               append_names = '_fb', check_shape = True,
+                                               check_others = data['df_fb_values'])
+    
+    return(counts(original, '_fb').assign(population = original['population_fb']),
+           counts(index, '_fb').assign(population = index['population_fb']))
+
+def case_aggregate_within_grid(data, tmp_path):
+    ## the grouped reduction sums the same population as the loop over the check shapes of each grid
+    original = clean_data.count_within_grid(grid_shapes = data['eas']['shape'], check_shapes = data['fb'],
+                                            append_names = '_fb', check_shape = True,
+                                            check_others = data['df_fb_values'])
+    aggregate = clean_data.aggregate_within_grid(grid_shapes = data['eas']['shape'], check_shapes = data['fb'],
+                                                 check_others = data['df_fb_values'])
+    
+    return(original[['population_fb']], aggregate[['population']].add_suffix('_fb'))
+
+def case_count_binned(data, tmp_path):
+    ## the binned engine works in the CRS of the grids (meters)
+    eas = reproject.transform_shapes(data['eas']['shape'], src_crs = synthetic.CRS_DESTINATION, dst_crs = synthetic.CRS_SOURCE)
+    roofs = reproject.transform_shapes(data['roofs'], src_crs = synthetic.CRS_DESTINATION, dst_crs = synthetic.CRS_SOURCE)
+    origin = clean_data.grid_origin(data['area_source'], data['meters'])
+    
+    index = clean_data.count_within_grid_index(grid_shapes = eas, check_shapes = roofs, append_names = '_roof', check_shape = False)
+    binned = clean_data.count_within_grid_binned(grid_shapes = eas, check_shapes = roofs, origin = origin,
+                                                 meters = data['meters'], append_names = '_roof')
+    
+    return(counts(index, '_roof'), counts(binned, '_roof'))
+
+def case_count_binned_shared_squares(data, tmp_path):
+    ## grids copied by overlapping boundaries share their square, and are tested exactly
+    grids = clean_data.create_grids_box(shape = data['area_source'], meters = data['meters'])
+    inner = shapely.box(*data['area_source'].bounds).buffer(-1000)
+    trim = clean_data.split_grids_polygon_index(grids = grids['shape'], boundaries = pd.Series([data['area_source'], inner]))
+    roofs = reproject.transform_shapes(data['roofs'], src_crs = synthetic.CRS_DESTINATION, dst_crs = synthetic.CRS_SOURCE)
+    origin = clean_data.grid_origin(data['area_source'], data['meters'])
+    
+    assert trim['index'].duplicated().any()
+    
+    index = clean_data.count_within_grid_index(grid_shapes = trim['shape'], check_shapes = roofs, append_names = '_roof', check_shape = False)
+    binned = clean_data.count_within_grid_binned(grid_shapes = trim['shape'], check_shapes = roofs, origin = origin,
+                                                 meters = data['meters'], append_names = '_roof')
+    
+    return(counts(index, '_roof'), counts(binned, '_roof'))
+
+def case_count_eas_binned(data, tmp_path):
+    ## projected EAs of the pipeline: the points are binned when the origin of the grids is given
+    roofs = reproject.transform_shapes(data['roofs'], src_crs = synthetic.CRS_DESTINATION, dst_crs = synthetic.CRS_SOURCE)
+    eas = pipeline.build_eas(study_area = data['area_source'], meters = data['meters'], crs_out = None, tile_cells = 4)
+    origin = clean_data.grid_origin(data['area_source'], data['meters'])
+    
+    index = pipeline.count_eas(eas = eas, count_layers = {'_roof': (roofs, False)}, tile_cells = 4)
+    binned = pipeline.count_eas(eas = eas, count_layers = {'_roof': (roofs, False)}, tile_cells = 4,
+                                origin = origin, meters = data['meters'])
+    
+    return(counts(index, '_roof'), counts(binned, '_roof'))
+
+def case_split_multiline(data, tmp_path):
+    ## the row by row split of the notebook (MultiLineStrings are split with .geoms in shapely 2), and the bulk split
+    roads = data['df_roads'].set_index(data['df_roads'].index + 10)
+    line_list = []
+    
+    for index, row in roads.iterrows():
+        if row['shape'].geom_type == 'MultiLineString':
+            for ele in [x for x in row['shape'].geoms]:
+                line_list.append({'index': index, 'shape': ele})
+        else:
+            line_list.append({'index': index, 'shape': row['shape']})
+    
+    original = pd.DataFrame.from_dict(line_list).merge(roads.drop('shape', axis = 1), right_index = True, left_on = 'index')
+    bulk = clean_data.split_multiline(roads, shape_name = 'shape')
+    
+    assert len(bulk) > len(roads)
+    
+    return(original, bulk)
+
+def case_create_grids_box(data, tmp_path):
+    ## the same grids as create_grids, built as boxes instead of polygonized from lines (polygonize has no order)
+    original = clean_data.create_grids(shape = data['area_source'], meters = data['meters'])
+    boxes = clean_data.create_grids_box(shape = data['area_source'], meters = data['meters'])
+    
+    bounds = [pd.DataFrame(np.round(shapely.bounds(x['shape'].values), 6)).sort_values([1, 0]) for x in [original, boxes]]
+    
+    return(bounds[0], bounds[1])
+
+def case_split_grids_polygon_index(data, tmp_path):
+    original = clean_data.split_grids_polygon(grids = data['grids']['shape'], boundaries = data['df_study_area']['shape'])
+    index = clean_data.split_grids_polygon_index(grids = data['grids']['shape'], boundaries = data['df_study_area']['shape'])
+    
+    return(original, index)
+
+def case_split_grids_line_index(data, tmp_path):
+    ## the original splits a grid by one line at a time, so both engines are run one line at a time
+    original, index = [], []
+    
+    for line_pos in range(len(data['lines'])):
+        lines = data['lines'].iloc[[line_pos]]
+    
+        original.append(clean_data.split_grids_line(grids = data['trim'], shape_name = 'shape', index_name = 'index', boundaries = lines))
+        index.append(clean_data.split_grids_line_index(grids = data['trim'], shape_name = 'shape', index_name = 'index', boundaries = lines))
+    
+    return(pd.concat(original).astype({'index': np.int64, 'bd_index': np.int64}),
+           pd.concat(index).astype({'index': np.int64, 'bd_index': np.int64}))
+
+def case_split_grids_lines(data, tmp_path):
+    ## all layers in one pass: the grids split by any line are the pieces of split_grids_line_index with all lines
+    index = clean_data.split_grids_line_index(grids = data['trim'], shape_name = 'shape', index_name = 'index',
+                                              boundaries = data['lines'])
+    lines = clean_data.split_grids_lines(grids = data['trim'], shape_name = 'shape', index_name = 'index',
+                                         boundary_layers = {'roads': data['lines'].iloc[:3], 'other': data['lines'].iloc[3:]})
+    
+    lines = lines[np.isin(lines['bd_index'].values, index['bd_index'].values)]
+    
+    return(index[['shape', 'bd_index']], lines[['shape', 'bd_index']])
+
+def case_segment_area_tiled(data, tmp_path):
+    ## tiles of grids, in a process pool, stitch back to the same EAs as a single tile
+    line_layers, count_layers = layers(data)
+    
+    single = pipeline.segment_area(study_area = data['area_source'], meters = data['meters'],
+                                   line_layers = line_layers, count_layers = count_layers)
+    tiled = pipeline.segment_area(study_area = data['area_source'], meters = data['meters'],
+                                  line_layers = line_layers, count_layers = count_layers, tile_cells = 3, workers = 2)
+    
+    return(single[EA_COLUMNS], tiled[EA_COLUMNS])
+
+def case_run_incremental(data, tmp_path):
+    ## updating the EAs of a previous run after a road moved and roofs were removed and duplicated gives the same EAs 
+    ## as a full run
+    line_layers, count_layers = layers(data)
+    settings = {'study_area': data['area_source'], 'meters': data['meters'], 'directory': str(tmp_path / 'snapshot')}
+    
+    incremental.run_incremental(line_layers = line_layers, count_layers = count_layers, **settings)
+    
+    roads = data['df_roads']['shape'].copy()
+    roads.iloc[0] = shapely.affinity.translate(roads.iloc[0], xoff = 0.002)
+    roofs = pd.concat([data['roofs'].iloc[50:], data['roofs'].iloc[:20]])
+    
+    line_layers = dict(line_layers, roads = roads)
+    count_layers = dict(count_layers, _roof = (points.PointStore.from_shapes(roofs), False))
+    
+    eas, summary = incremental.run_incremental(line_layers = line_layers, count_layers = count_layers, **settings)
+    full = pipeline.segment_area(study_area = data['area_source'], meters = data['meters'],
+                                 line_layers = line_layers, count_layers = count_layers)
+    
+    assert (summary['full_run'] == False) and (summary['grids_resplit'] > 0)
+    assert eas['ea_id'].is_unique
+    
+    return(full[EA_COLUMNS], eas[EA_COLUMNS])
+
+def case_segment_resolutions(data, tmp_path):
+    ## the resolution sweep gives the same EAs as a projected run of each resolution with the origin of the coarsest grids
+    line_layers, count_layers = layers(data)
+    resolutions = [250, 500, 1000]
+    origin = clean_data.grid_origin(data['area_source'], max(resolutions))
+    
+    sweep = multires.segment_resolutions(study_area = data['area_source'], resolutions = resolutions,
+                                         line_layers = line_layers, count_layers = count_layers, tolerance = 0.1)
+    single = {x: pipeline.segment_area(study_area = data['area_source'], meters = x, line_layers = line_layers,
+                                       count_layers = count_layers, projected = True, tolerance = 0.1, origin = origin)
+              for x in resolutions}
+    
+    return(pd.concat([single[x][EA_COLUMNS].assign(resolution = x) for x in resolutions]),
+           pd.concat([sweep[x][EA_COLUMNS].assign(resolution = x) for x in resolutions]))
+
+def write_layers(data, tmp_path):
+    ## the roofs and FB of the synthetic study area as shapefiles
+    file_roofs = str(tmp_path / 'roofs')
+    file_fb = str(tmp_path / 'fb')
+    
+    with shapefile.Writer(file_roofs, shapeType = shapefile.POINT) as w:
+        w.field('id', 'N')
+    
+        for i, point in enumerate(data['roofs']):
+            w.point(point.x, point.y)
+            w.record(i)
+    
+    with shapefile.Writer(file_fb, shapeType = shapefile.POLYGON) as w:
+        w.field('id', 'N')
+    
+        for i, polygon in enumerate(shapely.orient_polygons(data['fb'].values, exterior_cw = True)):
+            w.poly([list(polygon.exterior.coords)])
+            w.record(i)
+    
+    return(file_roofs, file_fb)
+
+def case_count_chunks(data, tmp_path):
+    ## roofs and FB read back from shapefiles a few records at a time
+    file_roofs, file_fb = write_layers(data, tmp_path)
+    index, chunks = [], []
+    
+    for file_name, check_shapes, check_shape in [(file_roofs, data['roofs'], False), (file_fb, data['fb'], True)]:
+        index.append(counts(clean_data.count_within_grid_index(
+                grid_shapes = data['eas']['shape'], check_shapes = check_shapes, append_names = '_x', check_shape = check_shape), '_x'))
+        chunks.append(counts(clean_data.count_within_grid_chunks(
+                grid_shapes = data['eas']['shape'], append_names = '_x', check_shape = check_shape,
+                chunks = load_data.read_shp_chunks(shapefile.Reader(file_name), chunk_size = 97)), '_x'))
+    
+    return(pd.concat(index), pd.concat(chunks))
+
+def case_point_store(data, tmp_path):
+    ## a PointStore counts the same as a series of Points
+    series = clean_data.count_within_grid_index(grid_shapes = data['eas']['shape'], check_shapes = data['roofs'],
+                                                append_names = '_roof', check_shape = False)
+    stored = clean_data.count_within_grid_index(grid_shapes = data['eas']['shape'], check_shapes = points.PointStore.from_shapes(data['roofs']),
+                                                append_names = '_roof', check_shape = False)
+    
+    return(counts(series, '_roof'), counts(stored, '_roof'))
+
+CASES = [case_count_index_points, case_count_index_polygons, 
+         case_aggregate_within_grid,
+         case_count_binned, case_count_binned_shared_squares, case_count_eas_binned,
+         case_split_multiline,
+         case_create_grids_box,
+         case_split_grids_polygon_index, case_split_grids_line_index,
+         case_split_grids_lines,
+         case_segment_area_tiled,
+         case_run_incremental,
+         case_segment_resolutions,
+         case_count_chunks,
+         case_point_store]
+
+
+@pytest.mark.parametrize('case', CASES, ids = lambda x: x.__name__[5:])
+def test_engine(data, tmp_path, case):
+    original, new = case(data, tmp_path)
+    
+    assert len(original) > 0
+    assert_same(original, new)
+
+def test_aggregate_apportion(data):
+    ## apportioning splits each FB polygon between the EAs by area, so the EAs hold the share of the population inside them
+    eas = data['eas']['shape']
+    population = data['df_fb_values']['population']
+    
+    aggregate = clean_data.aggregate_within_grid(grid_shapes = eas, check_shapes = data['fb'],
+                                                 check_others = data['df_fb_values'], apportion = True)
+    
+    inside = shapely.area(shapely.intersection(data['fb'].values, shapely.union_all(eas.values))) / shapely.area(data['fb'].values)
+    
+    assert np.isclose(aggregate['population'].sum(), (population * inside).sum())
+    assert aggregate['population'].sum() < clean_data.aggregate_within_grid(grid_shapes = eas, check_shapes = data['fb'],
+                                                                            check_others = data['df_fb_values'])['population'].sum()
+
+def test_segment_area(data):
+    ## the pipeline gives the same EAs and counts as the notebook engines run one after the other
+    line_layers, count_layers = layers(data)
+    eas = pipeline.segment_area(study_area = data['area_source'], meters = data['meters'],
+                                line_layers = line_layers, count_layers = count_layers)
+    
+    trim = clean_data.split_grids_polygon_index(grids = data['grids']['shape'], boundaries = data['df_study_area']['shape'])
+    lines = clean_data.split_grids_lines(grids = trim, shape_name = 'shape', index_name = 'index',
+                                         boundary_layers = line_layers)
+    roofs = clean_data.count_within_grid_index(grid_shapes = lines['shape'], check_shapes = data['roofs'],
+                                               append_names = '_roof', check_shape = False)
+    
+    assert len(eas) == len(lines)
+    assert np.isclose(shapely.area(eas['shape'].values).sum(), shapely.area(lines['shape'].values).sum())
+    assert eas['intersect_count_roof'].sum() == roofs['intersect_count_roof'].sum()
+
+def test_split_grids_lines_layers(data):
+    ## every grid is kept or split, and only a sliver of area is lost to the buffers around the lines
+    lines = clean_data.split_grids_lines(grids = data['trim'], shape_name = 'shape', index_name = 'index',
+                                         boundary_layers = {'lines': data['lines']})
+    
+    assert set(lines['bd_index']) == set(data['trim']['index'])
+    assert np.isclose(shapely.area(lines['shape'].values).sum(), shapely.area(data['trim']['shape'].values).sum(), rtol = 1e-3)
+    
+    ## only the pieces of split grids list the layers that split them
+    index = clean_data.split_grids_line_index(grids = data['trim'], shape_name = 'shape', index_name = 'index',
+                                              boundaries = data['lines'])
+    
+    assert ((lines['bd_layers'] != '') == lines['bd_index'].isin(index['bd_index'])).all()
+    
+    ## a road across the grid splits it, a river that ends inside the grid does not
+    grids = pd.DataFrame({'shape': [shapely.box(0, 0, 500, 500)], 'index': [0]})
+    road = pd.Series([shapely.LineString([(-10, 250), (510, 250)])])
+    river = pd.Series([shapely.LineString([(100, -10), (100, 200)])])
+    
+    lines = clean_data.split_grids_lines(grids = grids, shape_name = 'shape', index_name = 'index', tolerance = 0.1,
+                                         boundary_layers = {'roads': road, 'rivers': river})
+    
+    assert len(lines) == 2
+    assert (lines['bd_layers'] == 'roads').all()
+
+def test_changed_shapes():
+    ## layers are compared as multisets, so removing one of two identical points is a change
+    roofs = pd.Series(shapely.points([(0, 0), (0, 0), (1, 1)]))
+    
+    changed = incremental.changed_shapes(roofs, roofs.iloc[1:])
+    
+    assert len(changed) == 1 and changed[0].equals(roofs[0])
+    assert len(incremental.changed_shapes(roofs, roofs.iloc[::-1])) == 0
+
+def test_shape_hashes():
+    ## the hashes are the same in every session, so a snapshot can be compared with the layers of a later run
+    shapes = pd.Series(shapely.points([(0, 0), (1, 2)]))
+    code = 'import shapely, pandas, functions.incremental as i; ' \
+           'print(list(i.shape_hashes(pandas.Series(shapely.points([(0, 0), (1, 2)])))))'
+    
+    output = subprocess.run([sys.executable, '-c', code], capture_output = True, text = True, check = True,
+                            cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    
+    assert output.stdout.strip() == str(list(incremental.shape_hashes(shapes)))
+
+def test_load_points(data, tmp_path):
+    ## the points read from a shapefile are saved once, and memory mapped by later loads
+    file_roofs, file_fb = write_layers(data, tmp_path)
+    clip = data['df_study_area']['shape'][0]
+    
+    store = points.load_points(file_roofs + '.shp', directory = str(tmp_path / 'cache'), fields = ['id'], clip = clip)
+    again = points.load_points(file_roofs + '.shp', directory = str(tmp_path / 'cache'), fields = ['id'], clip = clip)
+    
+    kept = data['roofs'][shapely.intersects(clip, data['roofs'].values)]
+    
+    assert isinstance(again.xy, np.memmap)
+    assert np.array_equal(store.xy, again.xy)
+    assert np.array_equal(again.xy, shapely.get_coordinates(kept.values))
+    assert np.array_equal(again.attributes['id'], kept.index.values)